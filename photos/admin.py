@@ -1,7 +1,32 @@
 from django.contrib import admin
-from PIL import Image
+from django.db import models
 
-from photasm.photos.models import Album, Photo, PhotoTag
+from photasm.photos.jobs import (
+    enqueue, enqueue_processing, requeue_failed_jobs)
+from photasm.photos.models import Album, Photo, PhotoTag, StreamedImageField
+from photasm.photos.uploadhandler import (
+    StreamingImageUploadHandler, get_image_format)
+
+
+class AlbumAdmin(admin.ModelAdmin):
+    """\
+    Django Admin form for Albums.
+
+    Photos uploaded in batches have their thumbnails and metadata processed
+    by the background workers; the retry_failed_photos action returns the
+    work that failed for the selected Albums to their queue.
+
+    """
+    list_display = ('name', 'owner', 'photo_count', 'is_public')
+    actions = ['retry_failed_photos']
+
+    def retry_failed_photos(self, request, queryset):
+        album_ids = list(queryset.values_list('id', flat=True))
+        requeued = requeue_failed_jobs(album_ids=album_ids)
+        self.message_user(request, "%d failed job(s) queued again." % (
+            requeued,))
+    retry_failed_photos.short_description = (
+        "Retry processing the failed photographs of the selected albums")
 
 
 class PhotoAdmin(admin.ModelAdmin):
@@ -9,6 +34,29 @@ class PhotoAdmin(admin.ModelAdmin):
     Django Admin form for adding and editing Photos.
 
     """
+    list_display = ('__unicode__', 'album', 'owner', 'admin_thumbnail')
+    formfield_overrides = {
+        models.ImageField: {'form_class': StreamedImageField},
+    }
+
+    def admin_thumbnail(self, obj):
+        """\
+        Displays the thumbnail rather than the original in the change list.
+
+        """
+        if not obj.thumbnail:
+            return ''
+        return '<img src="%s" title="%s" />' % (obj.thumbnail_url, obj)
+    admin_thumbnail.short_description = 'thumbnail'
+    admin_thumbnail.allow_tags = True
+
+    def add_view(self, request, *args, **kwargs):
+        request.upload_handlers = [StreamingImageUploadHandler(request)]
+        return super(PhotoAdmin, self).add_view(request, *args, **kwargs)
+
+    def change_view(self, request, *args, **kwargs):
+        request.upload_handlers = [StreamingImageUploadHandler(request)]
+        return super(PhotoAdmin, self).change_view(request, *args, **kwargs)
 
     def save_model(self, request, obj, form, change):
         """\
@@ -20,81 +68,28 @@ class PhotoAdmin(admin.ModelAdmin):
         and saving them back to the file on the filesystem. Otherwise, if the
         Photo is being changed without modifying its associated image data,
         the image metadata is simply written to the file on the filesystem.
+        In either case the work is queued for a background worker.
 
         The change parameter is False if object is being added, and it is
         True if the object is being edited.
 
         """
-        image_change = False
-        try:
-            old_obj = Photo.objects.get(pk=obj.pk)
-            if old_obj.image.path != obj.image.path:
-                image_change = True
-        except:
-            pass
-
-        photo = form.cleaned_data['image']
-        photo.open()
-        image = Image.open(photo)
-        if image.format == 'JPEG':
-            obj.is_jpeg = True
-        photo.close()
+        image_change = obj.image_changed()
+
+        obj.is_jpeg = get_image_format(form.cleaned_data['image']) == 'JPEG'
 
         obj.save()
         form.save_m2m()
 
         # object is being added or image field is being modified
         if change is False or image_change is True:
-            # Remember user-entered fields.
-            description = obj.description
-            artist = obj.artist
-            country = obj.country
-            province_state = obj.province_state
-            city = obj.city
-            location = obj.location
-            time_created = obj.time_created
-            keywords = obj.keywords.all()
-
-            obj.create_thumbnail()
-            obj.sync_metadata_from_file()
-
-            # Put user-entered fields back into object that may have
-            # been overwritten by metadata sync.
-            sync_back = False
-            if description:
-                obj.description = description
-                sync_back = True
-            if artist:
-                obj.artist = artist
-                sync_back = True
-            if country:
-                obj.country = country
-                sync_back = True
-            if province_state:
-                obj.province_state = province_state
-                sync_back = True
-            if city:
-                obj.city = city
-                sync_back = True
-            if location:
-                obj.location = location
-                sync_back = True
-            if time_created:
-                obj.time_created = time_created
-                sync_back = True
-            if keywords:
-                obj.keywords = keywords
-                form.save_m2m()
-                sync_back = True
-
-            if sync_back is True:
-                obj.save()
-                obj.sync_metadata_to_file()
+            enqueue_processing(obj, 'merge_metadata')
 
         # object is being changed
         else:
-            obj.sync_metadata_to_file()
+            enqueue(obj, 'metadata_to_file')
 
 
 admin.site.register(Photo, PhotoAdmin)
-admin.site.register((Album, PhotoTag))
+admin.site.register(Album, AlbumAdmin)
+admin.site.register(PhotoTag)
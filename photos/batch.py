@@ -0,0 +1,194 @@
+import os
+import tempfile
+import zipfile
+
+from django.db import transaction
+
+from photasm.photos.image_files import (
+    CHUNK_SIZE,
+    SIGNATURE_LENGTH,
+    sniff_image_format,
+)
+from photasm.photos.jobs import enqueue_processing
+from photasm.photos.models import Photo
+from photasm.photos.uploadhandler import StagedFile, get_upload_dir
+
+
+class BatchResult(object):
+    """\
+    The outcome of importing one file of a batch.
+
+    The photo is the Photo created, or None if the file was not imported,
+    in which case error explains why.
+
+    """
+
+    def __init__(self, name, photo=None, error=None):
+        self.name = name
+        self.photo = photo
+        self.error = error
+
+    def __unicode__(self):
+        if self.photo is None:
+            return u"%s: %s" % (self.name, self.error)
+        return u"%s: added" % (self.name,)
+
+
+def _sniff_file(path):
+    f = open(path, 'rb')
+    try:
+        return sniff_image_format(f.read(SIGNATURE_LENGTH))
+    finally:
+        f.close()
+
+
+def _stage_upload(uploaded_file):
+    """\
+    Returns the path of an uploaded file on disk, writing it to the upload
+    directory if it is not already on disk.
+
+    """
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        return uploaded_file.temporary_file_path()
+    fd, path = tempfile.mkstemp(suffix='.upload', dir=get_upload_dir())
+    f = os.fdopen(fd, 'wb')
+    try:
+        for chunk in uploaded_file.chunks():
+            f.write(chunk)
+    finally:
+        f.close()
+    return path
+
+
+def _extract_zip(path):
+    """\
+    Extracts the images in a zip archive into the upload directory.
+
+    Members are copied in chunks, so memory use does not depend on their
+    size. Directories are skipped.
+
+    Returns a list of (name, path, image_format, error) tuples; path is None
+    for members that are not images.
+
+    """
+    staged = []
+    archive = zipfile.ZipFile(path)
+    try:
+        for info in archive.infolist():
+            name = info.filename
+            if name.endswith('/'):
+                continue
+            member = archive.open(info)
+            fd, member_path = tempfile.mkstemp(suffix='.upload',
+                                               dir=get_upload_dir())
+            f = os.fdopen(fd, 'wb')
+            try:
+                chunk = member.read(CHUNK_SIZE)
+                while chunk:
+                    f.write(chunk)
+                    chunk = member.read(CHUNK_SIZE)
+            finally:
+                f.close()
+                member.close()
+
+            image_format = _sniff_file(member_path)
+            if image_format is None:
+                os.remove(member_path)
+                staged.append((name, None, None,
+                               "not a recognized image"))
+            else:
+                staged.append((os.path.basename(name), member_path,
+                               image_format, None))
+    finally:
+        archive.close()
+    return staged
+
+
+def stage_files(uploaded_files):
+    """\
+    Puts uploaded images, and the images in uploaded zip archives, on disk.
+
+    Returns a list of (name, path, image_format, error) tuples in the order
+    of the files; path is None for files that are not images.
+
+    Parameters:
+    uploaded_files -- list of UploadedFile objects
+
+    """
+    staged = []
+    for uploaded_file in uploaded_files:
+        copied = not hasattr(uploaded_file, 'temporary_file_path')
+        path = _stage_upload(uploaded_file)
+        image_format = getattr(uploaded_file, 'image_format', None)
+        if image_format is None:
+            image_format = _sniff_file(path)
+        if image_format is not None:
+            staged.append((uploaded_file.name, path, image_format, None))
+            continue
+
+        if zipfile.is_zipfile(path):
+            staged.extend(_extract_zip(path))
+        else:
+            staged.append((uploaded_file.name, None, None,
+                           "not a recognized image or zip archive"))
+        if copied:
+            os.remove(path)
+    return staged
+
+
+@transaction.commit_on_success
+def create_photos(owner, album, staged):
+    """\
+    Creates Photos for staged image files in a single transaction.
+
+    Returns a list of BatchResults in the order of the files.
+
+    Parameters:
+    owner -- User owning the photographs
+    album -- Album to add the photographs to
+    staged -- list of (name, path, image_format, error) tuples, as returned
+              by stage_files()
+
+    """
+    results = []
+    for name, path, image_format, error in staged:
+        if path is None:
+            results.append(BatchResult(name, error=error))
+            continue
+        image_file = StagedFile(path, name)
+        try:
+            photo = Photo.objects.create_from_file(owner, album, image_file,
+                                                   image_format)
+        except (IOError, OSError) as e:
+            results.append(BatchResult(name, error=str(e)))
+        else:
+            results.append(BatchResult(name, photo=photo))
+        finally:
+            image_file.close()
+            if os.path.exists(path):
+                os.remove(path)
+    return results
+
+
+def import_files(owner, album, uploaded_files):
+    """\
+    Imports many uploaded images, or zip archives of images, into an Album.
+
+    The Photos are created in one transaction, and the creation of their
+    thumbnails and the reading of their metadata are queued, so that they
+    are processed in parallel by the job workers (see the
+    process_photo_jobs management command).
+
+    Returns a list of BatchResults, one per image or file not imported.
+
+    Parameters:
+    owner -- User owning the photographs
+    album -- Album to add the photographs to
+    uploaded_files -- list of UploadedFile objects
+
+    """
+    results = create_photos(owner, album, stage_files(uploaded_files))
+    for result in results:
+        if result.photo is not None:
+            enqueue_processing(result.photo)
+    return results
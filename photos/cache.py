@@ -0,0 +1,188 @@
+from datetime import datetime
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import wraps
+from django.utils.hashcompat import md5_constructor
+from django.views.decorators.http import condition
+
+
+DEFAULT_CACHE_TIMEOUT = 60 * 60
+"""\
+Seconds that rendered pages and template fragments are cached.
+
+Cached entries are invalidated by changing the version they are keyed by
+rather than by deleting them, so this mostly bounds the size of the cache.
+This may be overridden with the PHOTO_CACHE_TIMEOUT setting.
+
+"""
+
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def get_cache_timeout():
+    """\
+    Returns the number of seconds that pages and fragments are cached.
+
+    """
+    return getattr(settings, 'PHOTO_CACHE_TIMEOUT', DEFAULT_CACHE_TIMEOUT)
+
+
+def _version_key(kind, pk):
+    return 'photasm:version:%s:%s' % (kind, pk)
+
+
+def _new_version():
+    return '%x' % (int(time.time() * 1000000),)
+
+
+def get_version(kind, pk):
+    """\
+    Returns the current cache version of an object.
+
+    Cached data derived from the object is keyed by its version, so that
+    changing the version with bump_version() invalidates all of it at once.
+
+    Parameters:
+    kind -- kind of object: 'photo', 'album' or 'owner'
+    pk -- primary key of the object
+
+    """
+    key = _version_key(kind, pk)
+    version = cache.get(key)
+    if version is None:
+        # A version that was evicted is replaced with a new one, which is
+        # never equal to an older version.
+        version = _new_version()
+        cache.add(key, version, VERSION_TIMEOUT)
+        version = cache.get(key, version)
+    return version
+
+
+def bump_version(kind, pk):
+    """\
+    Invalidates the cached data derived from an object.
+
+    Parameters:
+    kind -- kind of object: 'photo', 'album' or 'owner'
+    pk -- primary key of the object
+
+    """
+    if pk is not None:
+        cache.set(_version_key(kind, pk), _new_version(), VERSION_TIMEOUT)
+
+
+def make_key(*parts):
+    """\
+    Returns a cache key made of several values.
+
+    The values are hashed, so they may contain any characters.
+
+    """
+    value = ':'.join([unicode(part) for part in parts]).encode('utf-8')
+    return 'photasm:%s' % (md5_constructor(value).hexdigest(),)
+
+
+def has_pending_messages(request):
+    """\
+    Determines whether the user has messages waiting to be displayed.
+
+    Messages are displayed once, by the next page rendered, so such a page
+    must be rendered rather than served from a cache.
+
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated():
+        return False
+    return user.message_set.count() > 0
+
+
+def cache_view(get_versions):
+    """\
+    Returns a decorator that caches the responses of a view.
+
+    Responses are cached separately for each user and URL, keyed by the
+    versions of the objects they display, so they are invalidated when any
+    of those objects changes. Only successful responses to GET and HEAD
+    requests are cached. The cache is bypassed while the user has messages
+    waiting to be displayed.
+
+    Parameters:
+    get_versions -- function taking the arguments of the view and returning
+                    a list of (kind, pk) tuples of the objects displayed, or
+                    None if the response should not be cached
+
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or \
+               has_pending_messages(request):
+                return view(request, *args, **kwargs)
+            objects = get_versions(request, *args, **kwargs)
+            if objects is None:
+                return view(request, *args, **kwargs)
+
+            versions = [get_version(kind, pk) for kind, pk in objects]
+            key = make_key('view', view.__name__, request.user.id,
+                           request.get_full_path(), *versions)
+            response = cache.get(key)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200:
+                    cache.set(key, response, get_cache_timeout())
+            return response
+        return wrapper
+    return decorator
+
+
+def conditional_view(get_state):
+    """\
+    Returns a decorator that answers conditional GET requests to a view.
+
+    The ETag and Last-Modified headers are computed from a small amount of
+    state, such as the updated timestamps of the objects displayed, which
+    is fetched once per request. If the client's copy is current, the
+    response is 304 Not Modified and the view is not run. The ETag depends
+    on the user and URL, as the pages differ between users. No validators
+    are used while the user has messages waiting to be displayed, so that
+    the page displaying them is always rendered.
+
+    Parameters:
+    get_state -- function taking the arguments of the view and returning a
+                 list of values that change whenever the response changes,
+                 or None if the objects displayed do not exist; the latest
+                 datetime in the list is used as Last-Modified
+
+    """
+    def decorator(view):
+        def state(request, *args, **kwargs):
+            if not hasattr(request, '_conditional_state'):
+                if has_pending_messages(request):
+                    request._conditional_state = None
+                else:
+                    request._conditional_state = get_state(request, *args,
+                                                           **kwargs)
+            return request._conditional_state
+
+        def etag(request, *args, **kwargs):
+            values = state(request, *args, **kwargs)
+            if values is None:
+                return None
+            return make_key('etag', view.__name__, request.user.id,
+                            request.get_full_path(), *values)
+
+        def last_modified(request, *args, **kwargs):
+            values = state(request, *args, **kwargs)
+            if values is None:
+                return None
+            timestamps = [value for value in values
+                          if isinstance(value, datetime)]
+            if not timestamps:
+                return None
+            return max(timestamps)
+
+        return condition(etag_func=etag, last_modified_func=last_modified)(
+            view)
+    return decorator
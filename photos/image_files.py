@@ -0,0 +1,96 @@
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+import time
+
+
+CHUNK_SIZE = 64 * 1024
+
+MTIME_GRANULARITY = 2
+"""\
+Coarsest resolution, in seconds, of file modification times.
+
+Some file systems store modification times with a resolution of one or two
+seconds, so a file changed shortly after it was last stat()ed may keep the
+same size and modification time.
+
+"""
+
+
+def hash_file(path):
+    """\
+    Computes the SHA-1 hash of a file's contents.
+
+    The file is read in chunks, so memory use does not depend on its size.
+
+    Returns the hash as a string of 40 hexadecimal digits.
+
+    Parameters:
+    path -- path to the file to hash
+
+    """
+    content_hash = sha1()
+    f = open(path, 'rb')
+    try:
+        chunk = f.read(CHUNK_SIZE)
+        while chunk:
+            content_hash.update(chunk)
+            chunk = f.read(CHUNK_SIZE)
+    finally:
+        f.close()
+    return content_hash.hexdigest()
+
+
+def is_mtime_ambiguous(mtime, now=None):
+    """\
+    Determines whether a file could still be changed without changing its
+    modification time.
+
+    This is the case while the modification time is within
+    MTIME_GRANULARITY of the current time.
+
+    Parameters:
+    mtime -- modification time of the file, as returned by os.stat()
+    now -- current time; defaults to time.time()
+
+    """
+    if now is None:
+        now = time.time()
+    return now - mtime < MTIME_GRANULARITY
+
+
+IMAGE_SIGNATURES = (
+    ('\xff\xd8\xff', 'JPEG'),
+    ('\x89PNG\r\n\x1a\n', 'PNG'),
+    ('GIF87a', 'GIF'),
+    ('GIF89a', 'GIF'),
+    ('II*\x00', 'TIFF'),
+    ('MM\x00*', 'TIFF'),
+    ('BM', 'BMP'),
+)
+"""\
+Leading bytes of the image formats that may be uploaded, with the PIL names
+of the formats.
+
+"""
+
+SIGNATURE_LENGTH = max([len(signature) for signature, format in
+                        IMAGE_SIGNATURES])
+
+
+def sniff_image_format(header):
+    """\
+    Determines the format of an image from its first bytes.
+
+    Returns the PIL name of the format, or None if it is not recognized.
+
+    Parameters:
+    header -- string holding at least the first SIGNATURE_LENGTH bytes of
+              the image
+
+    """
+    for signature, format in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return format
+    return None
@@ -1,4 +1,6 @@
 from datetime import datetime
+import os
+import tempfile
 
 import pyexiv2
 
@@ -29,6 +31,136 @@ def get_image_height_key(img_is_jpeg):
     return 'Exif.Image.ImageLength'
 
 
+class ImageMetadata(object):
+    """\
+    Exif and IPTC metadata read once from an image file.
+
+    This wraps a pyexiv2.Image and can be used wherever one is expected.
+    Changes are accumulated in memory and only written to the file, in a
+    single write, when flush() is called. The keys present are indexed as
+    sets, which are built on first use and invalidated whenever a tag is
+    set or deleted. The changes are also recorded, so that they can be
+    applied to a copy of the file instead; see replay().
+
+    """
+
+    def __init__(self, path):
+        """\
+        Reads the metadata from an image file.
+
+        Raises IOError if the file's metadata cannot be read.
+
+        Parameters:
+        path -- path to the image file
+
+        """
+        self.path = path
+        self.modified = False
+        self._changes = []
+        self._image = pyexiv2.Image(path)
+        self._image.readMetadata()
+        self._exif_key_set = None
+        self._iptc_key_set = None
+
+    def __getitem__(self, key):
+        return self._image[key]
+
+    def __setitem__(self, key, value):
+        self._invalidate_key_sets()
+        self._image[key] = value
+        self.modified = True
+        self._changes.append(('set', key, value))
+
+    def __delitem__(self, key):
+        self._invalidate_key_sets()
+        del self._image[key]
+        self.modified = True
+        self._changes.append(('delete', key, None))
+
+    def _invalidate_key_sets(self):
+        self._exif_key_set = None
+        self._iptc_key_set = None
+
+    def exifKeys(self):
+        return self._image.exifKeys()
+
+    def iptcKeys(self):
+        return self._image.iptcKeys()
+
+    def exif_key_set(self):
+        """\
+        Returns the Exif keys present as a set.
+
+        """
+        if self._exif_key_set is None:
+            self._exif_key_set = frozenset(self._image.exifKeys())
+        return self._exif_key_set
+
+    def iptc_key_set(self):
+        """\
+        Returns the IPTC keys present as a set.
+
+        """
+        if self._iptc_key_set is None:
+            self._iptc_key_set = frozenset(self._image.iptcKeys())
+        return self._iptc_key_set
+
+    def getThumbnailData(self):
+        return self._image.getThumbnailData()
+
+    def setThumbnailFromJpegFile(self, path):
+        self._image.setThumbnailFromJpegFile(path)
+        self.modified = True
+        f = open(path, 'rb')
+        try:
+            self._changes.append(('thumbnail', None, f.read()))
+        finally:
+            f.close()
+
+    def replay(self, path):
+        """\
+        Reads the metadata of a copy of the image file and applies the
+        changes made to this object to it.
+
+        Returns the ImageMetadata of the copy; the changes are written to
+        the copy when it is flushed, and this object is left unchanged.
+
+        Parameters:
+        path -- path to the copy of the image file
+
+        """
+        metadata = ImageMetadata(path)
+        for operation, key, value in self._changes:
+            if operation == 'set':
+                metadata[key] = value
+            elif operation == 'delete':
+                del metadata[key]
+            else:
+                thumb_fd, thumb_path = tempfile.mkstemp(suffix='.jpg')
+                os.write(thumb_fd, value)
+                os.close(thumb_fd)
+                try:
+                    metadata.setThumbnailFromJpegFile(thumb_path)
+                finally:
+                    os.remove(thumb_path)
+        return metadata
+
+    def flush(self):
+        """\
+        Writes any changes to the metadata back to the file.
+
+        Returns True if metadata needed to be written to the file;
+        False otherwise.
+
+        """
+        if not self.modified:
+            return False
+        self._image.writeMetadata()
+        self.modified = False
+        self._changes = []
+        return True
+
+
 def require_pyexiv2_obj(obj, obj_name):
     """\
     Ensures that a given object is a valid pyexiv2.Image.
@@ -38,6 +170,9 @@ def require_pyexiv2_obj(obj, obj_name):
     obj_name -- variable name of the object
 
     """
+    if isinstance(obj, ImageMetadata):
+        return
+
     is_pyexiv2_obj = True
     if (not (hasattr(obj, '__getitem__') and callable(obj.__getitem__) and
         hasattr(obj, '__setitem__') and callable(obj.__setitem__) and
@@ -118,6 +253,40 @@ def _del_img_key(image, metadata_key):
         pass
 
 
+def _exif_keys(image):
+    """\
+    Returns the Exif keys present in an image's metadata.
+
+    The indexed set of keys is used if the object provides one (see
+    ImageMetadata); otherwise the list of keys is fetched from pyexiv2.
+
+    Parameters:
+    image -- pyexiv2.Image object containing the metadata
+
+    """
+    exif_key_set = getattr(image, 'exif_key_set', None)
+    if exif_key_set is not None:
+        return exif_key_set()
+    return image.exifKeys()
+
+
+def _iptc_keys(image):
+    """\
+    Returns the IPTC keys present in an image's metadata.
+
+    The indexed set of keys is used if the object provides one (see
+    ImageMetadata); otherwise the list of keys is fetched from pyexiv2.
+
+    Parameters:
+    image -- pyexiv2.Image object containing the metadata
+
+    """
+    iptc_key_set = getattr(image, 'iptc_key_set', None)
+    if iptc_key_set is not None:
+        return iptc_key_set()
+    return image.iptcKeys()
+
+
 def _metadata_value_synced_with_file(value, image, metadata_key, keys_method):
     """\
     Determines whether a value is in sync with metadata in an image file.
@@ -166,7 +335,7 @@ def value_synced_with_exif(value, image, metadata_key):
 
     """
     return _metadata_value_synced_with_file(value, image, metadata_key,
-                                            pyexiv2.Image.exifKeys)
+                                            _exif_keys)
 
 
 def value_synced_with_iptc(value, image, metadata_key):
@@ -182,7 +351,7 @@ def value_synced_with_iptc(value, image, metadata_key):
 
     """
     return _metadata_value_synced_with_file(value, image, metadata_key,
-                                            pyexiv2.Image.iptcKeys)
+                                            _iptc_keys)
 
 
 def value_synced_with_exif_and_iptc(value, image, exif_key, iptc_key):
@@ -204,9 +373,9 @@ def value_synced_with_exif_and_iptc(value, image, exif_key, iptc_key):
     exif_value = None
     iptc_value = None
 
-    if exif_key in image.exifKeys():
+    if exif_key in _exif_keys(image):
         exif_value = image[exif_key]
-    if iptc_key in image.iptcKeys():
+    if iptc_key in _iptc_keys(image):
         iptc_value = image[iptc_key]
 
     # Empty set or string counts as in sync with None.
@@ -253,11 +422,11 @@ def datetime_synced_with_exif_and_iptc(datetime_value, image,
         # datetime_value was probably None
         pass
 
-    if exif_datetime_key in image.exifKeys():
+    if exif_datetime_key in _exif_keys(image):
         exif_datetime_value = image[exif_datetime_key]
-    if iptc_date_key in image.iptcKeys():
+    if iptc_date_key in _iptc_keys(image):
         iptc_date_value = image[iptc_date_key]
-    if iptc_time_key in image.iptcKeys():
+    if iptc_time_key in _iptc_keys(image):
         iptc_time_value = image[iptc_time_key]
         iptc_time_value = iptc_time_value.replace(tzinfo=None)
 
@@ -396,7 +565,7 @@ def sync_value_to_exif_and_iptc(value, image, exif_key, iptc_key):
             image[exif_key] = value
 
         # Delete IPTC key.
-        if iptc_key in image.iptcKeys():
+        if iptc_key in _iptc_keys(image):
             _del_img_key(image, iptc_key)
 
     return mod
@@ -436,9 +605,9 @@ def sync_datetime_to_exif_and_iptc(datetime_value, image, exif_datetime_key,
             _del_img_key(image, exif_datetime_key)
 
         # Delete IPTC keys.
-        if iptc_date_key in image.iptcKeys():
+        if iptc_date_key in _iptc_keys(image):
             _del_img_key(image, iptc_date_key)
-        if iptc_time_key in image.iptcKeys():
+        if iptc_time_key in _iptc_keys(image):
             _del_img_key(image, iptc_time_key)
 
     return mod
@@ -461,9 +630,9 @@ def read_value_from_exif_and_iptc(image, exif_key, iptc_key):
     exif_value = None
     iptc_value = None
 
-    if exif_key in image.exifKeys():
+    if exif_key in _exif_keys(image):
         exif_value = image[exif_key]
-    if iptc_key in image.iptcKeys():
+    if iptc_key in _iptc_keys(image):
         iptc_value = image[iptc_key]
 
     if exif_value is None:
@@ -495,11 +664,11 @@ def read_datetime_from_exif_and_iptc(image, exif_datetime_key,
     iptc_time_value = None
     iptc_datetime_value = None
 
-    if exif_datetime_key in image.exifKeys():
+    if exif_datetime_key in _exif_keys(image):
         exif_datetime_value = image[exif_datetime_key]
-    if iptc_date_key in image.iptcKeys():
+    if iptc_date_key in _iptc_keys(image):
         iptc_date_value = image[iptc_date_key]
-    if iptc_time_key in image.iptcKeys():
+    if iptc_time_key in _iptc_keys(image):
         iptc_time_value = image[iptc_time_key]
         iptc_time_value = iptc_time_value.replace(tzinfo=None)
 
@@ -509,3 +678,221 @@ def read_datetime_from_exif_and_iptc(image, exif_datetime_key,
                                                    iptc_time_value)
         return iptc_datetime_value
     return exif_datetime_value
+
+
+class MetadataMapping(object):
+    """\
+    Maps an attribute of a record to one or more image metadata tags.
+
+    Subclasses implement the comparison, reading and writing of the tags.
+    A list of mappings describes a whole record, which can then be
+    synchronized in a single pass by diff_record_with_file and
+    sync_record_to_file.
+
+    """
+
+    def __init__(self, attr, from_file=True, to_file=True):
+        """\
+        Parameters:
+        attr -- name of the record attribute holding the value
+        from_file -- whether the attribute is read from the file
+        to_file -- whether the attribute is written to the file
+
+        """
+        self.attr = attr
+        self.from_file = from_file
+        self.to_file = to_file
+
+    def synced(self, value, image, record):
+        """\
+        Returns True if the value is in sync with the image metadata.
+
+        """
+        raise NotImplementedError
+
+    def read(self, image, record):
+        """\
+        Returns the value of the attribute according to the image metadata.
+
+        Returns NOT_PRESENT if the attribute should be left alone because the
+        image does not contain the corresponding tags.
+
+        """
+        raise NotImplementedError
+
+    def write(self, value, image, record):
+        """\
+        Writes the value to the image metadata if it is out of sync.
+
+        Returns True if metadata needed to be written; False otherwise.
+
+        """
+        raise NotImplementedError
+
+
+NOT_PRESENT = object()
+"""\
+Sentinel returned by MetadataMapping.read when the tags are not present.
+
+"""
+
+
+class ExifAndIptcMapping(MetadataMapping):
+    """\
+    Maps an attribute to overlapping Exif and IPTC tags.
+
+    """
+
+    def __init__(self, attr, exif_key, iptc_key, empty=str(), **kwargs):
+        super(ExifAndIptcMapping, self).__init__(attr, **kwargs)
+        self.exif_key = exif_key
+        self.iptc_key = iptc_key
+        self.empty = empty
+
+    def synced(self, value, image, record):
+        return value_synced_with_exif_and_iptc(value, image, self.exif_key,
+                                               self.iptc_key)
+
+    def read(self, image, record):
+        value = read_value_from_exif_and_iptc(image, self.exif_key,
+                                              self.iptc_key)
+        if value is None:
+            value = self.empty
+        return value
+
+    def write(self, value, image, record):
+        return sync_value_to_exif_and_iptc(value, image, self.exif_key,
+                                           self.iptc_key)
+
+
+class IptcMapping(MetadataMapping):
+    """\
+    Maps an attribute to a single IPTC tag.
+
+    """
+
+    def __init__(self, attr, iptc_key, empty=str(), **kwargs):
+        super(IptcMapping, self).__init__(attr, **kwargs)
+        self.iptc_key = iptc_key
+        self.empty = empty
+
+    def synced(self, value, image, record):
+        return value_synced_with_iptc(value, image, self.iptc_key)
+
+    def read(self, image, record):
+        if self.iptc_key not in _iptc_keys(image):
+            return NOT_PRESENT
+        value = image[self.iptc_key]
+        if value is None:
+            value = self.empty
+        return value
+
+    def write(self, value, image, record):
+        return sync_value_to_iptc(value, image, self.iptc_key)
+
+
+class ExifMapping(MetadataMapping):
+    """\
+    Maps an attribute to a single Exif tag.
+
+    The key may be given as a function of the record, for tags whose key
+    depends on the record (see get_image_width_key).
+
+    """
+
+    def __init__(self, attr, exif_key, **kwargs):
+        super(ExifMapping, self).__init__(attr, **kwargs)
+        self.exif_key = exif_key
+
+    def get_key(self, record):
+        if callable(self.exif_key):
+            return self.exif_key(record)
+        return self.exif_key
+
+    def synced(self, value, image, record):
+        return value_synced_with_exif(value, image, self.get_key(record))
+
+    def read(self, image, record):
+        key = self.get_key(record)
+        if key not in _exif_keys(image):
+            return NOT_PRESENT
+        return image[key]
+
+    def write(self, value, image, record):
+        return sync_value_to_exif(value, image, self.get_key(record))
+
+
+class ExifAndIptcDatetimeMapping(MetadataMapping):
+    """\
+    Maps a date/time attribute to a combined Exif tag and split IPTC tags.
+
+    """
+
+    def __init__(self, attr, exif_datetime_key, iptc_date_key, iptc_time_key,
+                 **kwargs):
+        super(ExifAndIptcDatetimeMapping, self).__init__(attr, **kwargs)
+        self.keys = (exif_datetime_key, iptc_date_key, iptc_time_key)
+
+    def synced(self, value, image, record):
+        return datetime_synced_with_exif_and_iptc(value, image, *self.keys)
+
+    def read(self, image, record):
+        return read_datetime_from_exif_and_iptc(image, *self.keys)
+
+    def write(self, value, image, record):
+        return sync_datetime_to_exif_and_iptc(value, image, *self.keys)
+
+
+def diff_record_with_file(record, image, mappings):
+    """\
+    Compares a record with image metadata in a single pass.
+
+    Returns a dictionary mapping the name of each attribute that is out of
+    sync with the image metadata to the value read from the metadata. The
+    dictionary is empty if the record is in sync.
+
+    Parameters:
+    record -- object whose attributes are compared
+    image -- pyexiv2.Image object containing metadata to compare against
+    mappings -- list of MetadataMapping objects describing the record
+
+    """
+    require_pyexiv2_obj(image, 'image')
+    changes = {}
+    for mapping in mappings:
+        if not mapping.from_file:
+            continue
+        value = getattr(record, mapping.attr)
+        if mapping.synced(value, image, record):
+            continue
+        file_value = mapping.read(image, record)
+        if file_value is not NOT_PRESENT:
+            changes[mapping.attr] = file_value
+    return changes
+
+
+def sync_record_to_file(record, image, mappings):
+    """\
+    Writes the attributes of a record to image metadata in a single pass.
+
+    Metadata is only actually written for attributes that are out of sync.
+
+    Returns a dictionary mapping the name of each attribute that needed to
+    be written to the value written. The dictionary is empty if nothing
+    needed to be written.
+
+    Parameters:
+    record -- object whose attributes are written
+    image -- pyexiv2.Image object containing metadata to synchronize
+    mappings -- list of MetadataMapping objects describing the record
+
+    """
+    require_pyexiv2_obj(image, 'image')
+    changes = {}
+    for mapping in mappings:
+        if not mapping.to_file:
+            continue
+        value = getattr(record, mapping.attr)
+        if mapping.write(value, image, record):
+            changes[mapping.attr] = value
+    return changes
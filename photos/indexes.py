@@ -0,0 +1,115 @@
+from django.conf import settings
+from django.db import connection, transaction
+
+from photasm.photos.models import Album, Photo, Rendition
+
+
+INDEXES = (
+    (Photo, ('album', 'id')),
+    (Photo, ('album', 'album_sequence')),
+    (Album, ('owner', 'id')),
+    (Photo, ('image',)),
+    (Photo, ('thumbnail',)),
+    (Rendition, ('image',)),
+)
+"""\
+Indexes supporting the photograph browsing queries and the counting of the
+references to shared files.
+
+Each index is a (model, field names) tuple. Django only creates indexes on
+single columns declared with db_index, so these are created by
+create_indexes().
+
+"""
+
+SUPPORTED_ENGINES = ('sqlite3', 'postgresql', 'postgresql_psycopg2')
+
+
+def get_index_name(model, columns):
+    """\
+    Returns the name of the index on columns of the table of a model.
+
+    Parameters:
+    model -- model class of the table
+    columns -- list of column names
+
+    """
+    return '%s_%s' % (model._meta.db_table, '_'.join(columns))
+
+
+def get_existing_indexes(cursor, table):
+    """\
+    Returns the set of names of the indexes on a table.
+
+    Parameters:
+    cursor -- database cursor
+    table -- name of the table
+
+    """
+    if settings.DATABASE_ENGINE == 'sqlite3':
+        cursor.execute("SELECT name FROM sqlite_master "
+                       "WHERE type = 'index' AND tbl_name = %s", [table])
+    else:
+        cursor.execute("SELECT indexname FROM pg_indexes "
+                       "WHERE tablename = %s", [table])
+    return set([row[0] for row in cursor.fetchall()])
+
+
+def get_columns(cursor, table):
+    """\
+    Returns the set of names of the columns of a table.
+
+    Parameters:
+    cursor -- database cursor
+    table -- name of the table
+
+    """
+    description = connection.introspection.get_table_description(cursor,
+                                                                  table)
+    return set([row[0] for row in description])
+
+
+def create_index(cursor, model, columns, unique=False):
+    """\
+    Creates an index on columns of the table of a model if it is missing.
+
+    Returns True if the index was created; False if it already existed.
+
+    Parameters:
+    cursor -- database cursor
+    model -- model class of the table
+    columns -- list of column names
+    unique -- whether to create a unique index
+
+    """
+    table = model._meta.db_table
+    name = get_index_name(model, columns)
+    if name in get_existing_indexes(cursor, table):
+        return False
+    qn = connection.ops.quote_name
+    cursor.execute("CREATE %sINDEX %s ON %s (%s)" % (
+        unique and 'UNIQUE ' or '', qn(name), qn(table),
+        ', '.join([qn(column) for column in columns])))
+    return True
+
+
+def create_indexes():
+    """\
+    Creates any of the indexes in INDEXES that are missing.
+
+    This is safe to run repeatedly. Only SQLite and PostgreSQL are
+    supported; nothing is done for other databases.
+
+    Returns the names of the indexes created.
+
+    """
+    if settings.DATABASE_ENGINE not in SUPPORTED_ENGINES:
+        return []
+    cursor = connection.cursor()
+    created = []
+    for model, field_names in INDEXES:
+        columns = [model._meta.get_field(name).column for name in field_names]
+        if create_index(cursor, model, columns):
+            created.append(get_index_name(model, columns))
+    transaction.commit_unless_managed()
+    return created
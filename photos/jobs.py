@@ -0,0 +1,244 @@
+from datetime import datetime, timedelta
+import traceback
+
+from django.conf import settings
+from django.db.models import F
+
+from photasm.photos.cache import bump_version
+from photasm.photos.models import (
+    PROCESSING_FAILED,
+    PROCESSING_PENDING,
+    PROCESSING_READY,
+    PROCESSING_RUNNING,
+    Album,
+    Photo,
+    PhotoJob,
+)
+from photasm.photos.parallel import ProcessPool
+
+
+TASKS = {
+    'thumbnail': 'create_thumbnail',
+    'metadata_from_file': 'sync_metadata_from_file',
+    'metadata_to_file': 'sync_metadata_to_file',
+    'merge_metadata': 'merge_metadata_from_file',
+}
+"""\
+Names of the tasks a PhotoJob may run, mapped to the Photo methods run.
+
+"""
+
+DEFAULT_MAX_ATTEMPTS = 3
+
+DEFAULT_JOB_TIMEOUT = 60 * 60
+"""\
+Seconds after which a running job is assumed to belong to a dead worker.
+
+"""
+
+
+def _set_processing_status(photo_id, status):
+    """\
+    Updates the processing status of a Photo without calling Photo.save().
+
+    The updated times of the Photo and its Album are set and the cached
+    pages displaying the Photo are invalidated.
+
+    Parameters:
+    photo_id -- primary key of the Photo to update
+    status -- new processing status
+
+    """
+    now = datetime.now()
+    Photo.objects.filter(pk=photo_id).update(processing_status=status,
+                                             updated=now)
+    for album_id in Photo.objects.filter(pk=photo_id)\
+                                 .values_list('album', flat=True):
+        Album.objects.filter(pk=album_id).update(updated=now)
+        bump_version('photo', photo_id)
+        bump_version('album', album_id)
+
+
+def enqueue(photo, *tasks):
+    """\
+    Queues tasks to be run on a Photo by a background worker.
+
+    The tasks are run in the order given. If the PHOTO_JOBS_ALWAYS_EAGER
+    setting is True, the tasks are run immediately instead.
+
+    Returns the PhotoJob created.
+
+    Parameters:
+    photo -- Photo object to run the tasks on
+    tasks -- names of the tasks to run, as listed in TASKS
+
+    """
+    for task in tasks:
+        if task not in TASKS:
+            raise ValueError("Unknown photo processing task '%s'." % (task,))
+
+    job = PhotoJob.objects.create(photo=photo, tasks=','.join(tasks))
+    _set_processing_status(photo.pk, PROCESSING_PENDING)
+    photo.processing_status = PROCESSING_PENDING
+
+    if getattr(settings, 'PHOTO_JOBS_ALWAYS_EAGER', False):
+        run_job(job.pk)
+    return job
+
+
+def enqueue_processing(photo, metadata_task='metadata_from_file'):
+    """\
+    Queues the processing of a new image of a Photo.
+
+    The thumbnail, and the metadata if it is read from the file, are reused
+    from an identical image that was already processed if there is one (see
+    Photo.reuse_duplicate()), so only the remaining tasks are queued.
+
+    Returns the PhotoJob created, or None if nothing remained to be done.
+
+    Parameters:
+    photo -- Photo object whose image is new
+    metadata_task -- name of the task synchronizing the metadata
+
+    """
+    thumbnail, metadata = photo.reuse_duplicate(
+        metadata=(metadata_task == 'metadata_from_file'))
+    tasks = []
+    if not thumbnail:
+        tasks.append('thumbnail')
+    if not metadata:
+        tasks.append(metadata_task)
+    if not tasks:
+        return None
+    return enqueue(photo, *tasks)
+
+
+def run_job(job_id):
+    """\
+    Runs a pending PhotoJob.
+
+    The job is claimed atomically, so it is safe for several workers to
+    attempt to run the same job; only one of them will. If a task fails, the
+    job is returned to the queue to be retried unless it has reached the
+    maximum number of attempts, in which case it is marked as failed.
+
+    Returns True if the job ran successfully, False if it failed and None if
+    the job could not be claimed.
+
+    Parameters:
+    job_id -- primary key of the PhotoJob to run
+
+    """
+    claimed = PhotoJob.objects.filter(pk=job_id, status=PROCESSING_PENDING)\
+                              .update(status=PROCESSING_RUNNING,
+                                      attempts=F('attempts') + 1,
+                                      updated=datetime.now())
+    if not claimed:
+        return None
+
+    job = PhotoJob.objects.select_related('photo').get(pk=job_id)
+    _set_processing_status(job.photo_id, PROCESSING_RUNNING)
+
+    try:
+        photo = job.photo
+        # Share one read and one write of the image metadata between tasks.
+        try:
+            photo.open_metadata()
+        except IOError:
+            pass
+        for task in job.task_list:
+            getattr(photo, TASKS[task])()
+        photo.close_metadata()
+    except Exception:
+        max_attempts = getattr(settings, 'PHOTO_JOB_MAX_ATTEMPTS',
+                               DEFAULT_MAX_ATTEMPTS)
+        if job.attempts >= max_attempts:
+            job.status = PROCESSING_FAILED
+        else:
+            job.status = PROCESSING_PENDING
+        job.last_error = traceback.format_exc()
+        job.save()
+        _set_processing_status(job.photo_id, job.status)
+        return False
+
+    job.status = PROCESSING_READY
+    job.last_error = ''
+    job.save()
+
+    outstanding = PhotoJob.objects.filter(photo__id=job.photo_id).exclude(
+        status=PROCESSING_READY).count()
+    if not outstanding:
+        _set_processing_status(job.photo_id, PROCESSING_READY)
+    return True
+
+
+def requeue_stale_jobs(timeout=None):
+    """\
+    Returns jobs abandoned by dead workers to the queue.
+
+    Returns the number of jobs requeued.
+
+    Parameters:
+    timeout -- seconds a job may run before it is considered abandoned
+
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'PHOTO_JOB_TIMEOUT', DEFAULT_JOB_TIMEOUT)
+    cutoff = datetime.now() - timedelta(seconds=timeout)
+    return PhotoJob.objects.filter(status=PROCESSING_RUNNING,
+                                   updated__lt=cutoff)\
+                           .update(status=PROCESSING_PENDING)
+
+
+def requeue_failed_jobs(album_ids=None):
+    """\
+    Returns failed jobs to the queue, with their attempts reset.
+
+    Returns the number of jobs requeued.
+
+    Parameters:
+    album_ids -- if given, only jobs for photos in these albums are requeued
+
+    """
+    jobs = PhotoJob.objects.filter(status=PROCESSING_FAILED)
+    if album_ids is not None:
+        jobs = jobs.filter(photo__album__id__in=album_ids)
+    photo_ids = set(jobs.values_list('photo', flat=True))
+    requeued = jobs.update(status=PROCESSING_PENDING, attempts=0,
+                           updated=datetime.now())
+    for photo_id in photo_ids:
+        _set_processing_status(photo_id, PROCESSING_PENDING)
+    return requeued
+
+
+def process_jobs(processes=1, limit=None, album_ids=None):
+    """\
+    Runs the pending PhotoJobs.
+
+    Jobs are run in a pool of worker processes if more than one process is
+    requested.
+
+    Returns a (succeeded, failed) tuple with the number of jobs that ran
+    successfully and the number that failed.
+
+    Parameters:
+    processes -- number of worker processes to run the jobs in
+    limit -- maximum number of jobs to run
+    album_ids -- if given, only jobs for photos in these albums are run
+
+    """
+    job_ids = PhotoJob.objects.filter(status=PROCESSING_PENDING)\
+                              .order_by('id').values_list('id', flat=True)
+    if album_ids is not None:
+        job_ids = job_ids.filter(photo__album__id__in=album_ids)
+    if limit is not None:
+        job_ids = job_ids[:limit]
+    job_ids = list(job_ids)
+
+    pool = ProcessPool(min(processes, len(job_ids)))
+    try:
+        results = pool.map(run_job, job_ids)
+    finally:
+        pool.close()
+
+    return (results.count(True), results.count(False))
@@ -0,0 +1,14 @@
+from django.db.models.signals import post_syncdb
+
+from photasm.photos import models as photos_app
+from photasm.photos.indexes import create_indexes
+
+
+def _create_indexes(sender, created_models, verbosity, **kwargs):
+    if photos_app.Photo in created_models or \
+       photos_app.Album in created_models:
+        for name in create_indexes():
+            if verbosity >= 2:
+                print "Creating index %s" % (name,)
+
+post_syncdb.connect(_create_indexes, sender=photos_app)
@@ -0,0 +1,248 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from photasm.photos.image_files import hash_file
+from photasm.photos.indexes import (
+    SUPPORTED_ENGINES,
+    create_index,
+    create_indexes,
+    get_columns,
+)
+from photasm.photos.models import (
+    PROCESSING_READY,
+    Album,
+    Photo,
+    PhotoTag,
+    Rendition,
+    normalize_tag_name,
+)
+from photasm.photos.perceptual import BAND_COUNT, MAX_QUERY_VALUES
+
+
+ADDED_COLUMNS = (
+    (Album, 'is_public', "NOT NULL DEFAULT '1'"),
+    (Album, 'updated', "NOT NULL DEFAULT '1970-01-01 00:00:00'"),
+    (Album, 'photo_count', "NOT NULL DEFAULT 0"),
+    (Photo, 'processing_status', "NOT NULL DEFAULT '%s'" % (
+        PROCESSING_READY,)),
+    (Photo, 'updated', "NOT NULL DEFAULT '1970-01-01 00:00:00'"),
+    (Photo, 'album_sequence', "NULL"),
+    (Photo, 'thumbnail_hash', "NOT NULL DEFAULT ''"),
+    (Photo, 'perceptual_hash', "NOT NULL DEFAULT ''"),
+) + tuple([(Photo, 'phash_band%d' % (index,), "NULL")
+           for index in range(BAND_COUNT)]) + (
+    (Photo, 'file_size', "NULL"),
+    (Photo, 'file_mtime', "NULL"),
+    (Photo, 'file_hash', "NOT NULL DEFAULT ''"),
+    (Photo, 'content_hash', "NOT NULL DEFAULT ''"),
+    (Rendition, 'image_hash', "NOT NULL DEFAULT ''"),
+)
+"""\
+Columns added to the Album, Photo and Rendition tables after they were
+first created, as (model, field name, SQL constraints) tuples. The type of
+each column is that of its field.
+
+"""
+
+
+class Command(BaseCommand):
+    help = ("Upgrades an existing SQLite or PostgreSQL database: adds and "
+            "fills in the columns added to albums, photos and tags, and "
+            "creates the photo browsing indexes.")
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        if settings.DATABASE_ENGINE not in SUPPORTED_ENGINES:
+            raise CommandError("Unsupported database engine '%s'." % (
+                settings.DATABASE_ENGINE,))
+
+        added, created, merged = self.upgrade()
+        if verbosity > 0:
+            for name in added:
+                print "Added column %s." % (name,)
+            for name in created:
+                print "Created index %s." % (name,)
+            if merged:
+                print "Merged %d duplicate tag(s)." % (merged,)
+            if not (added or created or merged):
+                print "The database is up to date."
+
+    @transaction.commit_on_success
+    def upgrade(self):
+        """\
+        Adds the missing columns and indexes in a single transaction.
+
+        Databases created before PhotoTag.normalized_name existed have the
+        column added and filled in. Tags whose names differ only by case are
+        merged into the oldest of them before the column is made unique.
+
+        The columns in ADDED_COLUMNS are added likewise and filled in: the
+        update times are set to the current time, the photo counts and
+        positions are computed, and the content and thumbnail hashes are
+        computed from the files. The file fingerprints are left empty, so
+        the next resync_metadata run reads every file; see the
+        find_similar_photos command to fill in the perceptual hashes.
+
+        Returns an (added, created, merged) tuple with the names of the
+        columns added, the names of the indexes created and the number of
+        tags merged.
+
+        """
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        table = PhotoTag._meta.db_table
+
+        added = []
+        created = []
+        merged = 0
+        if 'normalized_name' not in get_columns(cursor, table):
+            cursor.execute("ALTER TABLE %s ADD COLUMN %s varchar(64) "
+                           "NOT NULL DEFAULT ''" % (qn(table),
+                                                    qn('normalized_name')))
+            merged = self.normalize_tags(cursor)
+            added.append('%s.normalized_name' % (table,))
+            create_index(cursor, PhotoTag, ['normalized_name'], unique=True)
+            created.append('%s_normalized_name' % (table,))
+
+        columns = {}
+        for model, field_name, constraints in ADDED_COLUMNS:
+            table = model._meta.db_table
+            if table not in columns:
+                columns[table] = get_columns(cursor, table)
+            field = model._meta.get_field(field_name)
+            if field.column in columns[table]:
+                continue
+            cursor.execute("ALTER TABLE %s ADD COLUMN %s %s %s" % (
+                qn(table), qn(field.column), field.db_type(), constraints))
+            added.append('%s.%s' % (table, field.column))
+            if field.db_index:
+                create_index(cursor, model, [field.column])
+                created.append('%s_%s' % (table, field.column))
+
+        created.extend(create_indexes())
+        if added:
+            self.fill_in_columns(cursor, added)
+        return (added, created, merged)
+
+    def fill_in_columns(self, cursor, added):
+        """\
+        Fills in the columns just added to the Album and Photo tables.
+
+        Parameters:
+        cursor -- database cursor
+        added -- names of the columns added, as 'table.column' strings
+
+        """
+        qn = connection.ops.quote_name
+        album_table = Album._meta.db_table
+        photo_table = Photo._meta.db_table
+
+        now = datetime.now()
+        for model in (Album, Photo):
+            table = model._meta.db_table
+            if '%s.updated' % (table,) in added:
+                cursor.execute("UPDATE %s SET %s = %%s" % (
+                    qn(table), qn('updated')), [now])
+
+        if '%s.photo_count' % (album_table,) in added:
+            cursor.execute(
+                "UPDATE %s SET %s = (SELECT COUNT(*) FROM %s "
+                "WHERE %s.%s = %s.%s)" % (
+                    qn(album_table), qn('photo_count'), qn(photo_table),
+                    qn(photo_table), qn('album_id'), qn(album_table),
+                    qn('id')))
+        if '%s.album_sequence' % (photo_table,) in added:
+            # Photos are numbered by primary key within their album.
+            cursor.execute(
+                "UPDATE %s SET %s = (SELECT COUNT(*) FROM %s other "
+                "WHERE other.%s = %s.%s AND other.%s <= %s.%s)" % (
+                    qn(photo_table), qn('album_sequence'), qn(photo_table),
+                    qn('album_id'), qn(photo_table), qn('album_id'),
+                    qn('id'), qn(photo_table), qn('id')))
+
+        for column, file_column in (('content_hash', 'image'),
+                                    ('thumbnail_hash', 'thumbnail')):
+            if '%s.%s' % (photo_table, column) in added:
+                self.hash_files(cursor, column, file_column)
+
+    def hash_files(self, cursor, column, file_column):
+        """\
+        Records the hashes of the image or thumbnail files of all photos.
+
+        Files that cannot be read are skipped.
+
+        Parameters:
+        cursor -- database cursor
+        column -- name of the column to record the hashes in
+        file_column -- name of the column holding the file names
+
+        """
+        qn = connection.ops.quote_name
+        hashes = []
+        for photo_id, name in Photo.objects.exclude(**{file_column: ''})\
+                                           .values_list('id', file_column):
+            if not name:
+                continue
+            try:
+                hashes.append((hash_file(default_storage.path(name)),
+                               photo_id))
+            except (IOError, OSError):
+                pass
+        cursor.executemany("UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+            qn(Photo._meta.db_table), qn(column), qn('id')), hashes)
+
+    def normalize_tags(self, cursor):
+        """\
+        Fills in the normalized names of all tags and merges duplicates.
+
+        Returns the number of tags merged.
+
+        Parameters:
+        cursor -- database cursor
+
+        """
+        qn = connection.ops.quote_name
+        field = Photo._meta.get_field('keywords')
+        m2m_table = qn(field.m2m_db_table())
+        photo_column = qn(field.m2m_column_name())
+        tag_column = qn(field.m2m_reverse_name())
+
+        tag_ids = {}
+        duplicates = []
+        for tag_id, name in PhotoTag.objects.order_by('id')\
+                                            .values_list('id', 'name'):
+            normalized_name = normalize_tag_name(name)
+            if normalized_name in tag_ids:
+                duplicates.append((tag_id, tag_ids[normalized_name]))
+            else:
+                tag_ids[normalized_name] = tag_id
+
+        for duplicate_id, tag_id in duplicates:
+            # Drop the links that the merged tag already has, then move the
+            # rest over to it.
+            cursor.execute(
+                "DELETE FROM %s WHERE %s = %%s AND %s IN "
+                "(SELECT %s FROM %s WHERE %s = %%s)" % (
+                    m2m_table, tag_column, photo_column, photo_column,
+                    m2m_table, tag_column),
+                [duplicate_id, tag_id])
+            cursor.execute("UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+                m2m_table, tag_column, tag_column), [tag_id, duplicate_id])
+        # SQLite allows at most 999 variables in a statement.
+        duplicate_ids = [duplicate_id for duplicate_id, tag_id in duplicates]
+        for start in range(0, len(duplicate_ids), MAX_QUERY_VALUES):
+            chunk = duplicate_ids[start:start + MAX_QUERY_VALUES]
+            cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                qn(PhotoTag._meta.db_table), qn('id'),
+                ', '.join(['%s'] * len(chunk))), chunk)
+
+        cursor.executemany("UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+            qn(PhotoTag._meta.db_table), qn('normalized_name'), qn('id')),
+            [(normalized_name, tag_id)
+             for normalized_name, tag_id in tag_ids.items()])
+        return len(duplicates)
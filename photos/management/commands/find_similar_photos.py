@@ -0,0 +1,131 @@
+from multiprocessing import cpu_count
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from PIL import Image
+
+from photasm.photos.models import Photo
+from photasm.photos.perceptual import (
+    DEFAULT_MAX_DISTANCE,
+    MAX_DISTANCE,
+    dhash,
+    get_hash_fields,
+)
+from photasm.photos.parallel import ProcessPool, describe_error
+
+
+def _hash_thumbnail(pk):
+    """\
+    Computes the perceptual hash of the thumbnail of a Photo.
+
+    Returns a (pk, value, error) tuple; value is None if the thumbnail could
+    not be read. Besides IOError, PIL may raise various exceptions while
+    decoding a truncated or corrupt file, so any exception is reported as
+    the error of the photo rather than stopping the run.
+
+    """
+    try:
+        photo = Photo.objects.only('thumbnail').get(pk=pk)
+        return (pk, dhash(Image.open(photo.thumbnail.path)), None)
+    except Photo.DoesNotExist:
+        return (pk, None, None)
+    except Exception as e:
+        return (pk, None, describe_error(e))
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--distance', type='int', dest='distance',
+                    default=DEFAULT_MAX_DISTANCE,
+                    help='Largest Hamming distance of the similar photos '
+                         '(at most %d).' % (MAX_DISTANCE,)),
+        make_option('--index', action='store_true', dest='index',
+                    default=False,
+                    help='Compute the missing perceptual hashes of photos '
+                         'that have thumbnails first.'),
+        make_option('--processes', type='int', dest='processes',
+                    default=cpu_count(),
+                    help='Number of worker processes to hash thumbnails in.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=500,
+                    help='Number of photos hashed per chunk and '
+                         'transaction.'),
+    )
+    args = '[photo_id ...]'
+    help = ("Lists the photos similar to the given photos, comparing the "
+            "perceptual hashes of their thumbnails.")
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        distance = options['distance']
+        if not 0 <= distance <= MAX_DISTANCE:
+            raise CommandError("The distance must be between 0 and %d." % (
+                MAX_DISTANCE,))
+        try:
+            photo_ids = [int(arg) for arg in args]
+        except ValueError:
+            raise CommandError("Photo IDs must be integers.")
+
+        if options['index']:
+            hashed, failed = self.index(options['processes'],
+                                        options['chunk_size'], verbosity)
+            if verbosity > 0:
+                print "%d photo(s) hashed, %d failed." % (hashed, failed)
+
+        for photo_id in photo_ids:
+            try:
+                photo = Photo.objects.get(pk=photo_id)
+            except Photo.DoesNotExist:
+                raise CommandError("Photo %d does not exist." % (photo_id,))
+            if not photo.perceptual_hash:
+                print "photo #%d has no perceptual hash yet." % (photo_id,)
+                continue
+            similar = Photo.objects.find_similar(
+                photo.perceptual_hash, distance,
+                Photo.objects.exclude(pk=photo_id))
+            print "photo #%d: %d similar photo(s)" % (photo_id, len(similar))
+            for photo_distance, similar_photo in similar:
+                print "  %s (distance %d, album %s)" % (
+                    similar_photo, photo_distance, similar_photo.album_id)
+
+    def index(self, processes, chunk_size, verbosity):
+        """\
+        Computes the perceptual hashes missing from photos with thumbnails.
+
+        The thumbnails are hashed in a pool of worker processes, and each
+        chunk of hashes is saved in a single transaction.
+
+        Returns a (hashed, failed) tuple with the numbers of photos.
+
+        """
+        queryset = Photo.objects.filter(perceptual_hash='')\
+                                .exclude(thumbnail=None).exclude(thumbnail='')
+        hashed = failed = 0
+        last_pk = 0
+        pool = ProcessPool(processes)
+        try:
+            while True:
+                pks = list(queryset.filter(pk__gt=last_pk).order_by('pk')
+                           .values_list('pk', flat=True)[:chunk_size])
+                if not pks:
+                    break
+                results = pool.map(_hash_thumbnail, pks)
+                self.save_hashes(results)
+                for pk, value, error in results:
+                    if error is not None:
+                        failed += 1
+                        if verbosity > 0:
+                            print "photo #%d failed: %s" % (pk, error)
+                    elif value is not None:
+                        hashed += 1
+                last_pk = pks[-1]
+        finally:
+            pool.close()
+        return (hashed, failed)
+
+    @transaction.commit_on_success
+    def save_hashes(self, results):
+        for pk, value, error in results:
+            if value is not None:
+                Photo.objects.filter(pk=pk).update(**get_hash_fields(value))
@@ -0,0 +1,176 @@
+from multiprocessing import cpu_count
+from optparse import make_option
+import os
+import time
+
+from django.core.files.base import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from photasm.photos.image_files import (
+    SIGNATURE_LENGTH,
+    hash_file,
+    sniff_image_format,
+)
+from photasm.photos.jobs import enqueue_processing, run_job
+from photasm.photos.models import Album, Photo
+from photasm.photos.parallel import ProcessPool
+
+
+def _walk_files(root):
+    """\
+    Yields the paths of the files in a directory tree, in sorted order.
+
+    Hidden files and directories are skipped.
+
+    """
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories[:] = sorted([name for name in subdirectories
+                                    if not name.startswith('.')])
+        for filename in sorted(filenames):
+            if not filename.startswith('.'):
+                yield os.path.join(directory, filename)
+
+
+def _scan_file(path):
+    """\
+    Determines whether a file is an image, and hashes it if it is.
+
+    The format is sniffed from the first bytes of the file, so images are
+    found regardless of their extension.
+
+    Returns a (path, image_format, content_hash, error) tuple; image_format
+    is None if the file is not a recognized image.
+
+    """
+    try:
+        f = open(path, 'rb')
+        try:
+            image_format = sniff_image_format(f.read(SIGNATURE_LENGTH))
+        finally:
+            f.close()
+        if image_format is None:
+            return (path, None, None, None)
+        return (path, image_format, hash_file(path), None)
+    except (IOError, OSError) as e:
+        return (path, None, None, e)
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes',
+                    default=cpu_count(),
+                    help='Number of worker processes to use.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=500,
+                    help='Number of files per chunk and transaction.'),
+        make_option('--defer', action='store_true', dest='defer',
+                    default=False,
+                    help='Leave the thumbnails and metadata to the '
+                         'process_photo_jobs workers.'),
+    )
+    args = '<album_id> <directory>'
+    help = ("Imports the images in a directory tree into an album. Files "
+            "already imported by the album's owner are skipped.")
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Usage: import_photos %s" % (self.args,))
+        try:
+            album = Album.objects.select_related('owner').get(pk=int(args[0]))
+        except (ValueError, Album.DoesNotExist):
+            raise CommandError("Album '%s' does not exist." % (args[0],))
+        root = args[1]
+        if not os.path.isdir(root):
+            raise CommandError("'%s' is not a directory." % (root,))
+
+        verbosity = int(options.get('verbosity', 1))
+        imported = skipped = failed = processed = 0
+        start_time = time.time()
+        pool = ProcessPool(options['processes'])
+        try:
+            for paths in _chunks(_walk_files(root), options['chunk_size']):
+                scanned = pool.map(_scan_file, paths)
+                for path, image_format, content_hash, error in scanned:
+                    if error is not None:
+                        failed += 1
+                        if verbosity > 0:
+                            print "%s failed: %s" % (path, error)
+
+                photos, duplicates = self.import_chunk(album, scanned)
+                imported += len(photos)
+                skipped += duplicates
+                if verbosity > 1:
+                    for photo in photos:
+                        print "Imported %s." % (photo.image.name,)
+
+                jobs = [enqueue_processing(photo) for photo in photos]
+                if not options['defer']:
+                    results = pool.map(run_job, [job.pk for job in jobs
+                                                 if job is not None])
+                    failed += results.count(False)
+
+                processed += len(paths)
+                if verbosity > 0:
+                    elapsed = time.time() - start_time
+                    print "%d files scanned, %d imported, %d skipped, " \
+                          "%d failed (%.1f files/s)" % (
+                              processed, imported, skipped, failed,
+                              processed / max(elapsed, 1e-6))
+        finally:
+            pool.close()
+
+    @transaction.commit_on_success
+    def import_chunk(self, album, scanned):
+        """\
+        Creates Photos for a chunk of scanned files in a single transaction.
+
+        Files that are not images are ignored. Images whose content hash
+        matches a photo the album's owner already has, or an earlier image
+        of the chunk, are skipped. If the import runs without --defer, the
+        thumbnails and metadata are processed after the chunk is committed.
+
+        Returns a (photos, duplicates) tuple with the Photos created and the
+        number of images skipped.
+
+        Parameters:
+        album -- Album to import the images into
+        scanned -- list of (path, image_format, content_hash, error) tuples
+                   returned by _scan_file()
+
+        """
+        images = [(path, image_format, content_hash)
+                  for path, image_format, content_hash, error in scanned
+                  if image_format is not None]
+        existing = set(Photo.objects.filter(
+            owner__id=album.owner_id,
+            content_hash__in=[content_hash for path, image_format,
+                              content_hash in images],
+        ).values_list('content_hash', flat=True))
+
+        photos = []
+        duplicates = 0
+        for path, image_format, content_hash in images:
+            if content_hash in existing:
+                duplicates += 1
+                continue
+            existing.add(content_hash)
+            image_file = File(open(path, 'rb'))
+            try:
+                photos.append(Photo.objects.create_from_file(
+                    album.owner, album, image_file, image_format,
+                    content_hash))
+            finally:
+                image_file.close()
+        return (photos, duplicates)
@@ -0,0 +1,39 @@
+from multiprocessing import cpu_count
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+
+from photasm.photos.jobs import process_jobs, requeue_stale_jobs
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes',
+                    default=cpu_count(),
+                    help='Number of worker processes to run jobs in.'),
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Exit once there are no pending jobs.'),
+        make_option('--poll-interval', type='float', dest='poll_interval',
+                    default=5.0,
+                    help='Seconds to wait when there are no pending jobs.'),
+    )
+    help = ("Runs queued thumbnail creation and metadata synchronization "
+            "jobs for uploaded photos.")
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        verbosity = int(options.get('verbosity', 1))
+
+        while True:
+            requeue_stale_jobs()
+            succeeded, failed = process_jobs(processes=processes,
+                                             limit=processes * 16)
+            if verbosity > 0 and (succeeded or failed):
+                print "%d job(s) succeeded, %d job(s) failed." % (succeeded,
+                                                                  failed)
+            if not (succeeded or failed):
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
@@ -0,0 +1,26 @@
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from photasm.photos.models import UploadSession
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--hours', type='float', dest='hours', default=24.0,
+                    help='Hours without a chunk after which an upload is '
+                         'abandoned.'),
+    )
+    help = ("Deletes abandoned resumable uploads and their partial files.")
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        cutoff = datetime.now() - timedelta(hours=options['hours'])
+
+        purged = 0
+        for session in UploadSession.objects.filter(updated__lt=cutoff):
+            session.delete()
+            purged += 1
+        if verbosity > 0:
+            print "%d upload(s) purged." % (purged,)
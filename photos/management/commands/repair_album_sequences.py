@@ -0,0 +1,65 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from photasm.photos.models import Album, Photo
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--album', type='int', dest='album', default=None,
+                    help='Only repair the album with this ID.'),
+    )
+    help = ("Recomputes the photo counts of albums and the positions of "
+            "photos within their albums.")
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        albums = Album.objects.order_by('id')
+        if options['album'] is not None:
+            albums = albums.filter(pk=options['album'])
+
+        repaired = 0
+        for album_id in albums.values_list('id', flat=True):
+            changed = self.repair_album(album_id)
+            if changed:
+                repaired += 1
+                if verbosity > 1:
+                    print "album #%d: %d row(s) repaired" % (album_id,
+                                                             changed)
+        if verbosity > 0:
+            print "%d album(s) repaired." % (repaired,)
+
+    @transaction.commit_on_success
+    def repair_album(self, album_id):
+        """\
+        Recomputes the photo count and photo positions of an album in a
+        single transaction.
+
+        Only the rows that are wrong are updated.
+
+        Returns the number of rows updated.
+
+        Parameters:
+        album_id -- primary key of the Album to repair
+
+        """
+        rows = list(Photo.objects.filter(album__id=album_id).order_by('id')
+                    .values_list('id', 'album_sequence'))
+        updates = []
+        for album_sequence, (photo_id, current) in enumerate(rows, 1):
+            if album_sequence != current:
+                updates.append((album_sequence, photo_id))
+        if updates:
+            qn = connection.ops.quote_name
+            cursor = connection.cursor()
+            cursor.executemany("UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+                qn(Photo._meta.db_table), qn('album_sequence'), qn('id')),
+                updates)
+
+        photo_count = len(rows)
+        changed = Album.objects.filter(pk=album_id).exclude(
+            photo_count=photo_count).update(photo_count=photo_count)
+        return len(updates) + changed
@@ -0,0 +1,250 @@
+from multiprocessing import cpu_count
+from optparse import make_option
+import os
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from photasm.photos.image_metadata import sync_record_to_file
+from photasm.photos.models import Photo
+from photasm.photos.parallel import ProcessPool, describe_error
+from photasm.photos.storage import is_content_name
+
+
+def _diff_from_file(pk, force=False):
+    """\
+    Reads the metadata changes for a Photo from its file.
+
+    The file is not read if its fingerprint shows that it is unchanged
+    since the last synchronization, unless force is True.
+
+    Returns a (pk, changes, fields, error, disable) tuple. fields holds the
+    fingerprint to record, or is None if it does not need to be recorded.
+    disable is True if the metadata could not be read from the file, in
+    which case metadata synchronization is disabled for the Photo.
+
+    """
+    try:
+        photo = Photo.objects.get(pk=pk)
+        if not force and photo.fingerprint_matches():
+            return (pk, {}, None, None, False)
+        fingerprint = photo.read_fingerprint()
+        try:
+            changes = photo.diff_metadata_with_file()
+        except IOError as e:
+            return (pk, None, None, describe_error(e), True)
+        return (pk, changes, fingerprint, None, False)
+    except Photo.DoesNotExist:
+        return (pk, {}, None, None, False)
+    except Exception as e:
+        return (pk, None, None, describe_error(e), False)
+
+
+def _force_diff_from_file(pk):
+    return _diff_from_file(pk, force=True)
+
+
+def _sync_to_file(pk, dry_run=False):
+    """\
+    Writes the metadata of a Photo to its file.
+
+    A content-addressed image shared with other Photos is copied first and
+    the changes are written to the copy. Nothing is saved to the database;
+    the fingerprint of the file, and the name of the copy, are returned to
+    be recorded by Command.apply_changes().
+
+    Returns a (pk, changes, fields, error, disable) tuple. fields holds the
+    values of the Photo fields to record. disable is True if the metadata
+    could not be read from or written to the file, in which case metadata
+    synchronization is disabled for the Photo.
+
+    """
+    try:
+        photo = Photo.objects.get(pk=pk)
+        try:
+            session = photo.open_metadata()
+        except IOError as e:
+            return (pk, None, None, describe_error(e), True)
+        changes = sync_record_to_file(photo, session,
+                                      photo.metadata_mappings)
+        if dry_run:
+            # The session is discarded without writing the changes.
+            return (pk, changes, None, None, False)
+
+        fields = {}
+        if session.modified and is_content_name(photo.image.name):
+            name, session = photo.copy_shared_image(session)
+            photo.image = fields['image'] = name
+        try:
+            session.flush()
+        except IOError as e:
+            if 'image' in fields:
+                default_storage.delete(fields['image'])
+            return (pk, None, None, describe_error(e), True)
+        fields.update(photo.read_fingerprint())
+        return (pk, changes, fields, None, False)
+    except Photo.DoesNotExist:
+        return (pk, {}, None, None, False)
+    except Exception as e:
+        return (pk, None, None, describe_error(e), False)
+
+
+def _diff_to_file(pk):
+    """\
+    Determines the metadata changes a Photo would write to its file.
+
+    Returns a (pk, changes, fields, error, disable) tuple.
+
+    """
+    return _sync_to_file(pk, dry_run=True)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--direction', dest='direction', default='from',
+                    choices=('from', 'to'),
+                    help="Synchronize 'from' the files to the database "
+                         "(default) or 'to' the files from the database."),
+        make_option('--processes', type='int', dest='processes',
+                    default=cpu_count(),
+                    help='Number of worker processes to use.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=500,
+                    help='Number of photos per chunk and transaction.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Report changes without saving them.'),
+        make_option('--force', action='store_true', dest='force',
+                    default=False,
+                    help='Read files even if their fingerprints show that '
+                         'they are unchanged.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File recording the last photo processed.'),
+        make_option('--resume', action='store_true', dest='resume',
+                    default=False,
+                    help='Resume after the photo recorded in the '
+                         'checkpoint file.'),
+        make_option('--album', type='int', dest='album', default=None,
+                    help='Only synchronize photos in the album with this ID.'),
+        make_option('--owner', dest='owner', default=None,
+                    help='Only synchronize photos owned by this user.'),
+    )
+    help = ("Synchronizes image metadata between the database and the image "
+            "files of many photos in parallel.")
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        chunk_size = options['chunk_size']
+        dry_run = options['dry_run']
+        checkpoint = options['checkpoint']
+
+        if options['resume'] and not checkpoint:
+            raise CommandError("--resume requires --checkpoint.")
+
+        queryset = Photo.objects.filter(metadata_sync_enabled=True)
+        if options['album'] is not None:
+            queryset = queryset.filter(album__id=options['album'])
+        if options['owner'] is not None:
+            queryset = queryset.filter(owner__username=options['owner'])
+
+        last_pk = 0
+        if options['resume'] and os.path.exists(checkpoint):
+            last_pk = int(open(checkpoint).read().strip() or 0)
+
+        if options['direction'] == 'from' and options['force']:
+            worker = _force_diff_from_file
+        elif options['direction'] == 'from':
+            worker = _diff_from_file
+        elif dry_run:
+            worker = _diff_to_file
+        else:
+            worker = _sync_to_file
+
+        processed = changed = failed = 0
+        start_time = time.time()
+        pool = ProcessPool(options['processes'])
+        try:
+            while True:
+                pks = list(queryset.filter(pk__gt=last_pk).order_by('pk')
+                           .values_list('pk', flat=True)[:chunk_size])
+                if not pks:
+                    break
+
+                results = pool.map(worker, pks)
+                if not dry_run:
+                    self.apply_changes(results,
+                                       options['direction'] == 'from')
+
+                for pk, changes, fields, error, disable in results:
+                    if error is not None:
+                        failed += 1
+                        if verbosity > 0:
+                            print "photo #%d failed: %s" % (pk, error)
+                    elif changes:
+                        changed += 1
+                        if verbosity > 1:
+                            print "photo #%d: %s" % (pk, ', '.join(
+                                sorted(changes.keys())))
+
+                processed += len(pks)
+                last_pk = pks[-1]
+                if checkpoint and not dry_run:
+                    checkpoint_file = open(checkpoint, 'w')
+                    checkpoint_file.write('%d\n' % (last_pk,))
+                    checkpoint_file.close()
+
+                if verbosity > 0:
+                    elapsed = time.time() - start_time
+                    print "%d processed, %d changed, %d failed " \
+                          "(%.1f photos/s)" % (processed, changed, failed,
+                                               processed / max(elapsed, 1e-6))
+        finally:
+            pool.close()
+
+    @transaction.commit_on_success
+    def apply_changes(self, results, save_changes):
+        """\
+        Saves the results of a chunk to the database in a single transaction.
+
+        The fingerprints of the files synchronized are recorded, and Photos
+        given a copy of a shared image of their own are updated to use it.
+        Photos whose metadata could not be read or written have metadata
+        synchronization disabled, as the Photo sync methods do; other
+        failures are left to be retried by a later run.
+
+        Parameters:
+        results -- list of (pk, changes, fields, error, disable) tuples
+                   returned by a worker
+        save_changes -- whether the changes were read from the files and
+                        should be saved to the database
+
+        """
+        disabled = [pk for pk, changes, fields, error, disable in results
+                    if disable]
+        updates = dict([(pk, fields)
+                        for pk, changes, fields, error, disable in results
+                        if fields is not None])
+
+        if save_changes:
+            changed = dict([(pk, changes)
+                            for pk, changes, fields, error, disable in results
+                            if changes])
+            for pk, photo in Photo.objects.in_bulk(changed.keys()).items():
+                for attr, value in changed[pk].items():
+                    setattr(photo, attr, value)
+                if pk in updates:
+                    for attr, value in updates.pop(pk).items():
+                        setattr(photo, attr, value)
+                photo.save()
+
+        copied = [pk for pk, fields in updates.items() if 'image' in fields]
+        for pk, photo in Photo.objects.in_bulk(copied).items():
+            photo.use_image_copy(updates[pk].pop('image'))
+        for pk, fields in updates.items():
+            Photo.objects.filter(pk=pk).update(**fields)
+
+        if disabled:
+            Photo.objects.filter(pk__in=disabled)\
+                         .update(metadata_sync_enabled=False)
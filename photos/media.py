@@ -0,0 +1,159 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import http_date
+
+from photasm.photos.image_files import CHUNK_SIZE
+
+
+CACHE_MAX_AGE = 60 * 60 * 24 * 365
+"""\
+Seconds that clients may cache media served at a versioned URL.
+
+The URL changes whenever the file does, so the response never goes stale.
+
+"""
+
+SENDFILE_HEADERS = {
+    'x-sendfile': 'X-Sendfile',
+    'x-accel-redirect': 'X-Accel-Redirect',
+}
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def make_version(*parts):
+    """\
+    Returns a short version string identifying some values.
+
+    Parameters:
+    parts -- values that change whenever the versioned file changes
+
+    """
+    value = ':'.join([unicode(part) for part in parts]).encode('utf-8')
+    return md5_constructor(value).hexdigest()[:16]
+
+
+def parse_range(header, size):
+    """\
+    Parses the value of an HTTP Range header for a single byte range.
+
+    Returns a (start, end) tuple of the first and last byte requested, or
+    None if the header should be ignored and the whole file served. Raises
+    ValueError if the range cannot be satisfied.
+
+    Parameters:
+    header -- value of the Range header
+    size -- size of the file in bytes
+
+    """
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        # Multiple or malformed ranges are answered with the whole file.
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # A suffix range requests the last bytes of the file.
+        length = int(end)
+        if not length:
+            raise ValueError("Empty suffix range.")
+        return (max(size - length, 0), size - 1)
+    start = int(start)
+    if end:
+        end = min(int(end), size - 1)
+    else:
+        end = size - 1
+    if start > end:
+        raise ValueError("Unsatisfiable range '%s'." % (header,))
+    return (start, end)
+
+
+def _read_file(path, start, length):
+    """\
+    Yields part of a file in chunks.
+
+    """
+    f = open(path, 'rb')
+    try:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def serve_file(request, path, name, public=True):
+    """\
+    Returns a response serving a media file.
+
+    If the PHOTO_MEDIA_SENDFILE setting is 'x-sendfile' or
+    'x-accel-redirect', the response only tells the front-end server which
+    file to send, so the file is not read by Django. For X-Accel-Redirect,
+    the file's storage name is appended to the PHOTO_MEDIA_ACCEL_PREFIX
+    setting, which should name an internal location mapped to MEDIA_ROOT.
+    Otherwise the file is streamed by Django, honoring single byte Range
+    requests.
+
+    The response may be cached for a year, as media is served at URLs that
+    change with the file.
+
+    Parameters:
+    request -- HttpRequest for the file
+    path -- absolute path of the file
+    name -- name of the file in the storage, relative to MEDIA_ROOT
+    public -- whether shared caches may store the file
+
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    sendfile = getattr(settings, 'PHOTO_MEDIA_SENDFILE', None)
+    if sendfile:
+        response = HttpResponse(mimetype=content_type)
+        if sendfile == 'x-accel-redirect':
+            prefix = getattr(settings, 'PHOTO_MEDIA_ACCEL_PREFIX',
+                             '/protected/')
+            value = prefix + name.replace(os.sep, '/')
+        else:
+            value = path
+        response[SENDFILE_HEADERS[sendfile]] = value.encode('utf-8')
+    else:
+        start, end = 0, size - 1
+        status = 200
+        if 'HTTP_RANGE' in request.META and size:
+            try:
+                byte_range = parse_range(request.META['HTTP_RANGE'], size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % (size,)
+                return response
+            if byte_range is not None:
+                start, end = byte_range
+                status = 206
+        length = end - start + 1
+        if request.method == 'HEAD':
+            content = ''
+        else:
+            content = _read_file(path, start, length)
+        response = HttpResponse(content, mimetype=content_type,
+                                status=status)
+        response['Content-Length'] = str(length)
+        if status == 206:
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Accept-Ranges'] = 'bytes'
+
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = '%s, max-age=%d' % (
+        public and 'public' or 'private', CACHE_MAX_AGE)
+    return response
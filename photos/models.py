@@ -1,30 +1,82 @@
+from datetime import datetime
 import math
 import os
 from StringIO import StringIO
 import tempfile
+import uuid
 
 from django import forms
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.files.base import ContentFile
 from django.core.files.images import ImageFile
 from django.core.files.storage import default_storage
-from django.db import models
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
 from PIL import Image
-import pyexiv2
 
+from photasm.photos.cache import bump_version
 from photasm.photos.image_metadata import (
-    datetime_synced_with_exif_and_iptc,
+    ExifAndIptcDatetimeMapping,
+    ExifAndIptcMapping,
+    ExifMapping,
+    ImageMetadata,
+    IptcMapping,
+    diff_record_with_file,
     get_image_height_key,
     get_image_width_key,
-    read_datetime_from_exif_and_iptc,
-    read_value_from_exif_and_iptc,
-    sync_datetime_to_exif_and_iptc,
-    sync_value_to_exif,
-    sync_value_to_exif_and_iptc,
-    sync_value_to_iptc,
-    value_synced_with_exif_and_iptc,
-    value_synced_with_iptc,
+    sync_record_to_file,
 )
+from photasm.photos.image_files import hash_file, is_mtime_ambiguous, sha1
+from photasm.photos.media import make_version
+from photasm.photos.perceptual import (
+    BAND_COUNT,
+    DEFAULT_MAX_DISTANCE,
+    MAX_QUERY_VALUES,
+    dhash,
+    get_band_neighbors,
+    get_hash_fields,
+    hamming_distance,
+    split_bands,
+)
+from photasm.photos.renditions import (
+    draft_for_downscale,
+    encode_image,
+    fits_within,
+    get_bounding_box,
+    get_rendition_format,
+    get_rendition_names,
+    get_rendition_sizes,
+    resize_image,
+)
+from photasm.photos.storage import (
+    get_content_name,
+    get_image_name,
+    hash_uploaded_file,
+    is_content_addressed,
+    is_content_name,
+)
+from photasm.photos.uploadhandler import get_upload_dir
+
+
+class DenormalizedIntegerField(models.IntegerField):
+    """\
+    Integer field holding a value maintained with UPDATE statements, such as
+    a count or a position.
+
+    The value is only written when the row is inserted. Saving an existing
+    object leaves the column as it is in the database, so that a value
+    loaded before a concurrent change is not written back over it.
+
+    """
+
+    def pre_save(self, model_instance, add):
+        if add:
+            return super(DenormalizedIntegerField, self).pre_save(
+                model_instance, add)
+        return F(self.name)
 
 
 class Album(models.Model):
@@ -38,6 +90,29 @@ class Album(models.Model):
     owner = models.ForeignKey(User)
     name = models.CharField(max_length=64)
 
+    is_public = models.BooleanField(default=True)
+    """\
+    Whether anyone may view the album. Otherwise, only the owner may view
+    its photographs.
+
+    """
+
+    updated = models.DateTimeField(auto_now=True)
+    """\
+    Time the album or any of its photographs was last changed.
+
+    """
+
+    photo_count = DenormalizedIntegerField(default=0, editable=False)
+    """\
+    Number of photographs in the album.
+
+    This is maintained when photographs are added, moved and deleted; the
+    repair_album_sequences command recomputes it. It is not written when
+    the album is saved.
+
+    """
+
     def __unicode__(self):
         return self.name
 
@@ -58,6 +133,85 @@ class Album(models.Model):
         return name_with_owner
 
 
+def normalize_tag_name(name):
+    """\
+    Returns the form of a tag name used to match tags case-insensitively.
+
+    Parameters:
+    name -- tag name to normalize
+
+    """
+    return name.lower()
+
+
+class PhotoTagManager(models.Manager):
+    """\
+    Manager for PhotoTags, with methods for resolving many tags at once.
+
+    """
+
+    def filter_names(self, names):
+        """\
+        Finds the PhotoTags matching names case-insensitively in one query.
+
+        The tags are looked up by their normalized names, which are unique
+        and indexed.
+
+        Returns a dictionary mapping each normalized name found to the
+        PhotoTag with that name.
+
+        Parameters:
+        names -- list of tag names to find
+
+        """
+        if not names:
+            return {}
+        normalized_names = set([normalize_tag_name(name) for name in names])
+        tags = self.filter(normalized_name__in=list(normalized_names))
+        return dict([(tag.normalized_name, tag) for tag in tags])
+
+    def create_many(self, names):
+        """\
+        Creates PhotoTags for a list of names in a single statement.
+
+        Only the first of several names with the same normalized name is
+        created. Names for which a tag already exists, such as a tag
+        created concurrently by another request, are skipped.
+
+        Parameters:
+        names -- list of tag names to create
+
+        """
+        rows = []
+        seen = set()
+        for name in names:
+            normalized_name = normalize_tag_name(name)
+            if normalized_name not in seen:
+                seen.add(normalized_name)
+                rows.append((name, normalized_name))
+
+        qn = connection.ops.quote_name
+        sql = "INSERT INTO %s (%s, %s) VALUES (%%s, %%s)" % (
+            qn(self.model._meta.db_table), qn('name'), qn('normalized_name'))
+        while rows:
+            sid = transaction.savepoint()
+            try:
+                connection.cursor().executemany(sql, rows)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                existing = self.filter_names([name for name, normalized_name
+                                              in rows])
+                if not existing:
+                    raise
+                rows = [(name, normalized_name)
+                        for name, normalized_name in rows
+                        if normalized_name not in existing]
+            else:
+                transaction.savepoint_commit(sid)
+                break
+        transaction.commit_unless_managed()
+
+
 class PhotoTag(models.Model):
     """\
     A keyword or tag related to a photograph, provided by the user.
@@ -68,9 +222,227 @@ class PhotoTag(models.Model):
     """
     name = models.CharField(max_length=64)
 
+    normalized_name = models.CharField(max_length=64, unique=True,
+                                       editable=False)
+    """\
+    Name used to match tags case-insensitively; see normalize_tag_name().
+
+    This is set when the tag is saved. Being unique, it prevents tags whose
+    names differ only by case.
+
+    """
+
+    objects = PhotoTagManager()
+
     def __unicode__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.normalized_name = normalize_tag_name(self.name)
+        super(PhotoTag, self).save(*args, **kwargs)
+
+
+class PhotoManager(models.Manager):
+    """\
+    Manager for Photos.
+
+    """
+
+    def find_similar(self, perceptual_hash, max_distance=DEFAULT_MAX_DISTANCE,
+                     queryset=None):
+        """\
+        Finds the photos whose perceptual hash is near a given hash.
+
+        The photos are found by multi-index hashing: candidates are looked
+        up through the indexed bands of their hashes, taking every band
+        value within max_distance // BAND_COUNT of the bands of the hash,
+        and only the candidates are compared bit by bit. No table scan is
+        needed for small distances.
+
+        Returns a list of (distance, photo) tuples, nearest first.
+
+        Parameters:
+        perceptual_hash -- perceptual hash as 16 hexadecimal digits
+        max_distance -- largest Hamming distance of the photos to return
+        queryset -- Photos to search; all of them if None
+
+        """
+        if queryset is None:
+            queryset = self.get_query_set()
+        value = int(perceptual_hash, 16)
+        radius = max_distance // BAND_COUNT
+        # Each band is looked up separately, with at most MAX_QUERY_VALUES
+        # values per query, as a single query for all of the neighbors would
+        # exceed the number of variables SQLite allows.
+        candidates = {}
+        for index, band in enumerate(split_bands(value)):
+            field_name = 'phash_band%d__in' % (index,)
+            neighbors = get_band_neighbors(band, radius)
+            for start in range(0, len(neighbors), MAX_QUERY_VALUES):
+                candidates.update(queryset.filter(**{
+                    field_name: neighbors[start:start + MAX_QUERY_VALUES],
+                }).values_list('id', 'perceptual_hash'))
+
+        matches = []
+        for pk, candidate_hash in candidates.items():
+            distance = hamming_distance(value, int(candidate_hash, 16))
+            if distance <= max_distance:
+                matches.append((distance, pk))
+        matches.sort()
+        pks = [pk for distance, pk in matches]
+        photos = {}
+        for start in range(0, len(pks), MAX_QUERY_VALUES):
+            photos.update(queryset.in_bulk(
+                pks[start:start + MAX_QUERY_VALUES]))
+        return [(distance, photos[pk]) for distance, pk in matches
+                if pk in photos]
+
+    def attach_keyword_lists(self, photos):
+        """\
+        Loads the keywords of many Photos with a single query.
+
+        The keywords are stored in the keyword_list cache of each Photo, so
+        accessing Photo.keyword_list afterwards does not query the database.
+
+        Returns the list of Photos.
+
+        Parameters:
+        photos -- iterable of Photo objects
+
+        """
+        photos = list(photos)
+        photos_by_id = {}
+        for photo in photos:
+            photo._keyword_list_cache = []
+            photos_by_id[photo.pk] = photo
+        if not photos_by_id:
+            return photos
+
+        qn = connection.ops.quote_name
+        field = self.model._meta.get_field('keywords')
+        photo_id_column = "%s.%s" % (qn(field.m2m_db_table()),
+                                     qn(field.m2m_column_name()))
+        tags = PhotoTag.objects.filter(photo__id__in=photos_by_id.keys())\
+                               .extra(select={'keyword_photo_id':
+                                              photo_id_column})
+        for tag in tags:
+            photos_by_id[tag.keyword_photo_id]._keyword_list_cache.append(
+                tag.name)
+        return photos
+
+    def create_from_file(self, owner, album, image_file, image_format,
+                         content_hash=''):
+        """\
+        Creates a Photo for an image file that is already on disk.
+
+        If the file has a temporary_file_path() method, it is moved into
+        the storage rather than copied. With content-addressed storage, an
+        identical image that is already stored is used instead. The
+        thumbnail and metadata are not processed; queue the jobs for them
+        with jobs.enqueue_processing().
+
+        Returns the new Photo.
+
+        Parameters:
+        owner -- User owning the photograph
+        album -- Album to add the photograph to
+        image_file -- django.core.files.File of the image; its name is used
+                      as the name of the stored file
+        image_format -- PIL name of the format of the image
+        content_hash -- SHA-1 hash of the image file, if known
+
+        """
+        photo = self.model(owner=owner, album=album,
+                           is_jpeg=(image_format == 'JPEG'),
+                           content_hash=content_hash)
+        photo.image = image_file
+        photo.save()
+        return photo
+
+    def attach_rendition_urls(self, photos, names=None):
+        """\
+        Loads the rendition URLs of many Photos with a single query.
+
+        The URLs are stored in the rendition_urls cache of each Photo, so
+        accessing Photo.rendition_urls afterwards does not query the
+        database.
+
+        Returns the list of Photos.
+
+        Parameters:
+        photos -- iterable of Photo objects
+        names -- names of the renditions to load; all of them if None
+
+        """
+        photos = list(photos)
+        if names is None:
+            names = get_rendition_names()
+        photos_by_id = {}
+        for photo in photos:
+            photo._rendition_urls = dict([(name, photo.image_url)
+                                          for name in names])
+            photos_by_id[photo.pk] = photo
+        if not photos_by_id:
+            return photos
+
+        renditions = Rendition.objects.filter(photo__in=photos_by_id.keys(),
+                                              name__in=names)\
+                                      .only('photo', 'name', 'image',
+                                            'image_hash', 'width', 'height')
+        for rendition in renditions:
+            photo = photos_by_id[rendition.photo_id]
+            photo._rendition_urls[rendition.name] = rendition.url
+        return photos
+
+
+PROCESSING_PENDING = 'pending'
+PROCESSING_RUNNING = 'running'
+PROCESSING_READY = 'ready'
+PROCESSING_FAILED = 'failed'
+
+PROCESSING_STATUS_CHOICES = (
+    (PROCESSING_PENDING, 'pending'),
+    (PROCESSING_RUNNING, 'processing'),
+    (PROCESSING_READY, 'ready'),
+    (PROCESSING_FAILED, 'failed'),
+)
+
+
+def _get_image_upload_to(instance, filename):
+    """\
+    Returns the storage name for a new image file of a Photo.
+
+    With content-addressed storage enabled, the name is derived from the
+    content hash of the image; otherwise the file is stored under the date
+    of the upload.
+
+    """
+    if is_content_addressed() and instance.content_hash:
+        return get_content_name(instance.content_hash, filename)
+    return get_image_name(filename)
+
+
+def _release_file(model, field_name, name, pk):
+    """\
+    Deletes a stored file unless other objects still reference it.
+
+    Files may be shared between objects by content-addressed storage and
+    by the reuse of the thumbnails of duplicate images, so the references
+    to a file are counted before it is deleted.
+
+    Parameters:
+    model -- model class whose objects reference the file
+    field_name -- name of the file field referencing the file
+    name -- storage name of the file
+    pk -- primary key of the object releasing the file
+
+    """
+    if not name:
+        return
+    references = model._default_manager.filter(**{field_name: name})
+    if not references.exclude(pk=pk).count():
+        default_storage.delete(name)
+
 
 class Photo(models.Model):
     """\
@@ -82,7 +454,7 @@ class Photo(models.Model):
     """
     owner = models.ForeignKey(User)
 
-    image = models.ImageField(upload_to="photos/%Y/%m/%d",
+    image = models.ImageField(upload_to=_get_image_upload_to,
                               height_field="image_height",
                               width_field="image_width")
 
@@ -212,82 +584,767 @@ class Photo(models.Model):
 
     metadata_sync_enabled = models.BooleanField(default=True)
 
+    processing_status = models.CharField(max_length=16, editable=False,
+                                         choices=PROCESSING_STATUS_CHOICES,
+                                         default=PROCESSING_READY)
+    """\
+    State of the background jobs creating thumbnails and syncing metadata.
+
+    """
+
+    updated = models.DateTimeField(auto_now=True)
+    """\
+    Time the photograph, its keywords or its processing status was last
+    changed.
+
+    """
+
+    album_sequence = DenormalizedIntegerField(null=True, editable=False)
+    """\
+    Position of the photograph within its album, starting at 1.
+
+    Photos are ordered by primary key within an album. This is maintained
+    when photographs are added, moved and deleted; the
+    repair_album_sequences command recomputes it. It is not written when
+    the photograph is saved.
+
+    """
+
+    thumbnail_hash = models.CharField(max_length=40, blank=True,
+                                      editable=False)
+    """\
+    SHA-1 hash of the thumbnail file, used to version its URL.
+
+    """
+
+    perceptual_hash = models.CharField(max_length=16, blank=True,
+                                       editable=False)
+    phash_band0 = models.IntegerField(null=True, editable=False,
+                                      db_index=True)
+    phash_band1 = models.IntegerField(null=True, editable=False,
+                                      db_index=True)
+    phash_band2 = models.IntegerField(null=True, editable=False,
+                                      db_index=True)
+    phash_band3 = models.IntegerField(null=True, editable=False,
+                                      db_index=True)
+    """\
+    Difference hash of the thumbnail, used to find near-duplicate photos,
+    and the bands it is split into for searching.
+
+    See perceptual.dhash() and PhotoManager.find_similar().
+
+    """
+
+    file_size = models.IntegerField(null=True, editable=False)
+    file_mtime = models.FloatField(null=True, editable=False)
+    file_hash = models.CharField(max_length=40, blank=True, editable=False,
+                                 db_index=True)
+    """\
+    Fingerprint of the image file when its metadata was last synchronized.
+
+    The file hash is only recorded if the PHOTO_FINGERPRINT_HASH setting is
+    True, or if the file had just been modified. See
+    Photo.fingerprint_matches().
+
+    """
+
+    content_hash = models.CharField(max_length=40, blank=True,
+                                    editable=False, db_index=True)
+    """\
+    SHA-1 hash of the image file as it was imported, used to skip files that
+    were already imported.
+
+    Unlike file_hash, this is not changed when metadata is written to the
+    file.
+
+    """
+
     album = models.ForeignKey(Album)
 
+    objects = PhotoManager()
+
+    metadata_mappings = (
+        ExifAndIptcMapping('description', 'Exif.Image.ImageDescription',
+                           'Iptc.Application2.Caption'),
+        ExifAndIptcMapping('artist', 'Exif.Image.Artist',
+                           'Iptc.Application2.Byline'),
+        IptcMapping('country', 'Iptc.Application2.CountryName'),
+        IptcMapping('province_state', 'Iptc.Application2.ProvinceState'),
+        IptcMapping('city', 'Iptc.Application2.City'),
+        IptcMapping('location', 'Iptc.Application2.SubLocation'),
+        ExifAndIptcDatetimeMapping('time_created',
+                                   'Exif.Photo.DateTimeOriginal',
+                                   'Iptc.Application2.DateCreated',
+                                   'Iptc.Application2.TimeCreated'),
+        IptcMapping('keyword_list', 'Iptc.Application2.Keywords', empty=None),
+        ExifMapping('image_width',
+                    lambda photo: get_image_width_key(photo.is_jpeg),
+                    from_file=False),
+        ExifMapping('image_height',
+                    lambda photo: get_image_height_key(photo.is_jpeg),
+                    from_file=False),
+    )
+    """\
+    Mapping of attributes to the image metadata tags they are synchronized
+    with, in both directions.
+
+    """
+
     def __unicode__(self):
         repr = "photo #%d" % (self.id,)
         return repr
 
+    def __init__(self, *args, **kwargs):
+        super(Photo, self).__init__(*args, **kwargs)
+        self._remember_original_files()
+
+    def _remember_original_files(self):
+        """\
+        Remembers the names of the files and the album the object was loaded
+        or saved with.
+
+        The raw field values are read from the instance dictionary so that
+        deferred fields are not loaded.
+
+        """
+        image = self.__dict__.get('image')
+        thumbnail = self.__dict__.get('thumbnail')
+        self._original_image = getattr(image, 'name', image)
+        self._original_thumbnail = getattr(thumbnail, 'name', thumbnail)
+        self._original_album_id = self.__dict__.get('album_id')
+
+    def image_changed(self):
+        """\
+        Determines whether the image file was changed since the object was
+        loaded or last saved.
+
+        Returns True if the image changed; False otherwise.
+
+        """
+        if self.pk is None or 'image' not in self.__dict__:
+            return False
+        return self.image.name != self._original_image
+
+    def thumbnail_changed(self):
+        """\
+        Determines whether the thumbnail file was changed since the object
+        was loaded or last saved.
+
+        Returns True if the thumbnail changed; False otherwise.
+
+        """
+        if self.pk is None or 'thumbnail' not in self.__dict__:
+            return False
+        return self.thumbnail.name != self._original_thumbnail
+
     def save(self, *args, **kwargs):
-        try:
-            # Check if the image property has changed.
-            # If so, delete the old image on the filesystem.
-            old_obj = Photo.objects.get(pk=self.pk)
-            if old_obj.image.path != self.image.path:
-                path = old_obj.image.path
-                default_storage.delete(path)
-                if old_obj.thumbnail:
-                    path = old_obj.thumbnail.path
-                    default_storage.delete(path)
-        except:
-            pass
+        new_image = self.pk is None or self.image_changed()
+        # Check if the image property has changed.
+        # If so, release the old image on the filesystem.
+        if self.image_changed():
+            _release_file(Photo, 'image', self._original_image, self.pk)
+            self.delete_renditions()
+            self.file_size = self.file_mtime = None
+            self.file_hash = self.content_hash = ''
+            if not self.thumbnail_changed():
+                self.thumbnail = None
+                self.thumbnail_hash = ''
+                self.set_perceptual_hash(None)
+        if self.thumbnail_changed():
+            _release_file(Photo, 'thumbnail', self._original_thumbnail,
+                          self.pk)
+        if new_image and self.image:
+            if not self.content_hash:
+                self.content_hash = self._hash_image()
+            if is_content_addressed() and self.content_hash:
+                self._share_stored_image()
+        self._keyword_list_cache = None
+
+        # Check if the photo is added to an album or moved between albums.
+        album_changed = self.pk is None or (
+            self._original_album_id is not None and
+            self.album_id != self._original_album_id)
+        if album_changed and self.pk is not None:
+            _remove_from_album(self._original_album_id, self.id)
+
         super(Photo, self).save(*args, **kwargs)
+        if album_changed:
+            self.album_sequence = _add_to_album(self.album_id, self.id)
+        self._remember_original_files()
 
     @models.permalink
     def get_absolute_url(self):
         return ('photo_detail', (), {'object_id': self.id})
 
+    def _hash_image(self):
+        """\
+        Returns the content hash of the image, or '' if it cannot be read.
+
+        """
+        if not self.image._committed:
+            return hash_uploaded_file(self.image.file)
+        try:
+            return hash_file(self.image.path)
+        except (IOError, OSError):
+            return ''
+
+    def _share_stored_image(self):
+        """\
+        Uses the stored copy of a new image, if there is one, instead of
+        storing the image again.
+
+        """
+        if self.image._committed:
+            return
+        name = get_content_name(self.content_hash, self.image.name)
+        if not default_storage.exists(name):
+            return
+        # The dimensions are otherwise read when the file is stored. Those
+        # found while the upload was streamed are used if available.
+        size = getattr(self.image.file, 'image_size', None)
+        if size is None:
+            f = default_storage.open(name)
+            try:
+                size = Image.open(f).size
+            finally:
+                f.close()
+        self.image_width, self.image_height = size
+        self.image = name
+
+    def copy_shared_image(self, session):
+        """\
+        Copies the content-addressed image of the Photo, before the changes
+        of a metadata session are written to it.
+
+        The shared file must keep the content it is named after, so the
+        changes are applied to the copy instead. Nothing is recorded in the
+        database; see use_image_copy().
+
+        Returns a (name, session) tuple with the storage name of the copy
+        and its metadata session.
+
+        Parameters:
+        session -- ImageMetadata of the shared file
+
+        """
+        shared_name = self.image.name
+        f = default_storage.open(shared_name)
+        try:
+            name = default_storage.save(get_image_name(shared_name), f)
+        finally:
+            f.close()
+        return (name, session.replay(default_storage.path(name)))
+
+    def use_image_copy(self, name):
+        """\
+        Records that the Photo uses a copy of its image of its own, made by
+        copy_shared_image().
+
+        The shared file is deleted if no other Photo uses it.
+
+        Parameters:
+        name -- storage name of the copy
+
+        """
+        shared_name = self.image.name
+        Photo.objects.filter(pk=self.pk).update(image=name)
+        self.image = name
+        self._original_image = name
+        _release_file(Photo, 'image', shared_name, self.pk)
+        self.touch()
+
+    def _detach_image(self, session):
+        """\
+        Gives the Photo a copy of its content-addressed image of its own,
+        before the changes of a metadata session are written to it.
+
+        Returns the metadata session of the copy.
+
+        Parameters:
+        session -- ImageMetadata of the shared file
+
+        """
+        name, session = self.copy_shared_image(session)
+        self.use_image_copy(name)
+        return session
+
+    def reuse_duplicate(self, metadata=True):
+        """\
+        Reuses the processing of an identical image instead of repeating it.
+
+        A processed Photo whose image has the same content hash supplies the
+        thumbnail and renditions, which are shared rather than created
+        again. Its metadata is copied too if it belongs to the same owner
+        and shares this Photo's content-addressed image file, so that the
+        metadata is known to have been read from an identical file.
+
+        Returns a (thumbnail, metadata) tuple telling whether the thumbnail
+        and the metadata were reused.
+
+        Parameters:
+        metadata -- whether the metadata may be reused
+
+        """
+        if not self.content_hash:
+            return (False, False)
+        duplicates = Photo.objects.filter(
+            content_hash=self.content_hash,
+            processing_status=PROCESSING_READY,
+        ).exclude(pk=self.pk).exclude(thumbnail=None).exclude(thumbnail='')
+
+        source = None
+        if metadata and is_content_name(self.image.name):
+            same_file = duplicates.filter(owner__id=self.owner_id,
+                                          image=self.image.name)
+            source = (list(same_file.order_by('id')[:1]) or [None])[0]
+        reuse_metadata = source is not None
+        if source is None:
+            source = (list(duplicates.order_by('id')[:1]) or [None])[0]
+        if source is None:
+            return (False, False)
+
+        self.thumbnail = source.thumbnail.name
+        self.thumbnail_hash = source.thumbnail_hash
+        self.perceptual_hash = source.perceptual_hash
+        for index in range(BAND_COUNT):
+            attr = 'phash_band%d' % (index,)
+            setattr(self, attr, getattr(source, attr))
+        if reuse_metadata:
+            for mapping in self.metadata_mappings:
+                if mapping.from_file and mapping.attr != 'keyword_list':
+                    setattr(self, mapping.attr, getattr(source, mapping.attr))
+            for attr in ('file_size', 'file_mtime', 'file_hash'):
+                setattr(self, attr, getattr(source, attr))
+        self.save()
+
+        self.delete_renditions()
+        for rendition in source.renditions.all():
+            Rendition.objects.create(photo=self, name=rendition.name,
+                                     image=rendition.image.name,
+                                     width=rendition.width,
+                                     height=rendition.height,
+                                     image_hash=rendition.image_hash)
+        if reuse_metadata:
+            self.keyword_list = source.keyword_list
+        return (True, reuse_metadata)
+
+    def set_perceptual_hash(self, value):
+        """\
+        Sets the perceptual hash and its bands, without saving the object.
+
+        Parameters:
+        value -- perceptual hash as an integer, or None to clear it
+
+        """
+        for attr, field_value in get_hash_fields(value).items():
+            setattr(self, attr, field_value)
+
+    def touch(self):
+        """\
+        Records a change to the Photo that was not made by Photo.save().
+
+        The updated time is set and the cached pages displaying the Photo
+        are invalidated, without saving the object.
+
+        """
+        self.updated = datetime.now()
+        Photo.objects.filter(pk=self.pk).update(updated=self.updated)
+        bump_version('photo', self.pk)
+
+    def get_album_position(self):
+        """\
+        Locates the Photo within its Album.
+
+        Photos are ordered by primary key within an album. The position and
+        count are read from Photo.album_sequence and Album.photo_count. If
+        the position has not been recorded yet, it is found with count
+        queries on the album and primary key instead.
+
+        Returns a (position, count) tuple, where position is 1 for the first
+        photo in the album and count is the number of photos in the album.
+
+        """
+        if self.album_sequence is not None:
+            return (self.album_sequence, self.album.photo_count)
+        in_album = Photo.objects.filter(album__id=self.album_id)
+        return (in_album.filter(id__lte=self.id).count(), in_album.count())
+
+    def get_album_neighbors(self):
+        """\
+        Finds the photos before and after the Photo in its Album.
+
+        Returns a (previous_id, next_id) tuple of primary keys; either is
+        None at the ends of the album.
+
+        """
+        in_album = Photo.objects.filter(album__id=self.album_id)
+        previous_ids = in_album.filter(id__lt=self.id).order_by('-id')\
+                               .values_list('id', flat=True)[:1]
+        next_ids = in_album.filter(id__gt=self.id).order_by('id')\
+                           .values_list('id', flat=True)[:1]
+        return ((list(previous_ids) or [None])[0],
+                (list(next_ids) or [None])[0])
+
+    def read_fingerprint(self):
+        """\
+        Returns the current fingerprint of the image file.
+
+        The fingerprint is a dictionary of values for the file_size,
+        file_mtime and file_hash fields. The file is hashed if the
+        PHOTO_FINGERPRINT_HASH setting is True, or if it was modified too
+        recently for a later change to be told apart by its modification
+        time.
+
+        """
+        path = self.image.path
+        stat = os.stat(path)
+        fingerprint = {
+            'file_size': stat.st_size,
+            'file_mtime': stat.st_mtime,
+            'file_hash': '',
+        }
+        if getattr(settings, 'PHOTO_FINGERPRINT_HASH', False) or \
+           is_mtime_ambiguous(stat.st_mtime):
+            fingerprint['file_hash'] = hash_file(path)
+        return fingerprint
+
+    def fingerprint_matches(self):
+        """\
+        Determines whether the image file is unchanged since the last sync.
+
+        The size and modification time of the file are compared with the
+        recorded fingerprint first, which only requires a stat() call. If a
+        hash was recorded, the contents are also compared by hash, in case
+        the file was changed without updating its modification time, or
+        within the resolution of modification times of the file system.
+
+        Returns True if the file is unchanged; False otherwise.
+
+        """
+        if self.file_size is None or self.file_mtime is None:
+            return False
+        path = self.image.path
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != self.file_size or stat.st_mtime != self.file_mtime:
+            return False
+        if self.file_hash:
+            return hash_file(path) == self.file_hash
+        return True
+
+    def record_fingerprint(self, fingerprint=None):
+        """\
+        Records the fingerprint of the image file.
+
+        The fingerprint is saved to the database directly, without calling
+        Photo.save().
+
+        Parameters:
+        fingerprint -- fingerprint to record, as returned by
+                       read_fingerprint(); None to clear the fingerprint
+
+        """
+        if fingerprint is None:
+            fingerprint = {
+                'file_size': None,
+                'file_mtime': None,
+                'file_hash': '',
+            }
+        for attr, value in fingerprint.items():
+            setattr(self, attr, value)
+        if self.pk is not None:
+            Photo.objects.filter(pk=self.pk).update(**fingerprint)
+
+    _metadata_session = None
+    _synced_in_session = False
+
+    def open_metadata(self):
+        """\
+        Opens a metadata session for the image file.
+
+        The Exif and IPTC metadata is read from the file once. Until
+        close_metadata() is called, every method that reads or writes the
+        image metadata uses this session instead of reading the file again,
+        and changes are only written to the file when the session is closed.
+
+        Returns the ImageMetadata object of the session. Raises IOError if
+        the metadata cannot be read from the file.
+
+        """
+        if self._metadata_session is None:
+            self._metadata_session = ImageMetadata(self.image.path)
+        return self._metadata_session
+
+    def close_metadata(self):
+        """\
+        Closes the metadata session, writing any changes to the file.
+
+        If the metadata cannot be written to the file, metadata
+        synchronization is disabled for the Photo. If the object and the
+        file were synchronized during the session, the fingerprint of the
+        file is recorded; otherwise, any change to the file invalidates it.
+
+        Returns True if metadata needed to be written to the file;
+        False otherwise.
+
+        """
+        session = self._metadata_session
+        synced = self._synced_in_session
+        self._metadata_session = None
+        self._synced_in_session = False
+        if session is None:
+            return False
+        try:
+            if session.modified and is_content_name(self.image.name):
+                session = self._detach_image(session)
+            written = session.flush()
+        except IOError:
+            self.metadata_sync_enabled = False
+            self.save()
+            return False
+
+        if synced:
+            self.record_fingerprint(self.read_fingerprint())
+        elif written:
+            # The file changed without the database being synchronized.
+            self.record_fingerprint(None)
+        return written
+
+    _keyword_list_cache = None
+
     @property
     def keyword_list(self):
         """\
         Returns the photograph keywords as a list of strings.
 
+        The keywords are cached on the object. The cache is invalidated when
+        the keywords are set through this property or the object is saved;
+        PhotoManager.attach_keyword_lists() fills it for many objects at once.
+
         """
-        return [keyword.name for keyword in self.keywords.all()]
+        if self._keyword_list_cache is None:
+            self._keyword_list_cache = list(
+                self.keywords.values_list('name', flat=True))
+        return list(self._keyword_list_cache)
 
     @keyword_list.setter
     def keyword_list(self, keyword_list):
         """\
         Sets the keywords from a list of strings.
 
+        Existing PhotoTags are matched by normalized name. All of the tags
+        are resolved with a single indexed query, any missing tags are
+        created with a single statement, and only the keywords actually
+        added or removed are changed in the relation.
+
         Parameters:
         keyword_list -- the list of keywords to set
 
         """
-        self.keywords.clear()
-
+        self._keyword_list_cache = None
         if not keyword_list:
+            self.keywords.clear()
+            self.touch()
             return
 
-        for keyword in keyword_list:
-            try:
-                photo_tag = PhotoTag.objects.get(name__iexact=keyword)
-            except ObjectDoesNotExist:
-                self.keywords.create(name=keyword)
-                continue
-            except PhotoTag.MultipleObjectsReturned:
+        tags = PhotoTag.objects.filter_names(keyword_list)
+        missing = [name for name in keyword_list
+                   if normalize_tag_name(name) not in tags]
+        if missing:
+            PhotoTag.objects.create_many(missing)
+            tags.update(PhotoTag.objects.filter_names(missing))
+        keyword_ids = set([tag.id for tag in tags.values()])
+
+        current_ids = set(self.keywords.values_list('id', flat=True))
+        removed_ids = current_ids - keyword_ids
+        added_ids = keyword_ids - current_ids
+        if removed_ids:
+            self.keywords.remove(*removed_ids)
+        if added_ids:
+            self.keywords.add(*added_ids)
+        if removed_ids or added_ids:
+            self.touch()
+
+    @property
+    def rendition_urls(self):
+        """\
+        Returns a dictionary of rendition URLs keyed by rendition name.
+
+        Every configured rendition name is present. Renditions that were not
+        generated because the original image is already small enough fall
+        back to the URL of the original image. This allows templates to pick
+        an appropriate size, e.g.:
+            {{ photo.rendition_urls.detail }}
+
+        """
+        if not hasattr(self, '_rendition_urls'):
+            urls = dict([(name, self.image_url)
+                         for name in get_rendition_names()])
+            for rendition in self.renditions.all():
+                urls[rendition.name] = rendition.url
+            self._rendition_urls = urls
+        return self._rendition_urls
+
+    def get_media_version(self, field_name):
+        """\
+        Returns a version string identifying the contents of the image or
+        thumbnail file.
+
+        The version of the thumbnail is its recorded hash. The version of the
+        image is its recorded hash, if one was recorded, or otherwise
+        derived from its recorded size and modification time. If
+        no fingerprint is recorded, the version changes whenever the Photo
+        does.
+
+        Parameters:
+        field_name -- 'image' or 'thumbnail'
+
+        """
+        if field_name == 'thumbnail':
+            if self.thumbnail_hash:
+                return self.thumbnail_hash[:16]
+            return make_version(self.thumbnail.name, self.updated)
+        if self.file_hash:
+            return self.file_hash[:16]
+        if self.file_mtime is not None:
+            return make_version(self.image.name, self.file_size,
+                                self.file_mtime)
+        return make_version(self.image.name, self.updated)
+
+    def get_media_url(self, field_name):
+        """\
+        Returns the versioned URL at which the image or thumbnail is served.
+
+        See views.photo_media().
+
+        Parameters:
+        field_name -- 'image' or 'thumbnail'
+
+        """
+        name = getattr(self, field_name).name
+        return reverse('photo_media', kwargs={
+            'object_id': self.id,
+            'field_name': field_name,
+            'version': self.get_media_version(field_name),
+            'filename': os.path.basename(name),
+        })
+
+    @property
+    def image_url(self):
+        return self.get_media_url('image')
+
+    @property
+    def thumbnail_url(self):
+        return self.get_media_url('thumbnail')
+
+    def delete_renditions(self):
+        """\
+        Deletes all renditions of the image, including their files unless
+        they are shared with a duplicate image.
+
+        """
+        for rendition in self.renditions.all():
+            _release_file(Rendition, 'image', rendition.image.name,
+                          rendition.pk)
+            rendition.delete()
+        if hasattr(self, '_rendition_urls'):
+            del self._rendition_urls
+
+    def _get_rendition_boxes(self):
+        """\
+        Returns the bounding boxes of the renditions the image needs.
+
+        """
+        original_size = (self.image_width, self.image_height)
+        return [box for name, box in get_rendition_sizes()
+                if not fits_within(original_size, box)]
+
+    def create_renditions(self, source=None):
+        """\
+        Creates the configured renditions of the image.
+
+        All renditions are created from a single decode of the original image.
+        Each rendition is downscaled from the next larger one rather than from
+        the original, so the cost of creating the smaller sizes is negligible.
+        Renditions that would not be smaller than the original are skipped.
+        Any previously existing renditions are replaced.
+
+        Returns a list of the PIL images created, largest first.
+
+        Parameters:
+        source -- decoded PIL image of the original, if already available
+
+        """
+        original_size = (self.image_width, self.image_height)
+        if source is None:
+            source = Image.open(self.image.path)
+            boxes = self._get_rendition_boxes()
+            if boxes:
+                draft_for_downscale(source, get_bounding_box(boxes))
+        self.delete_renditions()
+
+        format = get_rendition_format(source)
+        extension = {'JPEG': 'jpg', 'PNG': 'png'}[format]
+        basename = os.path.splitext(os.path.basename(self.image.name))[0]
+
+        images = []
+        current = source
+        for name, box in get_rendition_sizes():
+            if fits_within(original_size, box):
                 continue
-            self.keywords.add(photo_tag)
+            current = resize_image(current, box)
+            data = encode_image(current, format)
+            rendition = Rendition(photo=self, name=name,
+                                  width=current.size[0],
+                                  height=current.size[1],
+                                  image_hash=sha1(data).hexdigest())
+            rendition.image.save('%s_%s.%s' % (basename, name, extension),
+                                 ContentFile(data), save=False)
+            rendition.save()
+            images.append(current)
+        return images
 
     def create_thumbnail(self):
         """\
-        Creates a thumbnail version of the image.
+        Creates a thumbnail version of the image, along with its renditions.
+
+        The original image is decoded only once; the renditions and the
+        thumbnail are all generated from that decode. JPEG images are decoded
+        at a reduced resolution when the largest size needed allows it (see
+        renditions.draft_for_downscale).
 
         The embedded thumnail in a JPEG will be used if it exists.
         If the image is JPEG and it does not already have a thumbnail, it
-        will be embedded.
+        will be embedded, unless the image is content-addressed: embedding
+        would give the Photo a copy of its own of an image that duplicates
+        share. If a metadata session is open, the embedded thumbnail is
+        written when the session is closed.
 
         Note that calling this method will also call Photo.save().
 
         """
+        THUMB_SZ = 19200
+        thumb_sz_coefficient = math.sqrt(THUMB_SZ) / \
+                               math.sqrt(self.image_height * self.image_width)
+        thumb_width = int(round(self.image_width * thumb_sz_coefficient))
+        thumb_height = int(round(self.image_height * thumb_sz_coefficient))
+
+        source = Image.open(self.image.path)
+        source_format = source.format
+        boxes = self._get_rendition_boxes() + [(thumb_width, thumb_height)]
+        draft_for_downscale(source, get_bounding_box(boxes))
+        renditions = self.create_renditions(source)
+
         needs_thumbnail_embed = False
         if self.is_jpeg:
-            metadata = pyexiv2.Image(self.image.path)
-            metadata.readMetadata()
+            shared_session = self._metadata_session is not None
+            metadata = self.open_metadata()
             try:
                 thumb_data = metadata.getThumbnailData()
             except IOError:
-                needs_thumbnail_embed = True
+                needs_thumbnail_embed = not is_content_name(self.image.name)
             else:
                 thumb = StringIO(thumb_data[1])
                 thumb_image = Image.open(thumb)
@@ -297,34 +1354,80 @@ class Photo(models.Model):
                 thumb.close()
                 thumb = open(thumb_path)
                 self.thumbnail = ImageFile(thumb)
+                self.thumbnail_hash = hash_file(thumb_path)
+                self.set_perceptual_hash(dhash(thumb_image))
                 self.save()
                 thumb.close()
                 os.remove(thumb_path)
+                if not shared_session:
+                    self.close_metadata()
                 return
 
-        THUMB_SZ = 19200
-        thumb_sz_coefficient = math.sqrt(THUMB_SZ) / \
-                               math.sqrt(self.image_height * self.image_width)
-        thumb_width = int(round(self.image_width * thumb_sz_coefficient))
-        thumb_height = int(round(self.image_height * thumb_sz_coefficient))
-
-        thumb_image = Image.open(self.image.path)
+        # Downscale from the smallest rendition that is still large enough.
+        thumb_image = source
+        for rendition in renditions:
+            if (rendition.size[0] >= thumb_width and
+                rendition.size[1] >= thumb_height):
+                thumb_image = rendition
         if (self.image_width * self.image_height) > THUMB_SZ:
+            thumb_image = thumb_image.copy()
             thumb_image.thumbnail((thumb_width, thumb_height))
         thumb_fd, thumb_path = tempfile.mkstemp()
         os.close(thumb_fd)
-        thumb_image.save(thumb_path, thumb_image.format)
+        thumb_image.save(thumb_path, source_format)
         thumb = open(thumb_path)
         self.thumbnail = ImageFile(thumb)
+        self.thumbnail_hash = hash_file(thumb_path)
+        self.set_perceptual_hash(dhash(thumb_image))
         self.save()
         thumb.close()
 
         if needs_thumbnail_embed:
             metadata.setThumbnailFromJpegFile(thumb_path)
-            metadata.writeMetadata()
+            if not shared_session:
+                self.close_metadata()
 
         os.remove(thumb_path)
 
+    def merge_metadata_from_file(self):
+        """\
+        Merges the image metadata in the filesystem with the object.
+
+        Metadata is read from the file, except that values which are already
+        set on the object take precedence over the values in the file. If any
+        such values exist, the merged metadata is written back to the file.
+        The file is read and written at most once.
+
+        Returns True if the merged metadata needed to be written to the file;
+        False otherwise.
+
+        """
+        preserved = {}
+        for attr in ('description', 'artist', 'country', 'province_state',
+                     'city', 'location', 'time_created', 'keyword_list'):
+            value = getattr(self, attr)
+            if value:
+                preserved[attr] = value
+
+        shared_session = self._metadata_session is not None
+        try:
+            self.open_metadata()
+        except IOError:
+            pass
+
+        self.sync_metadata_from_file()
+
+        mod = False
+        if preserved:
+            for attr, value in preserved.items():
+                setattr(self, attr, value)
+            self.save()
+            mod = self.sync_metadata_to_file()
+
+        if not shared_session:
+            self.close_metadata()
+        return mod
+
     def sync_metadata_to_file(self):
         """\
         Synchronizes the image metadata from the object to the filesystem.
@@ -333,6 +1436,8 @@ class Photo(models.Model):
         itself as Exif and/or IPTC tags, allowing the information to be
         portable outside of this application. Metadata is only actually
         written to the filesystem if the values do not match up, however.
+        If a metadata session is open, the changes are written when the
+        session is closed.
 
         Returns True if metadata needed to be written to the file;
         False otherwise.
@@ -341,71 +1446,46 @@ class Photo(models.Model):
         if not self.metadata_sync_enabled:
             return False
 
+        shared_session = self._metadata_session is not None
         try:
-            image_metadata = pyexiv2.Image(self.image.path)
-            image_metadata.readMetadata()
+            image_metadata = self.open_metadata()
         except IOError:
             self.metadata_sync_enabled = False
             self.save()
             return False
 
-        mod = False # whether or not file actually needs written to
-
-        # sync description
-        mod = sync_value_to_exif_and_iptc(self.description, image_metadata,
-                                          'Exif.Image.ImageDescription',
-                                          'Iptc.Application2.Caption') or mod
+        changes = sync_record_to_file(self, image_metadata,
+                                      self.metadata_mappings)
+        mod = bool(changes)  # whether or not file actually needs written to
+        self._synced_in_session = True
 
-        # sync artist
-        mod = sync_value_to_exif_and_iptc(self.artist, image_metadata,
-                                          'Exif.Image.Artist',
-                                          'Iptc.Application2.Byline') or mod
-
-        # sync country
-        mod = sync_value_to_iptc(self.country, image_metadata,
-                                 'Iptc.Application2.CountryName') or mod
-
-        # sync province_state
-        mod = sync_value_to_iptc(self.province_state, image_metadata,
-                                 'Iptc.Application2.ProvinceState') or mod
-
-        # sync city
-        mod = sync_value_to_iptc(self.city, image_metadata,
-                                 'Iptc.Application2.City') or mod
-
-        # sync location
-        mod = sync_value_to_iptc(self.location, image_metadata,
-                                 'Iptc.Application2.SubLocation') or mod
-
-        # sync time_created
-        mod = sync_datetime_to_exif_and_iptc(self.time_created,
-            image_metadata, 'Exif.Photo.DateTimeOriginal',
-            'Iptc.Application2.DateCreated', 'Iptc.Application2.TimeCreated')\
-            or mod
+        if not shared_session:
+            self.close_metadata()
+            if not self.metadata_sync_enabled:
+                return False
 
-        # sync keywords
-        mod = sync_value_to_iptc(self.keyword_list, image_metadata,
-                                 'Iptc.Application2.Keywords') or mod
+        return mod
 
-        # sync image_width
-        mod = sync_value_to_exif(self.image_width, image_metadata,
-                                 get_image_width_key(self.is_jpeg)) or mod
+    def diff_metadata_with_file(self):
+        """\
+        Compares the object with the image metadata in the filesystem.
 
-        # sync image_height
-        mod = sync_value_to_exif(self.image_height, image_metadata,
-                                 get_image_height_key(self.is_jpeg)) or mod
+        Neither the object nor the file is modified. The metadata is read
+        from the open metadata session, if any.
 
-        if mod:
-            try:
-                image_metadata.writeMetadata()
-            except IOError:
-                self.metadata_sync_enabled = False
-                self.save()
-                return False
+        Returns a dictionary mapping the name of each attribute that is out
+        of sync with the file to the value read from the file. Raises IOError
+        if the metadata cannot be read from the file.
 
-        return mod
+        """
+        if self._metadata_session is not None:
+            image_metadata = self._metadata_session
+        else:
+            image_metadata = ImageMetadata(self.image.path)
+        return diff_record_with_file(self, image_metadata,
+                                     self.metadata_mappings)
 
-    def sync_metadata_from_file(self, commit=True):
+    def sync_metadata_from_file(self, commit=True, force=False):
         """\
         Synchronizes the image metadata from the filesystem to the object.
 
@@ -414,6 +1494,9 @@ class Photo(models.Model):
         from outside of this application. Metadata is only actually
         written to the database if the values do not match up, however.
 
+        The file is not read at all if its fingerprint shows that it has not
+        changed since the last synchronization, unless force is True.
+
         Returns True if metadata needed to be written to the database;
         False otherwise.
 
@@ -421,103 +1504,26 @@ class Photo(models.Model):
         if not self.metadata_sync_enabled:
             return False
 
+        if not force and self.fingerprint_matches():
+            return False
+
+        shared_session = self._metadata_session is not None
         try:
-            image_metadata = pyexiv2.Image(self.image.path)
-            image_metadata.readMetadata()
+            self.open_metadata()
         except IOError:
             self.metadata_sync_enabled = False
             self.save()
             return False
 
-        mod_instance = False  # whether or not database needs written to
-
-        # sync description
-        mod_attr = not value_synced_with_exif_and_iptc(
-            self.description, image_metadata,
-            'Exif.Image.ImageDescription', 'Iptc.Application2.Caption')
-        mod_instance = mod_attr or mod_instance
-        if mod_attr:
-            value = read_value_from_exif_and_iptc(image_metadata,
-                'Exif.Image.ImageDescription', 'Iptc.Application2.Caption')
-            if value is None:
-                value = str()
-            self.description = value
-
-        # sync artist
-        mod_attr = not value_synced_with_exif_and_iptc(
-            self.artist, image_metadata,
-            'Exif.Image.Artist', 'Iptc.Application2.Byline')
-        mod_instance = mod_attr or mod_instance
-        if mod_attr:
-            value = read_value_from_exif_and_iptc(image_metadata,
-                'Exif.Image.Artist', 'Iptc.Application2.Byline')
-            if value is None:
-                value = str()
-            self.artist = value
-
-        # sync country
-        mod_attr = not value_synced_with_iptc(self.country, image_metadata,
-                                              'Iptc.Application2.CountryName')
-        mod_instance = mod_attr or mod_instance
-        if ('Iptc.Application2.CountryName' in image_metadata.iptcKeys() and
-            mod_attr):
-            value = image_metadata['Iptc.Application2.CountryName']
-            if value is None:
-                value = str()
-            self.country = value
-
-        # sync province_state
-        mod_attr = not value_synced_with_iptc(
-            self.province_state, image_metadata,
-            'Iptc.Application2.ProvinceState')
-        mod_instance = mod_attr or mod_instance
-        if ('Iptc.Application2.ProvinceState' in image_metadata.iptcKeys() and
-            mod_attr):
-            value = image_metadata['Iptc.Application2.ProvinceState']
-            if value is None:
-                value = str()
-            self.province_state = value
-
-        # sync city
-        mod_attr = not value_synced_with_iptc(self.city, image_metadata,
-                                              'Iptc.Application2.City')
-        mod_instance = mod_attr or mod_instance
-        if 'Iptc.Application2.City' in image_metadata.iptcKeys() and mod_attr:
-            value = image_metadata['Iptc.Application2.City']
-            if value is None:
-                value = str()
-            self.city = value
-
-        # sync location
-        mod_attr = not value_synced_with_iptc(self.location, image_metadata,
-                                              'Iptc.Application2.SubLocation')
-        mod_instance = mod_attr or mod_instance
-        if ('Iptc.Application2.SubLocation' in image_metadata.iptcKeys() and
-            mod_attr):
-            value = image_metadata['Iptc.Application2.SubLocation']
-            if value is None:
-                value = str()
-            self.location = value
-
-        # sync time_created
-        mod_attr = not datetime_synced_with_exif_and_iptc(
-            self.time_created, image_metadata,
-            'Exif.Photo.DateTimeOriginal', 'Iptc.Application2.DateCreated',
-            'Iptc.Application2.TimeCreated')
-        mod_instance = mod_attr or mod_instance
-        if mod_attr:
-            self.time_created = read_datetime_from_exif_and_iptc(
-                image_metadata, 'Exif.Photo.DateTimeOriginal',
-                'Iptc.Application2.DateCreated',
-                'Iptc.Application2.TimeCreated')
-
-        # sync keywords
-        mod_attr = not value_synced_with_iptc(self.keyword_list,
-            image_metadata, 'Iptc.Application2.Keywords')
-        mod_instance = mod_attr or mod_instance
-        if ('Iptc.Application2.Keywords' in image_metadata.iptcKeys() and
-            mod_attr):
-            self.keyword_list = image_metadata['Iptc.Application2.Keywords']
+        changes = self.diff_metadata_with_file()
+        for attr, value in changes.items():
+            setattr(self, attr, value)
+        # whether or not database needs written to
+        mod_instance = bool(changes)
+        self._synced_in_session = commit or not mod_instance
+
+        if not shared_session:
+            self.close_metadata()
 
         if mod_instance and commit:
             self.save()
@@ -525,6 +1531,238 @@ class Photo(models.Model):
         return mod_instance
 
 
+def _add_to_album(album_id, photo_id):
+    """\
+    Records the addition of a Photo to an Album.
+
+    The photo count of the album is incremented and the photos after the
+    added one are moved back one position. As photos are usually added with
+    the highest primary key, usually no photos are moved.
+
+    The position of the added Photo is counted in the statement that
+    records it, rather than derived from a separate read of the photo
+    count, so that photos added to the album concurrently cannot be given
+    the same position.
+
+    Returns the position of the added Photo.
+
+    Parameters:
+    album_id -- primary key of the Album
+    photo_id -- primary key of the Photo added
+
+    """
+    Album.objects.filter(pk=album_id).update(
+        photo_count=F('photo_count') + 1, updated=datetime.now())
+    Photo.objects.filter(album__id=album_id, id__gt=photo_id)\
+                 .update(album_sequence=F('album_sequence') + 1)
+
+    qn = connection.ops.quote_name
+    table = qn(Photo._meta.db_table)
+    cursor = connection.cursor()
+    cursor.execute(
+        "UPDATE %s SET %s = (SELECT COUNT(*) FROM %s other "
+        "WHERE other.%s = %%s AND other.%s <= %%s) WHERE %s = %%s" % (
+            table, qn('album_sequence'), table, qn('album_id'), qn('id'),
+            qn('id')),
+        [album_id, photo_id, photo_id])
+    transaction.commit_unless_managed()
+    bump_version('album', album_id)
+    return Photo.objects.filter(pk=photo_id)\
+                        .values_list('album_sequence', flat=True)[0]
+
+
+def _remove_from_album(album_id, photo_id):
+    """\
+    Records the removal of a Photo from an Album.
+
+    The photo count of the album is decremented and the photos after the
+    removed one are moved forward one position. These are found by primary
+    key rather than by the position of the removed Photo, which may have
+    changed since it was loaded.
+
+    Parameters:
+    album_id -- primary key of the Album
+    photo_id -- primary key of the Photo removed
+
+    """
+    Album.objects.filter(pk=album_id).update(
+        photo_count=F('photo_count') - 1, updated=datetime.now())
+    bump_version('album', album_id)
+    Photo.objects.filter(album__id=album_id, id__gt=photo_id)\
+                 .update(album_sequence=F('album_sequence') - 1)
+
+
+def _photo_deleted(sender, instance, **kwargs):
+    _remove_from_album(instance.album_id, instance.id)
+
+post_delete.connect(_photo_deleted, sender=Photo)
+
+
+def _invalidate_photo(sender, instance, **kwargs):
+    bump_version('photo', instance.pk)
+    bump_version('album', instance.album_id)
+    Album.objects.filter(pk=instance.album_id).update(updated=datetime.now())
+
+post_save.connect(_invalidate_photo, sender=Photo)
+post_delete.connect(_invalidate_photo, sender=Photo)
+
+
+def _invalidate_album(sender, instance, **kwargs):
+    bump_version('album', instance.pk)
+    bump_version('owner', instance.owner_id)
+
+post_save.connect(_invalidate_album, sender=Album)
+post_delete.connect(_invalidate_album, sender=Album)
+
+
+class PhotoJob(models.Model):
+    """\
+    A queued list of processing tasks to run on a Photo in the background.
+
+    Tasks are names of Photo methods listed in photasm.photos.jobs.TASKS and
+    are run in order by a worker (see the process_photo_jobs management
+    command). A job that fails is retried until it has been attempted
+    PHOTO_JOB_MAX_ATTEMPTS times.
+
+    """
+    photo = models.ForeignKey(Photo, related_name='jobs')
+    tasks = models.CharField(max_length=128)
+    status = models.CharField(max_length=16, choices=PROCESSING_STATUS_CHOICES,
+                              default=PROCESSING_PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return "job #%d (%s) for %s" % (self.id, self.tasks, self.photo)
+
+    @property
+    def task_list(self):
+        """\
+        Returns the names of the tasks to run as a list of strings.
+
+        """
+        return self.tasks.split(',')
+
+
+class Rendition(models.Model):
+    """\
+    A downscaled version of a Photo at one of the configured rendition sizes.
+
+    Renditions allow pages to serve an image appropriate for the size at
+    which it is displayed instead of the full original.
+
+    """
+    photo = models.ForeignKey(Photo, related_name='renditions')
+    name = models.CharField(max_length=32)
+    image = models.ImageField(upload_to="thumbs/%Y/%m/%d")
+    width = models.IntegerField(editable=False)
+    height = models.IntegerField(editable=False)
+
+    image_hash = models.CharField(max_length=40, blank=True, editable=False)
+    """\
+    SHA-1 hash of the rendition file, used to version its URL.
+
+    Renditions created again are stored under the same names, so the name
+    alone does not identify their contents.
+
+    """
+
+    class Meta:
+        unique_together = (('photo', 'name'),)
+
+    def __unicode__(self):
+        return "%s rendition of %s" % (self.name, self.photo)
+
+    @property
+    def url(self):
+        """\
+        Returns the versioned URL at which the rendition is served.
+
+        The version is the recorded hash of the file. Renditions recorded
+        without one are versioned by their primary key, name and size,
+        which change whenever the rendition is created again.
+
+        """
+        if self.image_hash:
+            version = self.image_hash[:16]
+        else:
+            version = make_version(self.pk, self.image.name, self.width,
+                                   self.height)
+        return reverse('photo_media', kwargs={
+            'object_id': self.photo_id,
+            'field_name': self.name,
+            'version': version,
+            'filename': os.path.basename(self.image.name),
+        })
+
+
+class UploadSession(models.Model):
+    """\
+    An image being uploaded in chunks, which may be resumed after the
+    connection drops.
+
+    The chunks are appended to a file in the upload directory. Once all of
+    them are received, the file becomes a Photo; see views.upload_finalize.
+
+    """
+    owner = models.ForeignKey(User)
+    album = models.ForeignKey(Album)
+    token = models.CharField(max_length=32, unique=True, editable=False)
+    filename = models.CharField(max_length=255)
+    size = models.IntegerField()
+    received = models.IntegerField(default=0, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return "upload of %s (%d of %d bytes)" % (self.filename,
+                                                 self.received, self.size)
+
+    @property
+    def path(self):
+        """\
+        Returns the path of the file the chunks are written to.
+
+        """
+        return os.path.join(get_upload_dir(), '%s.part' % (self.token,))
+
+    @property
+    def is_complete(self):
+        return self.received >= self.size
+
+    def save(self, *args, **kwargs):
+        if not self.token:
+            self.token = uuid.uuid4().hex
+        super(UploadSession, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        super(UploadSession, self).delete(*args, **kwargs)
+
+
+class StreamedImageField(forms.ImageField):
+    """\
+    Image form field that trusts the format found while streaming an upload.
+
+    Django's ImageField decodes the whole image to validate it. Files
+    received by uploadhandler.StreamingImageUploadHandler were already
+    recognized as images from their first bytes, so they are not read
+    again. Other files are validated as usual.
+
+    """
+
+    def clean(self, data, initial=None):
+        if not hasattr(data, 'image_format'):
+            return super(StreamedImageField, self).clean(data, initial)
+        f = forms.FileField.clean(self, data, initial)
+        if f is not None and data.image_format is None:
+            raise forms.ValidationError(self.error_messages['invalid_image'])
+        return f
+
+
 class PhotoUploadForm(forms.ModelForm):
     """\
     Form presented to the user for uploading a Photo.
@@ -535,6 +1773,8 @@ class PhotoUploadForm(forms.ModelForm):
 
     """
 
+    image = StreamedImageField()
+
     class Meta:
         model = Photo
         fields = ('image',)
@@ -0,0 +1,155 @@
+import base64
+
+from django.conf import settings
+
+
+DEFAULT_PAGE_SIZE = 60
+"""\
+Number of photographs shown on one page of an album.
+
+This may be overridden with the PHOTO_ALBUM_PAGE_SIZE setting.
+
+"""
+
+DEFAULT_MAX_PAGE_SIZE = 200
+"""\
+Largest page size that may be requested with the per_page parameter.
+
+This may be overridden with the PHOTO_ALBUM_MAX_PAGE_SIZE setting.
+
+"""
+
+
+class InvalidCursor(ValueError):
+    """\
+    Raised when a cursor token cannot be decoded.
+
+    """
+    pass
+
+
+def encode_cursor(album_id, photo_id):
+    """\
+    Returns an opaque token marking a position within an album.
+
+    The token only depends on the album and the photograph at the position,
+    so it stays valid when photographs are added to or removed from the
+    album.
+
+    Parameters:
+    album_id -- primary key of the Album
+    photo_id -- primary key of the Photo at the position
+
+    """
+    token = base64.urlsafe_b64encode('%d:%d' % (album_id, photo_id))
+    return token.rstrip('=')
+
+
+def decode_cursor(album_id, token):
+    """\
+    Returns the photograph primary key encoded in a cursor token.
+
+    Raises InvalidCursor if the token is malformed or belongs to another
+    album.
+
+    Parameters:
+    album_id -- primary key of the Album being paged through
+    token -- token returned by encode_cursor()
+
+    """
+    try:
+        token = str(token)
+        value = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        token_album_id, photo_id = [int(part) for part in value.split(':')]
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor("Malformed cursor '%s'." % (token,))
+    if token_album_id != album_id:
+        raise InvalidCursor("Cursor '%s' belongs to another album." % (token,))
+    return photo_id
+
+
+def get_page_size(requested=None):
+    """\
+    Returns the number of items to show on a page.
+
+    Parameters:
+    requested -- page size requested by the client, if any; it is limited
+                 to the maximum page size
+
+    """
+    page_size = getattr(settings, 'PHOTO_ALBUM_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    if requested:
+        try:
+            page_size = int(requested)
+        except ValueError:
+            pass
+    max_page_size = getattr(settings, 'PHOTO_ALBUM_MAX_PAGE_SIZE',
+                            DEFAULT_MAX_PAGE_SIZE)
+    return max(1, min(page_size, max_page_size))
+
+
+class KeysetPage(object):
+    """\
+    One page of the photographs of an album, ordered by primary key.
+
+    Pages are found by seeking from the primary key of the last photograph
+    of the previous page (or the first photograph of the next page) rather
+    than with OFFSET, so any page of an album is as cheap to fetch as the
+    first one, using the index on the album and primary key.
+
+    """
+
+    def __init__(self, queryset, album_id, page_size, after=None,
+                 before=None):
+        """\
+        Fetches one page of photographs.
+
+        Parameters:
+        queryset -- Photos of the album
+        album_id -- primary key of the Album
+        page_size -- maximum number of photographs on the page
+        after -- token of the cursor after which the page starts
+        before -- token of the cursor before which the page ends
+
+        """
+        self.album_id = album_id
+
+        # One row more than the page size tells whether there are more rows.
+        if before:
+            photo_id = decode_cursor(album_id, before)
+            object_list = list(queryset.filter(id__lt=photo_id)
+                               .order_by('-id')[:page_size + 1])
+            self.has_previous = len(object_list) > page_size
+            self.has_next = True
+            object_list = object_list[:page_size]
+            object_list.reverse()
+        else:
+            if after:
+                photo_id = decode_cursor(album_id, after)
+                queryset = queryset.filter(id__gt=photo_id)
+            object_list = list(queryset.order_by('id')[:page_size + 1])
+            self.has_next = len(object_list) > page_size
+            self.has_previous = bool(after)
+            object_list = object_list[:page_size]
+
+        if not object_list:
+            self.has_previous = self.has_next = False
+        self.object_list = object_list
+
+    def next_cursor(self):
+        """\
+        Returns the token of the cursor for the next page, or None.
+
+        """
+        if not self.has_next:
+            return None
+        return encode_cursor(self.album_id, self.object_list[-1].pk)
+
+    def previous_cursor(self):
+        """\
+        Returns the token of the cursor for the previous page, or None.
+
+        """
+        if not self.has_previous:
+            return None
+        return encode_cursor(self.album_id, self.object_list[0].pk)
@@ -0,0 +1,67 @@
+from multiprocessing import Pool
+
+from django.db import connection
+
+
+def describe_error(e):
+    """\
+    Describes an exception raised by a worker.
+
+    Exceptions raised by pyexiv2 and PIL cannot always be pickled, so only
+    their description is sent back from the worker processes.
+
+    """
+    return '%s: %s' % (e.__class__.__name__, e)
+
+
+class ProcessPool(object):
+    """\
+    A pool of worker processes for CPU-bound image and metadata work.
+
+    pyexiv2 and PIL do not release the GIL, so such work only scales with
+    the number of cores when it is spread across processes. With a single
+    process, work is simply done in the current process.
+
+    """
+
+    def __init__(self, processes):
+        """\
+        Starts the worker processes.
+
+        Parameters:
+        processes -- number of worker processes to start
+
+        """
+        self.processes = processes
+        self._pool = None
+        if processes > 1:
+            # A database connection must not be shared with forked workers;
+            # each of them opens its own when it first needs one.
+            connection.close()
+            self._pool = Pool(processes)
+
+    def map(self, func, items):
+        """\
+        Applies a function to every item, returning the results in order.
+
+        The function must be defined at module level so that it can be sent
+        to the worker processes.
+
+        Parameters:
+        func -- function to apply
+        items -- list of arguments to apply the function to
+
+        """
+        if self._pool is None:
+            return map(func, items)
+        return self._pool.map(func, items, chunksize=1)
+
+    def close(self):
+        """\
+        Waits for the worker processes to finish and stops them.
+
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
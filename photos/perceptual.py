@@ -0,0 +1,136 @@
+from PIL import Image
+
+
+HASH_SIZE = 8
+"""\
+Width and height of the grid of differences a perceptual hash is made of.
+
+"""
+
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+BAND_COUNT = 4
+"""\
+Number of bands a perceptual hash is split into for searching.
+
+Each band is stored in its own indexed column. If two hashes are within a
+Hamming distance k of each other, at least one of their bands is within a
+distance of k // BAND_COUNT, so candidates can be found with indexed
+lookups of the bands near those of the hash searched for (multi-index
+hashing) rather than by comparing every hash.
+
+"""
+
+BAND_BITS = HASH_BITS // BAND_COUNT
+
+DEFAULT_MAX_DISTANCE = 6
+"""\
+Default largest Hamming distance at which photos are considered similar.
+
+"""
+
+MAX_DISTANCE = 15
+"""\
+Largest Hamming distance that may be searched for.
+
+The number of values looked up per band grows quickly with the distance:
+697 of them at this distance.
+
+"""
+
+MAX_QUERY_VALUES = 500
+"""\
+Largest number of values looked up in a single query, such as the band
+values searched for by PhotoManager.find_similar().
+
+SQLite allows at most 999 variables in a statement.
+
+"""
+
+
+def dhash(image):
+    """\
+    Computes the difference hash of an image.
+
+    The image is reduced to a small grayscale grid, and each bit of the
+    hash tells whether a cell is brighter than the cell to its right. The
+    hash changes little when the image is resized, recompressed or has its
+    brightness adjusted.
+
+    Returns the hash as a HASH_BITS bit integer.
+
+    Parameters:
+    image -- PIL image, such as the thumbnail of a photograph
+
+    """
+    small = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE),
+                                      Image.ANTIALIAS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for column in range(HASH_SIZE):
+            brighter = pixels[offset + column] > pixels[offset + column + 1]
+            value = (value << 1) | int(brighter)
+    return value
+
+
+def hamming_distance(a, b):
+    """\
+    Returns the number of bits that differ between two hashes.
+
+    """
+    return bin(a ^ b).count('1')
+
+
+def split_bands(value):
+    """\
+    Splits a perceptual hash into BAND_COUNT integers of BAND_BITS bits.
+
+    """
+    mask = (1 << BAND_BITS) - 1
+    return [int((value >> (index * BAND_BITS)) & mask)
+            for index in range(BAND_COUNT)]
+
+
+def get_hash_fields(value):
+    """\
+    Returns the values of the Photo fields storing a perceptual hash.
+
+    Parameters:
+    value -- perceptual hash as an integer, or None to clear the hash
+
+    """
+    if value is None:
+        fields = {'perceptual_hash': ''}
+        bands = [None] * BAND_COUNT
+    else:
+        fields = {'perceptual_hash': '%0*x' % (HASH_BITS // 4, value)}
+        bands = split_bands(value)
+    for index, band in enumerate(bands):
+        fields['phash_band%d' % (index,)] = band
+    return fields
+
+
+def get_band_neighbors(band, radius):
+    """\
+    Returns all of the band values within a Hamming distance of a band.
+
+    Parameters:
+    band -- value of the band
+    radius -- largest number of bits that may differ
+
+    """
+    neighbors = [band]
+    frontier = [(band, -1)]
+    for distance in range(radius):
+        next_frontier = []
+        for value, last_bit in frontier:
+            # Flip only higher bits than those already flipped, so each
+            # value is produced once.
+            for bit in range(last_bit + 1, BAND_BITS):
+                neighbor = value ^ (1 << bit)
+                neighbors.append(neighbor)
+                next_frontier.append((neighbor, bit))
+        frontier = next_frontier
+    return neighbors
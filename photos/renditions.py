@@ -0,0 +1,162 @@
+from StringIO import StringIO
+
+from django.conf import settings
+from PIL import Image
+
+
+DEFAULT_RENDITION_SIZES = (
+    ('grid_2x', (320, 320)),
+    ('detail', (800, 800)),
+    ('detail_2x', (1600, 1600)),
+    ('lightbox', (1280, 1280)),
+    ('lightbox_2x', (2560, 2560)),
+)
+"""\
+Named image sizes generated for every Photo, in addition to its thumbnail.
+
+Each size is a bounding box; renditions keep the aspect ratio of the original
+and are never enlarged. This may be overridden with the
+PHOTO_RENDITION_SIZES setting.
+
+"""
+
+DEFAULT_RENDITION_QUALITY = 85
+
+DEFAULT_DRAFT_OVERSAMPLE = 2
+"""\
+How much larger than the largest requested size a JPEG is decoded.
+
+JPEG images may be decoded directly at 1/2, 1/4 or 1/8 scale, which is much
+faster and uses much less memory than decoding at full resolution. Decoding
+at exactly the requested size (1) is fastest but leaves the final resample
+little headroom; larger values trade speed for quality. A value of None or 0
+disables reduced-resolution decoding. This may be overridden with the
+PHOTO_DRAFT_OVERSAMPLE setting.
+
+"""
+
+
+def get_rendition_sizes():
+    """\
+    Returns the configured rendition sizes, largest first.
+
+    The result is a list of (name, (width, height)) tuples.
+
+    """
+    sizes = getattr(settings, 'PHOTO_RENDITION_SIZES', DEFAULT_RENDITION_SIZES)
+    return sorted(sizes, key=lambda size: size[1][0] * size[1][1],
+                  reverse=True)
+
+
+def get_rendition_names():
+    """\
+    Returns the names of all configured renditions.
+
+    """
+    return [name for name, box in get_rendition_sizes()]
+
+
+def fits_within(image_size, box):
+    """\
+    Determines whether an image already fits within a bounding box.
+
+    Returns True if no downscaling would be needed; False otherwise.
+
+    Parameters:
+    image_size -- (width, height) of the image
+    box -- (width, height) of the bounding box
+
+    """
+    return image_size[0] <= box[0] and image_size[1] <= box[1]
+
+
+def get_bounding_box(boxes):
+    """\
+    Returns the smallest box that contains all of the given boxes.
+
+    Parameters:
+    boxes -- list of (width, height) tuples
+
+    """
+    return (max([box[0] for box in boxes]), max([box[1] for box in boxes]))
+
+
+def draft_for_downscale(image, size):
+    """\
+    Configures an image to be decoded at a reduced resolution if possible.
+
+    For JPEG images this selects DCT-domain downscaling so that the image is
+    decoded at the smallest of 1/1, 1/2, 1/4 or 1/8 scale that is still at
+    least as large as the requested size times the configured oversampling
+    factor. Other formats are unaffected. This must be called before the
+    image data is loaded.
+
+    Returns the image, whose size reflects the reduced resolution.
+
+    Parameters:
+    image -- PIL image opened but not yet loaded
+    size -- (width, height) that the image will be downscaled to
+
+    """
+    oversample = getattr(settings, 'PHOTO_DRAFT_OVERSAMPLE',
+                         DEFAULT_DRAFT_OVERSAMPLE)
+    if not oversample or image.format != 'JPEG':
+        return image
+    image.draft(image.mode, (int(size[0] * oversample),
+                             int(size[1] * oversample)))
+    return image
+
+
+def get_rendition_format(image):
+    """\
+    Returns the PIL format name a rendition of an image should be saved as.
+
+    Renditions are saved as JPEG unless the image has transparency, in which
+    case PNG is used.
+
+    Parameters:
+    image -- PIL image the rendition will be created from
+
+    """
+    if image.mode in ('RGBA', 'LA', 'P'):
+        return 'PNG'
+    return 'JPEG'
+
+
+def resize_image(image, box):
+    """\
+    Returns a copy of an image downscaled to fit within a bounding box.
+
+    Parameters:
+    image -- PIL image to downscale
+    box -- (width, height) of the bounding box
+
+    """
+    rendition = image.copy()
+    rendition.thumbnail(box, Image.ANTIALIAS)
+    return rendition
+
+
+def encode_image(image, format):
+    """\
+    Encodes an image for storage as a rendition.
+
+    Returns the encoded image data as a string.
+
+    Parameters:
+    image -- PIL image to encode
+    format -- PIL format name to encode the image as
+
+    """
+    if format == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+        image = image.convert('RGB')
+    quality = getattr(settings, 'PHOTO_RENDITION_QUALITY',
+                      DEFAULT_RENDITION_QUALITY)
+    buf = StringIO()
+    if format == 'JPEG':
+        image.save(buf, format, quality=quality, optimize=True)
+    else:
+        image.save(buf, format, optimize=True)
+    data = buf.getvalue()
+    buf.close()
+    return data
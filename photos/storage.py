@@ -0,0 +1,101 @@
+from datetime import datetime
+import os
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from photasm.photos.image_files import CHUNK_SIZE, hash_file, sha1
+
+
+CONTENT_DIR = 'photos/content'
+"""\
+Directory under MEDIA_ROOT that content-addressed images are stored in.
+
+"""
+
+IMAGE_DIR = 'photos/%Y/%m/%d'
+"""\
+Directory under MEDIA_ROOT that other images are stored in, formatted with
+the date of the upload.
+
+"""
+
+
+def is_content_addressed():
+    """\
+    Returns whether new images are stored by the hash of their contents.
+
+    This is enabled by the PHOTO_CONTENT_ADDRESSED_STORAGE setting. When it
+    is, an image uploaded several times is stored once and shared by the
+    Photos; see Photo.save().
+
+    """
+    return getattr(settings, 'PHOTO_CONTENT_ADDRESSED_STORAGE', False)
+
+
+def get_content_name(content_hash, filename):
+    """\
+    Returns the storage name of a content-addressed image.
+
+    The name is made of the hash, split into two levels of directories so
+    that no directory grows too large, and the extension of the file.
+
+    Parameters:
+    content_hash -- SHA-1 hash of the image file
+    filename -- original name of the image file
+
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    return '%s/%s/%s/%s%s' % (CONTENT_DIR, content_hash[:2],
+                              content_hash[2:4], content_hash, extension)
+
+
+def is_content_name(name):
+    """\
+    Returns whether a storage name is that of a content-addressed image.
+
+    The file at such a name must always hold the content it was named
+    after, as other Photos may reuse it.
+
+    """
+    return bool(name) and name.startswith(CONTENT_DIR + '/')
+
+
+def get_image_name(filename):
+    """\
+    Returns the storage name for an image that is not content-addressed.
+
+    The storage makes the name unique when the file is saved.
+
+    Parameters:
+    filename -- name of the image file
+
+    """
+    return os.path.join(datetime.now().strftime(IMAGE_DIR),
+                        default_storage.get_valid_name(
+                            os.path.basename(filename)))
+
+
+def hash_uploaded_file(uploaded_file):
+    """\
+    Computes the SHA-1 hash of a file that has not been stored yet.
+
+    The hash computed while the file was streamed is used if available.
+    Otherwise the file is read in chunks.
+
+    Returns the hash as a string of 40 hexadecimal digits.
+
+    Parameters:
+    uploaded_file -- django.core.files.File of the image
+
+    """
+    content_hash = getattr(uploaded_file, 'content_hash', None)
+    if content_hash:
+        return content_hash
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        return hash_file(uploaded_file.temporary_file_path())
+    content_hash = sha1()
+    for chunk in uploaded_file.chunks(CHUNK_SIZE):
+        content_hash.update(chunk)
+    uploaded_file.seek(0)
+    return content_hash.hexdigest()
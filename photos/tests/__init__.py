@@ -4,6 +4,10 @@ from photo import *
 from photo_views import *
 from empty_database import *
 from image_metadata import *
+from jobs import *
+from perceptual import *
+from renditions import *
+from uploads import *
 from views import *
 
 __test__ = {}
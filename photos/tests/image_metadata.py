@@ -7,16 +7,22 @@ from PIL import Image
 import pyexiv2
 
 from photasm.photos.image_metadata import (
+    ExifAndIptcMapping,
+    ExifMapping,
+    ImageMetadata,
+    IptcMapping,
     _collapse_iter,
     _del_img_key,
     _is_iter,
     datetime_synced_with_exif_and_iptc,
+    diff_record_with_file,
     get_image_height_key,
     get_image_width_key,
     read_datetime_from_exif_and_iptc,
     read_value_from_exif_and_iptc,
     require_pyexiv2_obj,
     sync_datetime_to_exif_and_iptc,
+    sync_record_to_file,
     sync_value_to_exif,
     sync_value_to_exif_and_iptc,
     sync_value_to_iptc,
@@ -58,6 +64,79 @@ class ImageMetadataTest(TestCase):
 
         os.remove(file_path)
 
+    def test_image_metadata(self):
+        file_descriptor, file_path = tempfile.mkstemp(suffix='.jpg')
+        os.close(file_descriptor)
+        Image.new('RGB', (1, 1)).save(file_path, 'JPEG')
+
+        metadata = ImageMetadata(file_path)
+        self.assertEqual(require_pyexiv2_obj(metadata, 'metadata'), None)
+        self.assertFalse(metadata.flush())
+
+        # Key sets are invalidated when tags change.
+        self.assertFalse('Exif.Image.Artist' in metadata.exif_key_set())
+        self.assertEqual(metadata.iptc_key_set(), frozenset())
+
+        # Changes are accumulated until flushed.
+        metadata['Exif.Image.Artist'] = 'Adam'
+        self.assertTrue('Exif.Image.Artist' in metadata.exif_key_set())
+        self.assertTrue(sync_value_to_iptc('USA', metadata,
+                                           'Iptc.Application2.CountryName'))
+        self.assertTrue('Iptc.Application2.CountryName' in
+                        metadata.iptc_key_set())
+        _del_img_key(metadata, 'Exif.Image.Artist')
+        self.assertFalse('Exif.Image.Artist' in metadata.exif_key_set())
+        metadata['Exif.Image.Artist'] = 'Adam'
+        self.assertFalse('Exif.Image.Artist' in
+                         ImageMetadata(file_path).exifKeys())
+        self.assertTrue(metadata.flush())
+        self.assertFalse(metadata.flush())
+
+        metadata = ImageMetadata(file_path)
+        self.assertEqual(metadata['Exif.Image.Artist'], 'Adam')
+        self.assertEqual(metadata['Iptc.Application2.CountryName'], 'USA')
+
+        os.remove(file_path)
+        file_descriptor, file_path = tempfile.mkstemp(suffix='.pcx')
+        os.close(file_descriptor)
+        Image.new('RGB', (1, 1)).save(file_path, 'PCX')
+        self.assertRaises(IOError, ImageMetadata, file_path)
+        os.remove(file_path)
+
+    def test_record_sync(self):
+        class Record(object):
+            description = 'Test file'
+            city = ''
+            width = 1
+
+        mappings = (
+            ExifAndIptcMapping('description', 'Exif.Image.ImageDescription',
+                               'Iptc.Application2.Caption'),
+            IptcMapping('city', 'Iptc.Application2.City'),
+            ExifMapping('width', lambda record: 'Exif.Photo.PixelXDimension',
+                        from_file=False),
+        )
+
+        file_descriptor, file_path = tempfile.mkstemp(suffix='.jpg')
+        os.close(file_descriptor)
+        Image.new('RGB', (1, 1)).save(file_path, 'JPEG')
+        metadata = ImageMetadata(file_path)
+
+        record = Record()
+        self.assertEqual(diff_record_with_file(record, metadata, mappings),
+                         {'description': ''})
+        self.assertEqual(sync_record_to_file(record, metadata, mappings),
+                         {'description': 'Test file', 'width': 1})
+        self.assertEqual(sync_record_to_file(record, metadata, mappings), {})
+        self.assertEqual(diff_record_with_file(record, metadata, mappings),
+                         {})
+
+        metadata['Iptc.Application2.City'] = 'Blacksburg'
+        self.assertEqual(diff_record_with_file(record, metadata, mappings),
+                         {'city': 'Blacksburg'})
+
+        os.remove(file_path)
+
     def test_is_iter(self):
         self.assertTrue(_is_iter(set()))
         self.assertFalse(_is_iter("Test string."))
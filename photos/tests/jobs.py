@@ -0,0 +1,137 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.images import ImageFile
+from django.test import TestCase, TransactionTestCase
+from PIL import Image
+
+from photasm.photos.jobs import (
+    enqueue, process_jobs, requeue_failed_jobs, run_job)
+from photasm.photos.models import Album, Photo, PhotoJob
+from photasm.photos.parallel import ProcessPool
+
+
+class PhotoJobTest(TestCase):
+
+    def setUp(self):
+        image_fd, image_path = tempfile.mkstemp(suffix='.jpg')
+        os.close(image_fd)
+        Image.new('RGB', (640, 480)).save(image_path, 'JPEG')
+
+        user = User.objects.create(username="Adam")
+        album = Album.objects.create(owner=user, name="Test")
+        self.photo = Photo()
+        self.photo.owner = user
+        self.photo.album = album
+        image = open(image_path)
+        self.photo.image = ImageFile(image)
+        self.photo.is_jpeg = True
+        self.photo.save()
+        image.close()
+        os.remove(image_path)
+
+    def tearDown(self):
+        if hasattr(settings, 'PHOTO_JOB_MAX_ATTEMPTS'):
+            del settings.PHOTO_JOB_MAX_ATTEMPTS
+        User.objects.all().delete()
+        Album.objects.all().delete()
+        PhotoJob.objects.all().delete()
+        Photo.objects.all().delete()
+
+    def test_run(self):
+        job = enqueue(self.photo, 'thumbnail', 'metadata_from_file')
+        self.assertEqual(job.task_list, ['thumbnail', 'metadata_from_file'])
+        self.assertEqual(Photo.objects.get(pk=self.photo.pk).processing_status,
+                         'pending')
+
+        self.assertTrue(run_job(job.pk))
+        # A job that has already run cannot be claimed again.
+        self.assertEqual(run_job(job.pk), None)
+
+        job = PhotoJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, 'ready')
+        self.assertEqual(job.attempts, 1)
+        photo = Photo.objects.get(pk=self.photo.pk)
+        self.assertEqual(photo.processing_status, 'ready')
+        self.assertTrue(photo.thumbnail)
+
+    def test_unknown_task(self):
+        self.assertRaises(ValueError, enqueue, self.photo, 'foo')
+
+    def test_retry(self):
+        settings.PHOTO_JOB_MAX_ATTEMPTS = 2
+        os.remove(self.photo.image.path)
+        job = enqueue(self.photo, 'thumbnail')
+
+        self.assertEqual(process_jobs(), (0, 1))
+        job = PhotoJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, 'pending')
+        self.assertTrue(job.last_error)
+
+        self.assertEqual(process_jobs(), (0, 1))
+        job = PhotoJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(Photo.objects.get(pk=self.photo.pk).processing_status,
+                         'failed')
+
+        self.assertEqual(process_jobs(), (0, 0))
+
+        # Failed jobs can be queued again from the start.
+        self.assertEqual(requeue_failed_jobs(album_ids=[0]), 0)
+        self.assertEqual(
+            requeue_failed_jobs(album_ids=[self.photo.album_id]), 1)
+        job = PhotoJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, 'pending')
+        self.assertEqual(job.attempts, 0)
+        self.assertEqual(Photo.objects.get(pk=self.photo.pk).processing_status,
+                         'pending')
+
+
+def _square(value):
+    return value * value
+
+
+# The worker processes open their own database connections, so they only
+# see committed data.
+class ProcessPoolTest(TransactionTestCase):
+
+    def tearDown(self):
+        User.objects.all().delete()
+        Album.objects.all().delete()
+        PhotoJob.objects.all().delete()
+        Photo.objects.all().delete()
+
+    def test_map(self):
+        pool = ProcessPool(2)
+        try:
+            self.assertEqual(pool.map(_square, range(5)), [0, 1, 4, 9, 16])
+        finally:
+            pool.close()
+
+    def test_process_jobs(self):
+        if settings.DATABASE_NAME == ':memory:':
+            # Forked workers get a copy of an in-memory database rather than
+            # sharing it.
+            return
+
+        user = User.objects.create(username="Adam")
+        album = Album.objects.create(owner=user, name="Test")
+        for i in range(3):
+            image_fd, image_path = tempfile.mkstemp(suffix='.jpg')
+            os.close(image_fd)
+            Image.new('RGB', (640, 480)).save(image_path, 'JPEG')
+            photo = Photo(owner=user, album=album, is_jpeg=True)
+            image = open(image_path)
+            photo.image = ImageFile(image)
+            photo.save()
+            image.close()
+            os.remove(image_path)
+            enqueue(photo, 'thumbnail')
+
+        self.assertEqual(process_jobs(processes=2), (3, 0))
+        for photo in Photo.objects.all():
+            self.assertEqual(photo.processing_status, 'ready')
+            self.assertTrue(photo.thumbnail)
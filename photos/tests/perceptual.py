@@ -0,0 +1,163 @@
+import os
+from StringIO import StringIO
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.images import ImageFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from PIL import Image, ImageDraw
+
+from photasm.photos.models import Album, Photo
+from photasm.photos.perceptual import (
+    DEFAULT_MAX_DISTANCE,
+    MAX_DISTANCE,
+    dhash,
+    get_band_neighbors,
+    hamming_distance,
+)
+
+
+def _make_image(size=(640, 480)):
+    image = Image.new('RGB', size, (40, 40, 40))
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    draw.rectangle((0, 0, width // 3, height // 2), fill=(220, 220, 220))
+    draw.ellipse((width // 2, height // 3, width - 1, height - 1),
+                 fill=(120, 180, 60))
+    draw.rectangle((width // 4, height * 2 // 3, width // 2, height - 1),
+                   fill=(250, 40, 40))
+    return image
+
+
+class PerceptualHashTest(TestCase):
+
+    def test_dhash(self):
+        image = _make_image()
+        value = dhash(image)
+
+        # Resizing and recompressing changes the hash little.
+        data = StringIO()
+        image.resize((320, 240), Image.ANTIALIAS).save(data, 'JPEG',
+                                                       quality=40)
+        data.seek(0)
+        self.assertTrue(hamming_distance(value, dhash(Image.open(data))) <=
+                        DEFAULT_MAX_DISTANCE)
+
+        # A different image has a distant hash.
+        other = image.transpose(Image.FLIP_LEFT_RIGHT)
+        self.assertTrue(hamming_distance(value, dhash(other)) >
+                        DEFAULT_MAX_DISTANCE)
+
+    def test_band_neighbors(self):
+        self.assertEqual(get_band_neighbors(5, 0), [5])
+        for radius, count in ((1, 17), (2, 137)):
+            neighbors = get_band_neighbors(5, radius)
+            self.assertEqual(len(set(neighbors)), count)
+            for neighbor in neighbors:
+                self.assertTrue(hamming_distance(5, neighbor) <= radius)
+
+
+class FindSimilarTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('adam', 'adam@example.com',
+                                             'adampassword')
+        self.album = Album.objects.create(owner=self.user, name='Test')
+
+    def tearDown(self):
+        User.objects.all().delete()
+        Album.objects.all().delete()
+        Photo.objects.all().delete()
+
+    def create_photo(self, value):
+        photo = Photo(owner=self.user, album=self.album, image='test.jpg',
+                      image_width=640, image_height=480)
+        photo.set_perceptual_hash(value)
+        photo.save()
+        return photo
+
+    def test_find_similar(self):
+        base = 0x0123456789abcdef
+        base_photo = self.create_photo(base)
+        # Three bits apart, all in one band.
+        near = self.create_photo(base ^ 0x7)
+        # Eight bits apart, two in each band, so no band matches exactly.
+        spread = self.create_photo(base ^ 0x0003000300030003)
+        far = self.create_photo(base ^ 0xffffffff)
+        Photo(owner=self.user, album=self.album, image='test.jpg',
+              image_width=640, image_height=480).save()
+
+        similar = Photo.objects.find_similar(
+            base_photo.perceptual_hash, 3,
+            Photo.objects.exclude(pk=base_photo.pk))
+        self.assertEqual([(distance, photo.id) for distance, photo in similar],
+                         [(3, near.id)])
+
+        similar = Photo.objects.find_similar(base_photo.perceptual_hash, 8)
+        self.assertEqual([distance for distance, photo in similar],
+                         [0, 3, 8])
+        self.assertEqual(similar[2][1].id, spread.id)
+        self.assertFalse(far.id in [photo.id for distance, photo in similar])
+
+    def test_max_distance(self):
+        base = 0x0123456789abcdef
+        base_photo = self.create_photo(base)
+        # Four bits apart in three bands and three in the last one.
+        near = self.create_photo(base ^ 0x000f000f000f0007)
+        far = self.create_photo(base ^ 0x001f001f001f001f)
+
+        similar = Photo.objects.find_similar(
+            base_photo.perceptual_hash, MAX_DISTANCE,
+            Photo.objects.exclude(pk=base_photo.pk))
+        self.assertEqual([(distance, photo.id) for distance, photo in similar],
+                         [(MAX_DISTANCE, near.id)])
+
+    def test_thumbnail_hash(self):
+        image_fd, image_path = tempfile.mkstemp(suffix='.jpg')
+        os.close(image_fd)
+        _make_image().save(image_path, 'JPEG')
+        photo = Photo(owner=self.user, album=self.album, is_jpeg=True)
+        image = open(image_path, 'rb')
+        photo.image = ImageFile(image)
+        photo.save()
+        image.close()
+        os.remove(image_path)
+
+        photo.create_thumbnail()
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(len(photo.perceptual_hash), 16)
+        perceptual_hash = photo.perceptual_hash
+
+        # A corrupt thumbnail is reported without stopping the run.
+        data = open(photo.thumbnail.path, 'rb').read()
+        corrupt = Photo(owner=self.user, album=self.album, image='test.jpg',
+                        image_width=640, image_height=480)
+        corrupt.thumbnail = default_storage.save(
+            'thumbs/corrupt.jpg', ContentFile(data[:len(data) // 2]))
+        corrupt.save()
+
+        # The command fills in missing hashes.
+        Photo.objects.update(perceptual_hash='', phash_band0=None,
+                             phash_band1=None, phash_band2=None,
+                             phash_band3=None)
+        call_command('find_similar_photos', index=True, processes=1,
+                     verbosity=0)
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(photo.perceptual_hash, perceptual_hash)
+        self.assertEqual(Photo.objects.get(pk=corrupt.pk).perceptual_hash,
+                         '')
+        default_storage.delete(corrupt.thumbnail.name)
+
+        duplicate = self.create_photo(int(perceptual_hash, 16) ^ 0x1)
+        self.client.login(username='adam', password='adampassword')
+        response = self.client.get(reverse('similar_photos',
+                                           args=[photo.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(distance, similar_photo.id) for
+                          distance, similar_photo in
+                          response.context['similar']],
+                         [(1, duplicate.id)])
@@ -1,14 +1,23 @@
 import datetime
 import os
+import shutil
 import tempfile
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.files.base import File
 from django.core.files.images import ImageFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
 from django.test import TestCase
 from PIL import Image
 import pyexiv2
 
-from photasm.photos.models import Album, Photo, PhotoTag
+from photasm.photos.image_files import hash_file
+from photasm.photos.indexes import create_indexes
+from photasm.photos.jobs import enqueue_processing, process_jobs
+from photasm.photos.models import Album, Photo, PhotoTag, Rendition
+from photasm.photos.storage import get_content_name
 
 
 class KeywordsTest(TestCase):
@@ -84,6 +93,74 @@ class KeywordsTest(TestCase):
         photo.save()
         self.assertEqual(photo.keyword_list, [])
 
+    def test_attach_keyword_lists(self):
+        owner = User.objects.create(username='Adam')
+        album = Album.objects.create(name='test', owner=owner)
+        for keyword_list in (['test', 'photo'], [], ['photo']):
+            photo = Photo()
+            photo.owner = owner
+            photo.album = album
+            image = open(self.file_path)
+            photo.image = ImageFile(image)
+            photo.save()
+            image.close()
+            photo.keyword_list = keyword_list
+
+        photos = Photo.objects.attach_keyword_lists(
+            Photo.objects.order_by('id'))
+        self.assertEqual([sorted(photo._keyword_list_cache)
+                          for photo in photos],
+                         [[u'photo', u'test'], [], [u'photo']])
+        self.assertEqual(photos[2].keyword_list, [u'photo'])
+
+    def test_set_many(self):
+        photo = Photo()
+        owner = User.objects.create(username='Adam')
+        album = Album.objects.create(name='test', owner=owner)
+        photo.owner = owner
+        photo.album = album
+        image = open(self.file_path)
+        photo.image = ImageFile(image)
+        photo.save()
+        image.close()
+        PhotoTag.objects.create(name="Test")
+
+        # Duplicates are matched case-insensitively.
+        photo.keyword_list = ['test', 'Photo', 'TEST', 'photo', 'new']
+        self.assertEqual(sorted(photo.keyword_list),
+                         [u'Photo', u'Test', u'new'])
+        self.assertEqual(PhotoTag.objects.count(), 3)
+
+        # Only the difference is applied.
+        photo.keyword_list = ['photo', 'other']
+        self.assertEqual(sorted(photo.keyword_list), [u'Photo', u'other'])
+        self.assertEqual(PhotoTag.objects.count(), 4)
+
+    def test_normalized_name(self):
+        tag = PhotoTag.objects.create(name="Test")
+        self.assertEqual(tag.normalized_name, u'test')
+        self.assertEqual(PhotoTag.objects.filter_names(['TEST', 'other']),
+                         {u'test': tag})
+
+        # Creating many tags skips names differing only by case.
+        PhotoTag.objects.create_many(['Photo', 'photo'])
+        self.assertEqual(
+            list(PhotoTag.objects.order_by('id').values_list(
+                'name', 'normalized_name')),
+            [(u'Test', u'test'), (u'Photo', u'photo')])
+
+        # Tags that already exist, e.g. created by a concurrent request, are
+        # skipped.
+        PhotoTag.objects.create_many(['TEST', 'new', 'PHOTO'])
+        self.assertEqual(
+            list(PhotoTag.objects.order_by('id').values_list(
+                'name', 'normalized_name')),
+            [(u'Test', u'test'), (u'Photo', u'photo'), (u'new', u'new')])
+
+    def test_create_photo_indexes(self):
+        call_command('create_photo_indexes', verbosity=0)
+        self.assertEqual(create_indexes(), [])
+
 
 class CreateThumbnailTest(TestCase):
 
@@ -198,6 +275,519 @@ class CreateThumbnailTest(TestCase):
         Photo.objects.all().delete()
 
 
+class CreateRenditionsTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="Adam")
+        self.album = Album.objects.create(owner=self.user, name="Test")
+
+    def tearDown(self):
+        User.objects.all().delete()
+        Album.objects.all().delete()
+        Rendition.objects.all().delete()
+        Photo.objects.all().delete()
+
+    def create_photo(self, size):
+        image_fd, image_path = tempfile.mkstemp(suffix='.jpg')
+        os.close(image_fd)
+        Image.new('RGB', size).save(image_path, 'JPEG')
+        photo = Photo()
+        photo.owner = self.user
+        photo.album = self.album
+        image = open(image_path)
+        photo.image = ImageFile(image)
+        photo.is_jpeg = True
+        photo.save()
+        image.close()
+        os.remove(image_path)
+        return photo
+
+    def test_create(self):
+        photo = self.create_photo((2000, 1500))
+        photo.create_thumbnail()
+
+        renditions = dict([(rendition.name, rendition)
+                           for rendition in photo.renditions.all()])
+        # Renditions larger than the original are not created.
+        self.assertEqual(sorted(renditions.keys()),
+                         ['detail', 'detail_2x', 'grid_2x', 'lightbox'])
+        self.assertEqual((renditions['detail'].width,
+                          renditions['detail'].height), (800, 600))
+        self.assertEqual(Image.open(renditions['detail'].image.path).size,
+                         (800, 600))
+        self.assertEqual(Image.open(renditions['grid_2x'].image.path).size,
+                         (320, 240))
+
+        urls = photo.rendition_urls
+        self.assertEqual(urls['detail'], renditions['detail'].url)
+        self.assertEqual(urls['lightbox_2x'], photo.image_url)
+
+        thumb = Image.open(photo.thumbnail.path)
+        self.assertEqual(thumb.size[0] * thumb.size[1], 19200)
+
+        # Creating the renditions again replaces the old ones. They may be
+        # stored under the same names, so their URLs depend on their
+        # contents.
+        self.assertEqual(renditions['detail'].image_hash,
+                         hash_file(renditions['detail'].image.path))
+        Image.new('RGB', (2000, 1500), 'white').save(photo.image.path,
+                                                      'JPEG')
+        photo.create_renditions()
+        self.assertEqual(photo.renditions.count(), 4)
+        self.assertNotEqual(photo.renditions.get(name='detail').url,
+                            urls['detail'])
+
+    def test_small_image(self):
+        photo = self.create_photo((80, 60))
+        self.assertEqual(photo.create_renditions(), [])
+        self.assertEqual(photo.renditions.count(), 0)
+        self.assertEqual(photo.rendition_urls['detail'], photo.image_url)
+
+
+class ReplaceImageTest(TestCase):
+
+    def runTest(self):
+        paths = []
+        for size in ((2000, 1500), (640, 480)):
+            file_descriptor, file_path = tempfile.mkstemp(suffix='.jpg')
+            os.close(file_descriptor)
+            Image.new('RGB', size).save(file_path, 'JPEG')
+            paths.append(file_path)
+
+        user = User.objects.create(username="Adam")
+        album = Album.objects.create(owner=user, name="Test")
+        photo = Photo()
+        photo.owner = user
+        image = open(paths[0])
+        photo.image = ImageFile(image)
+        photo.album = album
+        photo.is_jpeg = True
+        self.assertFalse(photo.image_changed())
+        photo.save()
+        image.close()
+        photo.create_thumbnail()
+
+        old_image_path = photo.image.path
+        old_thumbnail_path = photo.thumbnail.path
+        old_rendition_paths = [rendition.image.path
+                               for rendition in photo.renditions.all()]
+        self.assertTrue(old_rendition_paths)
+
+        # Saving without changing the image keeps the files.
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertFalse(photo.image_changed())
+        photo.description = 'Test file'
+        photo.save()
+        self.assertTrue(os.path.exists(old_image_path))
+        self.assertTrue(os.path.exists(old_thumbnail_path))
+
+        # Replacing the image deletes the old files.
+        image = open(paths[1])
+        photo.image = ImageFile(image)
+        self.assertTrue(photo.image_changed())
+        photo.save()
+        image.close()
+        self.assertFalse(photo.image_changed())
+        self.assertFalse(os.path.exists(old_image_path))
+        self.assertFalse(os.path.exists(old_thumbnail_path))
+        for path in old_rendition_paths:
+            self.assertFalse(os.path.exists(path))
+        self.assertFalse(photo.thumbnail)
+        self.assertEqual(photo.renditions.count(), 0)
+
+        for path in paths:
+            os.remove(path)
+        User.objects.all().delete()
+        Album.objects.all().delete()
+        Photo.objects.all().delete()
+
+
+class AlbumSequenceTest(TestCase):
+
+    def create_photo(self, album):
+        return Photo.objects.create(owner=self.user, album=album,
+                                    image='photos/test.jpg', image_width=1,
+                                    image_height=1)
+
+    def get_sequences(self, album):
+        return list(Photo.objects.filter(album=album).order_by('id')
+                    .values_list('album_sequence', flat=True))
+
+    def runTest(self):
+        self.user = User.objects.create(username="Adam")
+        album = Album.objects.create(owner=self.user, name="Test")
+        other_album = Album.objects.create(owner=self.user, name="Other")
+
+        photos = [self.create_photo(album) for i in range(3)]
+        other_photo = self.create_photo(other_album)
+        album = Album.objects.get(pk=album.pk)
+        self.assertEqual(album.photo_count, 3)
+        self.assertEqual(self.get_sequences(album), [1, 2, 3])
+        self.assertEqual(photos[2].album_sequence, 3)
+        self.assertEqual(photos[1].get_album_position(), (2, 3))
+
+        # Moving a photo renumbers both albums.
+        photos[0].album = other_album
+        photos[0].save()
+        self.assertEqual(photos[0].album_sequence, 1)
+        self.assertEqual(self.get_sequences(album), [1, 2])
+        self.assertEqual(self.get_sequences(other_album), [1, 2])
+        self.assertEqual(Album.objects.get(pk=album.pk).photo_count, 2)
+        self.assertEqual(Album.objects.get(pk=other_album.pk).photo_count, 2)
+
+        # Saving without moving the photo changes nothing.
+        photos[0].description = 'Test'
+        photos[0].save()
+        self.assertEqual(Album.objects.get(pk=other_album.pk).photo_count, 2)
+
+        # Saving objects loaded before the values changed does not write
+        # the stale values back.
+        stale_album = Album.objects.get(pk=album.pk)
+        stale_photo = Photo.objects.get(pk=photos[2].pk)
+        added_photo = self.create_photo(album)
+        stale_album.name = 'Renamed'
+        stale_album.save()
+        self.assertEqual(Album.objects.get(pk=album.pk).photo_count, 3)
+        Photo.objects.get(pk=photos[1].pk).delete()
+        stale_photo.description = 'Test'
+        stale_photo.save()
+        self.assertEqual(self.get_sequences(album), [1, 2])
+
+        # Deleting a photo renumbers the photos after it, even if its
+        # position changed since it was loaded.
+        stale_photo.delete()
+        self.assertEqual(self.get_sequences(album), [1])
+        self.assertEqual(Photo.objects.get(pk=added_photo.pk).album_sequence,
+                         1)
+        self.assertEqual(Album.objects.get(pk=album.pk).photo_count, 1)
+
+        # Positions are counted rather than derived from the photo count,
+        # which photos added concurrently may have changed in between.
+        Album.objects.filter(pk=album.pk).update(photo_count=5)
+        concurrent_photo = self.create_photo(album)
+        self.assertEqual(concurrent_photo.album_sequence, 2)
+        self.assertEqual(self.get_sequences(album), [1, 2])
+        concurrent_photo.delete()
+
+        # The repair command recomputes damaged values.
+        Photo.objects.update(album_sequence=None)
+        Album.objects.update(photo_count=0)
+        call_command('repair_album_sequences', verbosity=0)
+        self.assertEqual(self.get_sequences(album), [1])
+        self.assertEqual(self.get_sequences(other_album), [1, 2])
+        self.assertEqual(Album.objects.get(pk=other_album.pk).photo_count, 2)
+        self.assertEqual(Photo.objects.get(pk=other_photo.pk).album_sequence,
+                         2)
+
+        User.objects.all().delete()
+        Album.objects.all().delete()
+        Photo.objects.all().delete()
+
+
+class FingerprintTest(TestCase):
+
+    def runTest(self):
+        file_descriptor, file_path = tempfile.mkstemp(suffix='.jpg')
+        os.close(file_descriptor)
+        Image.new('RGB', (1, 1)).save(file_path, 'JPEG')
+
+        user = User.objects.create(username="Adam")
+        album = Album.objects.create(owner=user, name="Test")
+        photo = Photo()
+        photo.owner = user
+        image = open(file_path)
+        photo.image = ImageFile(image)
+        photo.album = album
+        photo.is_jpeg = True
+        photo.save()
+        image.close()
+        os.remove(file_path)
+
+        # No fingerprint has been recorded yet.
+        self.assertFalse(photo.fingerprint_matches())
+        photo.description = 'Test file'
+        self.assertTrue(photo.sync_metadata_to_file())
+        self.assertTrue(photo.fingerprint_matches())
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(photo.file_size, os.path.getsize(photo.image.path))
+        self.assertTrue(photo.fingerprint_matches())
+
+        # The file is not read while it is unchanged.
+        photo.description = ''
+        self.assertFalse(photo.sync_metadata_from_file())
+        self.assertEqual(photo.description, '')
+        self.assertTrue(photo.sync_metadata_from_file(force=True))
+        self.assertEqual(photo.description, 'Test file')
+
+        # Changing the file invalidates the fingerprint.
+        metadata = pyexiv2.Image(photo.image.path)
+        metadata.readMetadata()
+        metadata['Exif.Image.ImageDescription'] = 'Image for testing'
+        metadata.writeMetadata()
+        self.assertFalse(photo.fingerprint_matches())
+        self.assertTrue(photo.sync_metadata_from_file())
+        self.assertEqual(photo.description, 'Image for testing')
+        self.assertTrue(photo.fingerprint_matches())
+
+        # The file was just modified, so its hash was recorded, and a change
+        # that keeps its size and modification time is still noticed.
+        self.assertTrue(photo.file_hash)
+        image = open(photo.image.path, 'r+b')
+        image.seek(-1, 2)
+        last_byte = image.read(1)
+        image.seek(-1, 2)
+        image.write(chr(ord(last_byte) ^ 0xff))
+        image.close()
+        os.utime(photo.image.path, (photo.file_mtime, photo.file_mtime))
+        self.assertFalse(photo.fingerprint_matches())
+
+        User.objects.all().delete()
+        Album.objects.all().delete()
+        Photo.objects.all().delete()
+
+
+class ResyncMetadataTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="Adam")
+        self.album = Album.objects.create(owner=self.user, name="Test")
+
+    def tearDown(self):
+        User.objects.all().delete()
+        Album.objects.all().delete()
+        Photo.objects.all().delete()
+
+    def create_photo(self, description):
+        file_descriptor, file_path = tempfile.mkstemp(suffix='.jpg')
+        os.close(file_descriptor)
+        Image.new('RGB', (1, 1)).save(file_path, 'JPEG')
+        metadata = pyexiv2.Image(file_path)
+        metadata.readMetadata()
+        metadata['Exif.Image.ImageDescription'] = description
+        metadata.writeMetadata()
+
+        photo = Photo(owner=self.user, album=self.album, is_jpeg=True)
+        image = open(file_path)
+        photo.image = ImageFile(image)
+        photo.save()
+        image.close()
+        os.remove(file_path)
+        return photo
+
+    def read_description(self, photo):
+        metadata = pyexiv2.Image(photo.image.path)
+        metadata.readMetadata()
+        return metadata['Exif.Image.ImageDescription']
+
+    def runTest(self):
+        first = self.create_photo('First file')
+        second = self.create_photo('Second file')
+        broken = self.create_photo('Broken file')
+        broken_file = open(broken.image.path, 'wb')
+        broken_file.write('not an image')
+        broken_file.close()
+        missing = self.create_photo('Missing file')
+        os.remove(missing.image.path)
+
+        # A file that cannot be read is reported without stopping the run.
+        # Only photos whose metadata cannot be read have metadata
+        # synchronization disabled; other failures are retried.
+        call_command('resync_metadata', processes=1, verbosity=0)
+        self.assertEqual(Photo.objects.get(pk=first.pk).description,
+                         'First file')
+        self.assertEqual(Photo.objects.get(pk=second.pk).description,
+                         'Second file')
+        self.assertFalse(
+            Photo.objects.get(pk=broken.pk).metadata_sync_enabled)
+        self.assertTrue(
+            Photo.objects.get(pk=missing.pk).metadata_sync_enabled)
+
+        Photo.objects.filter(pk=first.pk).update(description='Changed')
+        call_command('resync_metadata', direction='to', processes=1,
+                     verbosity=0)
+        self.assertEqual(self.read_description(first), 'Changed')
+        self.assertEqual(self.read_description(second), 'Second file')
+        self.assertTrue(Photo.objects.get(pk=first.pk).fingerprint_matches())
+
+
+class ImportPhotosTest(TestCase):
+
+    def runTest(self):
+        root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(root, 'nested'))
+        os.mkdir(os.path.join(root, '.hidden'))
+        first_path = os.path.join(root, 'first.jpg')
+        Image.new('RGB', (640, 480)).save(first_path, 'JPEG')
+        Image.new('RGB', (320, 240)).save(
+            os.path.join(root, 'nested', 'second.data'), 'TIFF')
+        shutil.copy(first_path, os.path.join(root, 'nested', 'copy.jpg'))
+        shutil.copy(first_path, os.path.join(root, '.hidden', 'third.jpg'))
+        notes = open(os.path.join(root, 'notes.jpg'), 'w')
+        notes.write('not an image')
+        notes.close()
+
+        user = User.objects.create(username="Adam")
+        album = Album.objects.create(owner=user, name="Test")
+        call_command('import_photos', str(album.id), root, processes=1,
+                     verbosity=0)
+
+        # Images are found by their contents and duplicates are skipped.
+        photos = Photo.objects.filter(album=album).order_by('id')
+        self.assertEqual([(photo.image_width, photo.is_jpeg)
+                          for photo in photos], [(640, True), (320, False)])
+        for photo in photos:
+            self.assertEqual(photo.content_hash, hash_file(photo.image.path))
+            self.assertTrue(photo.thumbnail)
+        self.assertEqual(Album.objects.get(pk=album.pk).photo_count, 2)
+
+        # Importing again skips the files already imported.
+        call_command('import_photos', str(album.id), root, processes=1,
+                     verbosity=0)
+        self.assertEqual(Photo.objects.filter(album=album).count(), 2)
+
+        shutil.rmtree(root)
+        User.objects.all().delete()
+        Album.objects.all().delete()
+        Photo.objects.all().delete()
+
+
+class ContentAddressedStorageTest(TestCase):
+
+    def setUp(self):
+        settings.PHOTO_CONTENT_ADDRESSED_STORAGE = True
+        image_fd, self.image_path = tempfile.mkstemp(suffix='.tif')
+        os.close(image_fd)
+        Image.new('RGB', (640, 480)).save(self.image_path, 'TIFF')
+        metadata = pyexiv2.Image(self.image_path)
+        metadata.readMetadata()
+        metadata['Exif.Image.ImageDescription'] = 'test image'
+        metadata.writeMetadata()
+
+    def tearDown(self):
+        del settings.PHOTO_CONTENT_ADDRESSED_STORAGE
+        os.remove(self.image_path)
+        User.objects.all().delete()
+        Album.objects.all().delete()
+        Photo.objects.all().delete()
+
+    def create_photo(self, album, path):
+        image_file = File(open(path, 'rb'))
+        try:
+            return Photo.objects.create_from_file(album.owner, album,
+                                                  image_file, 'TIFF')
+        finally:
+            image_file.close()
+
+    def runTest(self):
+        user = User.objects.create(username="Adam")
+        album = Album.objects.create(owner=user, name="Test")
+        other_album = Album.objects.create(owner=user, name="Other")
+        content_hash = hash_file(self.image_path)
+        name = get_content_name(content_hash, self.image_path)
+
+        first = self.create_photo(album, self.image_path)
+        self.assertEqual(first.content_hash, content_hash)
+        self.assertEqual(first.image.name, name)
+        self.assertEqual(enqueue_processing(first).task_list,
+                         ['thumbnail', 'metadata_from_file'])
+        self.assertEqual(process_jobs(), (1, 0))
+        first = Photo.objects.get(pk=first.pk)
+        self.assertEqual(first.description, 'test image')
+
+        # A duplicate shares the stored file, thumbnail and metadata.
+        second = self.create_photo(other_album, self.image_path)
+        self.assertEqual(second.image.name, name)
+        self.assertEqual((second.image_width, second.image_height),
+                         (640, 480))
+        self.assertEqual(enqueue_processing(second), None)
+        second = Photo.objects.get(pk=second.pk)
+        self.assertEqual(second.thumbnail.name, first.thumbnail.name)
+        self.assertEqual(second.description, 'test image')
+        self.assertEqual(
+            sorted(second.renditions.values_list('image', flat=True)),
+            sorted(first.renditions.values_list('image', flat=True)))
+
+        # Writing metadata gives the photo a copy of its own.
+        second.description = 'changed'
+        self.assertTrue(second.sync_metadata_to_file())
+        second = Photo.objects.get(pk=second.pk)
+        self.assertNotEqual(second.image.name, name)
+        self.assertEqual(hash_file(first.image.path), content_hash)
+        metadata = pyexiv2.Image(second.image.path)
+        metadata.readMetadata()
+        self.assertEqual(metadata['Exif.Image.ImageDescription'], 'changed')
+
+        # Shared files are only deleted once nothing uses them.
+        other_fd, other_path = tempfile.mkstemp(suffix='.tif')
+        os.close(other_fd)
+        Image.new('RGB', (320, 240)).save(other_path, 'TIFF')
+        image = open(other_path, 'rb')
+        first.image = ImageFile(image)
+        first.save()
+        image.close()
+        os.remove(other_path)
+        self.assertFalse(default_storage.exists(name))
+        self.assertTrue(default_storage.exists(second.thumbnail.name))
+
+
+class SharedJpegThumbnailTest(ContentAddressedStorageTest):
+
+    def runTest(self):
+        user = User.objects.create(username="Adam")
+        album = Album.objects.create(owner=user, name="Test")
+        image_fd, image_path = tempfile.mkstemp(suffix='.jpg')
+        os.close(image_fd)
+        Image.new('RGB', (640, 480)).save(image_path, 'JPEG')
+        content_hash = hash_file(image_path)
+        name = get_content_name(content_hash, image_path)
+
+        # No thumbnail is embedded into a JPEG shared by duplicates.
+        photos = []
+        for i in range(2):
+            image_file = File(open(image_path, 'rb'))
+            photos.append(Photo.objects.create_from_file(
+                user, album, image_file, 'JPEG'))
+            image_file.close()
+            enqueue_processing(photos[-1])
+        os.remove(image_path)
+        self.assertEqual(process_jobs(), (2, 0))
+        for photo in Photo.objects.filter(album=album):
+            self.assertEqual(photo.image.name, name)
+            self.assertTrue(photo.thumbnail)
+        self.assertEqual(hash_file(default_storage.path(name)),
+                         content_hash)
+
+
+class ResyncSharedImageTest(ContentAddressedStorageTest):
+
+    def runTest(self):
+        user = User.objects.create(username="Adam")
+        album = Album.objects.create(owner=user, name="Test")
+        content_hash = hash_file(self.image_path)
+        name = get_content_name(content_hash, self.image_path)
+
+        first = self.create_photo(album, self.image_path)
+        enqueue_processing(first)
+        process_jobs()
+        second = self.create_photo(album, self.image_path)
+        enqueue_processing(second)
+        self.assertEqual(second.image.name, name)
+
+        # Writing metadata in bulk leaves the shared file unchanged.
+        Photo.objects.filter(pk=second.pk).update(description='changed')
+        call_command('resync_metadata', direction='to', processes=1,
+                     verbosity=0)
+        first = Photo.objects.get(pk=first.pk)
+        second = Photo.objects.get(pk=second.pk)
+        self.assertEqual(first.image.name, name)
+        self.assertEqual(hash_file(first.image.path), content_hash)
+        self.assertNotEqual(second.image.name, name)
+        metadata = pyexiv2.Image(second.image.path)
+        metadata.readMetadata()
+        self.assertEqual(metadata['Exif.Image.ImageDescription'], 'changed')
+        self.assertTrue(second.fingerprint_matches())
+
+
 class SyncMetadataToFileTest(TestCase):
 
     def runTest(self):
@@ -1,15 +1,18 @@
 import datetime
 import os
 import tempfile
+import zipfile
 
 from django.contrib.auth.models import User
 from django.core.files.images import ImageFile
 from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.utils import simplejson
 from PIL import Image
 import pyexiv2
 
-from photasm.photos.models import Album, Photo, PhotoTag
+from photasm.photos.jobs import process_jobs
+from photasm.photos.models import Album, Photo, PhotoTag, UploadSession
 
 
 class AddPhotoTest(TestCase):
@@ -67,6 +70,12 @@ class AddPhotoTest(TestCase):
             "object_id": photo.id,
         })
         self.assertRedirects(response, photo_url)
+        # Processing is queued rather than done during the request.
+        self.assertEqual(photo.processing_status, 'pending')
+        self.assertFalse(photo.thumbnail)
+        self.assertEqual(process_jobs(), (1, 0))
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(photo.processing_status, 'ready')
         # Photo has already been synced
         self.assertFalse(photo.sync_metadata_from_file())
         self.assertEqual(photo.description, 'test image')
@@ -85,6 +94,94 @@ class AddPhotoTest(TestCase):
         image.close()
         self.assertEqual(response.status_code, 404)
 
+    def test_resumable_upload(self):
+        data = open(self.image_path, 'rb').read()
+        size = len(data)
+        half = size // 2
+
+        url = reverse('upload_initiate', args=[self.album.id])
+        response = self.client.post(url, {'filename': 'test' +
+                                          self.file_suffix, 'size': size})
+        self.assertEqual(response.status_code, 201)
+        state = simplejson.loads(response.content)
+        self.assertEqual(state['offset'], 0)
+        session_url = state['url']
+
+        response = self.client.put(
+            session_url, data[:half], content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE='bytes 0-%d/%d' % (half - 1, size))
+        self.assertEqual(simplejson.loads(response.content)['offset'], half)
+
+        # Finalizing before all chunks are received fails.
+        finalize_url = reverse('upload_finalize', args=[state['token']])
+        response = self.client.post(finalize_url)
+        self.assertEqual(response.status_code, 409)
+
+        # Resending a chunk that was already received is a conflict.
+        response = self.client.put(
+            session_url, data[:half], content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE='bytes 0-%d/%d' % (half - 1, size))
+        self.assertEqual(response.status_code, 409)
+
+        # The upload resumes from the offset reported.
+        response = self.client.get(session_url)
+        offset = simplejson.loads(response.content)['offset']
+        response = self.client.put(
+            session_url, data[offset:],
+            content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE='bytes %d-%d/%d' % (offset, size - 1, size))
+        self.assertEqual(simplejson.loads(response.content)['offset'], size)
+
+        response = self.client.post(finalize_url)
+        self.assertEqual(response.status_code, 201)
+        photo = Photo.objects.get(pk=simplejson.loads(response.content)['id'])
+        self.assertEqual(photo.album, self.album)
+        self.assertEqual(photo.is_jpeg, self.is_jpeg)
+        self.assertEqual((photo.image_width, photo.image_height), (640, 480))
+        self.assertEqual(open(photo.image.path, 'rb').read(), data)
+        self.assertEqual(UploadSession.objects.count(), 0)
+        self.assertEqual(process_jobs(), (1, 0))
+        photo = Photo.objects.get(pk=photo.pk)
+        self.assertEqual(photo.description, 'test image')
+
+    def test_batch_upload(self):
+        zip_fd, zip_path = tempfile.mkstemp(suffix='.zip')
+        os.close(zip_fd)
+        archive = zipfile.ZipFile(zip_path, 'w')
+        archive.write(self.image_path, 'first' + self.file_suffix)
+        archive.write(self.image_path, 'folder/second' + self.file_suffix)
+        archive.writestr('notes.txt', 'not an image')
+        archive.close()
+
+        url = reverse('photo_batch_upload', args=[self.album.id])
+        image = open(self.image_path, 'rb')
+        zip_file = open(zip_path, 'rb')
+        response = self.client.post(url, {'images': [image, zip_file]},
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        image.close()
+        zip_file.close()
+        os.remove(zip_path)
+
+        self.assertEqual(response.status_code, 200)
+        results = simplejson.loads(response.content)
+        self.assertEqual([result['name'] for result in results], [
+            os.path.basename(self.image_path), 'first' + self.file_suffix,
+            'second' + self.file_suffix, 'notes.txt'])
+        self.assertEqual([result['id'] is None for result in results],
+                         [False, False, False, True])
+
+        album = Album.objects.get(pk=self.album.pk)
+        self.assertEqual(album.photo_count, 3)
+        self.assertEqual(process_jobs(album_ids=[album.id]),
+                         (3, 0))
+        for photo in Photo.objects.filter(album=album):
+            self.assertEqual(photo.is_jpeg, self.is_jpeg)
+            self.assertEqual(photo.description, 'test image')
+            self.assertTrue(photo.thumbnail)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
     def test_admin_form(self):
         photo_upload_url = '/admin/photos/photo/add/'
 
@@ -97,6 +194,7 @@ class AddPhotoTest(TestCase):
             'metadata_sync_enabled': True,
         })
         image.close()
+        self.assertEqual(process_jobs(), (1, 0))
         photos = Photo.objects.order_by('-id')
         self.assertTrue(len(photos))
         photo = photos[0]
@@ -219,6 +317,7 @@ class EditPhotoTest(TestCase):
             '_save': 'Save',
         }
         response = self.client.post(photo_edit_url, post_data)
+        self.assertEqual(process_jobs(), (1, 0))
         self.photo = Photo.objects.get(id=self.photo.id)
         self.assertEqual(response.status_code, 302)
         self.assertFalse(self.photo.sync_metadata_to_file())
@@ -269,6 +368,22 @@ class PhotoDetailTest(TestCase):
         response = self.client.get(photo_detail_url)
         self.assertEqual(response.status_code, 200)
 
+    def test_private_album(self):
+        self.client.logout()
+        url = reverse('photo_detail', args=[self.photo.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # Neither the cached page nor the validators outlive the access.
+        album = Album.objects.get(pk=self.photo.album_id)
+        album.is_public = False
+        album.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 404)
+
     def test_photo_in_album(self):
         view = 'photo_in_album'
 
@@ -277,3 +392,17 @@ class PhotoDetailTest(TestCase):
         })
         response = self.client.get(view_url)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['photo_index'], 1)
+        self.assertEqual(response.context['photo_count'], 1)
+        self.assertEqual(response.context['previous_id'], None)
+        self.assertEqual(response.context['next_id'], None)
+
+        second_photo = Photo.objects.create(
+            owner=self.photo.owner, album=self.photo.album,
+            image=self.photo.image.name, image_width=self.photo.image_width,
+            image_height=self.photo.image_height)
+        self.assertEqual(second_photo.get_album_position(), (2, 2))
+        self.assertEqual(second_photo.get_album_neighbors(),
+                         (self.photo.id, None))
+        self.assertEqual(self.photo.get_album_neighbors(),
+                         (None, second_photo.id))
@@ -0,0 +1,58 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.test import TestCase
+from PIL import Image
+
+from photasm.photos.renditions import (
+    draft_for_downscale,
+    fits_within,
+    get_bounding_box,
+    get_rendition_format,
+)
+
+
+class RenditionsTest(TestCase):
+
+    def setUp(self):
+        image_fd, self.image_path = tempfile.mkstemp(suffix='.jpg')
+        os.close(image_fd)
+        Image.new('RGB', (4000, 3000)).save(self.image_path, 'JPEG')
+
+    def tearDown(self):
+        os.remove(self.image_path)
+        if hasattr(settings, 'PHOTO_DRAFT_OVERSAMPLE'):
+            del settings.PHOTO_DRAFT_OVERSAMPLE
+
+    def test_fits_within(self):
+        self.assertTrue(fits_within((800, 600), (800, 800)))
+        self.assertFalse(fits_within((801, 600), (800, 800)))
+
+    def test_get_bounding_box(self):
+        self.assertEqual(get_bounding_box([(320, 320), (160, 120)]),
+                         (320, 320))
+        self.assertEqual(get_bounding_box([(100, 300), (200, 50)]),
+                         (200, 300))
+
+    def test_get_rendition_format(self):
+        self.assertEqual(get_rendition_format(Image.new('RGB', (1, 1))),
+                         'JPEG')
+        self.assertEqual(get_rendition_format(Image.new('RGBA', (1, 1))),
+                         'PNG')
+
+    def test_draft_for_downscale(self):
+        settings.PHOTO_DRAFT_OVERSAMPLE = 1
+        image = draft_for_downscale(Image.open(self.image_path), (500, 500))
+        # Decoded at 1/4 scale, the largest reduction that is still at least
+        # as large as the requested size.
+        self.assertEqual(image.size, (1000, 750))
+        image.load()
+
+        settings.PHOTO_DRAFT_OVERSAMPLE = 2
+        image = draft_for_downscale(Image.open(self.image_path), (500, 500))
+        self.assertEqual(image.size, (2000, 1500))
+
+        settings.PHOTO_DRAFT_OVERSAMPLE = None
+        image = draft_for_downscale(Image.open(self.image_path), (500, 500))
+        self.assertEqual(image.size, (4000, 3000))
@@ -0,0 +1,50 @@
+import os
+from StringIO import StringIO
+
+from django.test import TestCase
+from PIL import Image
+
+from photasm.photos.image_files import sha1, sniff_image_format
+from photasm.photos.uploadhandler import (
+    StreamingImageUploadHandler,
+    get_image_format,
+)
+
+
+class StreamingUploadTest(TestCase):
+
+    def upload(self, data, chunk_size=1024):
+        handler = StreamingImageUploadHandler()
+        handler.new_file('image', 'test.jpg', 'image/jpeg', len(data))
+        for start in range(0, len(data), chunk_size):
+            handler.receive_data_chunk(data[start:start + chunk_size], start)
+        return handler.file_complete(len(data))
+
+    def test_sniff_image_format(self):
+        for format in ('JPEG', 'PNG', 'GIF', 'TIFF', 'BMP'):
+            buf = StringIO()
+            Image.new('RGB', (1, 1)).save(buf, format)
+            self.assertEqual(sniff_image_format(buf.getvalue()), format)
+        self.assertEqual(sniff_image_format('not an image'), None)
+
+    def test_upload(self):
+        buf = StringIO()
+        Image.new('RGB', (640, 480)).save(buf, 'JPEG')
+        data = buf.getvalue()
+
+        upload = self.upload(data)
+        path = upload.temporary_file_path()
+        self.assertEqual(upload.image_format, 'JPEG')
+        self.assertEqual(get_image_format(upload), 'JPEG')
+        self.assertEqual(upload.image_size, (640, 480))
+        self.assertEqual(upload.content_hash, sha1(data).hexdigest())
+        self.assertEqual(upload.size, len(data))
+        self.assertEqual(open(path, 'rb').read(), data)
+        upload.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_upload_not_image(self):
+        upload = self.upload('not an image' * 1000)
+        self.assertEqual(upload.image_format, None)
+        self.assertEqual(upload.image_size, None)
+        upload.close()
@@ -1,3 +1,4 @@
+import datetime
 import os
 import tempfile
 
@@ -5,9 +6,11 @@ from django.contrib.auth.models import User
 from django.core.files.images import ImageFile
 from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.utils import simplejson
 from PIL import Image
 
 from photasm.photos.models import Album, Photo
+from photasm.photos.pagination import decode_cursor, encode_cursor
 
 
 class ViewTest(TestCase):
@@ -50,12 +53,145 @@ class ViewTest(TestCase):
     def test_album(self):
         response = self.client.get(self.album.get_absolute_url())
         self.assertEqual(response.status_code, 200)
+        photo_list = response.context['photo_list']
+        self.assertEqual(len(photo_list), 1)
+        self.assertTrue('grid_2x' in photo_list[0].rendition_urls)
 
         url = reverse('album_detail', args=[0])
 
         response = self.client.get(url)
         self.assertEqual(response.status_code, 404)
 
+    def test_album_cache(self):
+        url = self.album.get_absolute_url()
+        response = self.client.get(url)
+        self.assertEqual(len(response.context['photo_list']), 1)
+
+        # The second request is answered from the cache.
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context, None)
+
+        # Adding a photo to the album invalidates the cached page.
+        photo = Photo.objects.get(album=self.album)
+        Photo.objects.create(owner=photo.owner, album=self.album,
+                             image=photo.image.name,
+                             image_width=photo.image_width,
+                             image_height=photo.image_height)
+        response = self.client.get(url)
+        self.assertEqual(len(response.context['photo_list']), 2)
+
+        # A page displaying messages is neither served from nor stored in
+        # the cache.
+        self.album.owner.message_set.create(message='Test message')
+        response = self.client.get(url)
+        self.assertContains(response, 'Test message')
+        response = self.client.get(url)
+        self.assertNotContains(response, 'Test message')
+
+    def test_conditional_get(self):
+        url = self.album.get_absolute_url()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag,
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+        # Pending messages are displayed even if the page is unchanged.
+        self.album.owner.message_set.create(message='Test message')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag,
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertContains(response, 'Test message')
+        self.assertFalse(response.has_header('ETag'))
+
+        # Changing the album changes the validators.
+        Album.objects.filter(pk=self.album.pk).update(
+            updated=datetime.datetime.now() + datetime.timedelta(days=1))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag,
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_media(self):
+        photo = Photo.objects.get(album=self.album)
+        url = photo.thumbnail_url
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, open(photo.thumbnail.path).read())
+        self.assertTrue('max-age' in response['Cache-Control'])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(len(response.content), 10)
+        self.assertTrue(response['Content-Range'].startswith('bytes 0-9/'))
+
+        response = self.client.get(url, HTTP_RANGE='bytes=100000000-')
+        self.assertEqual(response.status_code, 416)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"%s"' % (
+            photo.get_media_version('thumbnail'),))
+        self.assertEqual(response.status_code, 304)
+
+        # Outdated versions redirect to the current one.
+        outdated_url = url.replace(photo.get_media_version('thumbnail'),
+                                   '0' * 16)
+        response = self.client.get(outdated_url)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith(url))
+
+        # Photos in private albums are only served to their owner.
+        Album.objects.filter(pk=self.album.pk).update(is_public=False)
+        response = self.client.get(photo.image_url)
+        self.assertEqual(response.status_code, 200)
+        self.client.logout()
+        response = self.client.get(photo.image_url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_album_pages(self):
+        photo = Photo.objects.get(album=self.album)
+        second_photo = Photo.objects.create(owner=photo.owner,
+                                            album=self.album,
+                                            image=photo.image.name,
+                                            image_width=photo.image_width,
+                                            image_height=photo.image_height)
+        url = self.album.get_absolute_url()
+
+        response = self.client.get(url, {'per_page': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['photo_list']), [photo])
+        self.assertEqual(response.context['previous_query'], None)
+        next_cursor = response.context['page'].next_cursor()
+        self.assertEqual(decode_cursor(self.album.id, next_cursor), photo.id)
+
+        response = self.client.get(url, {'per_page': 1, 'after': next_cursor})
+        self.assertEqual(list(response.context['photo_list']),
+                         [second_photo])
+        self.assertEqual(response.context['next_query'], None)
+        previous_cursor = response.context['page'].previous_cursor()
+
+        response = self.client.get(url, {'per_page': 1,
+                                         'before': previous_cursor})
+        self.assertEqual(list(response.context['photo_list']), [photo])
+
+        response = self.client.get(url, {'after': 'invalid'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {
+            'after': encode_cursor(self.album.id + 1, photo.id),
+        })
+        self.assertEqual(response.status_code, 400)
+
+        json_url = reverse('album_photos', args=[self.album.id])
+        response = self.client.get(json_url, {'per_page': 1})
+        self.assertEqual(response.status_code, 200)
+        data = simplejson.loads(response.content)
+        self.assertEqual([item['id'] for item in data['photos']], [photo.id])
+        self.assertEqual(data['next'], next_cursor)
+        self.assertEqual(data['previous'], None)
+
 
 class CreateAlbumTest(TestCase):
 
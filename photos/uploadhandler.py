@@ -0,0 +1,246 @@
+import errno
+import os
+import re
+from StringIO import StringIO
+import tempfile
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from PIL import Image
+
+from photasm.photos.image_files import (
+    CHUNK_SIZE,
+    SIGNATURE_LENGTH,
+    sha1,
+    sniff_image_format,
+)
+
+
+UPLOAD_DIR = 'uploads'
+"""\
+Directory under MEDIA_ROOT that uploads are streamed into.
+
+Keeping uploads on the same filesystem as the stored images lets the storage
+move them into place instead of copying them.
+
+"""
+
+MAX_HEADER_SIZE = 256 * 1024
+"""\
+Most bytes buffered to read the dimensions of an uploaded image.
+
+The dimensions of JPEG images follow the Exif data, which may be up to 64 KB,
+and the embedded previews of some formats.
+
+"""
+
+
+def get_upload_dir():
+    """\
+    Returns the directory that uploads are streamed into, creating it if
+    needed.
+
+    """
+    directory = os.path.join(settings.MEDIA_ROOT, UPLOAD_DIR)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return directory
+
+
+class StreamedImageUpload(UploadedFile):
+    """\
+    An uploaded file written to disk as it was received.
+
+    Besides the usual UploadedFile attributes, this has the image_format
+    (the PIL name of the format, or None if the file is not a recognized
+    image), the image_size (the (width, height) of the image, or None if it
+    could not be read) and the content_hash (the SHA-1 hash of the file).
+
+    """
+
+    def __init__(self, name, content_type, charset):
+        file = tempfile.NamedTemporaryFile(suffix='.upload',
+                                           dir=get_upload_dir())
+        super(StreamedImageUpload, self).__init__(file, name, content_type,
+                                                  0, charset)
+        self.image_format = None
+        self.image_size = None
+        self.content_hash = None
+
+    def temporary_file_path(self):
+        """\
+        Returns the full path of the file, so that it is moved into place
+        rather than copied when it is saved.
+
+        """
+        return self.file.name
+
+    def close(self):
+        try:
+            return self.file.close()
+        except OSError as e:
+            # The file was moved into place.
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class StagedFile(File):
+    """\
+    A complete file in the upload directory, ready to be moved into the
+    storage.
+
+    """
+
+    def __init__(self, path, name):
+        super(StagedFile, self).__init__(open(path, 'rb'), name)
+        self.path = path
+
+    def temporary_file_path(self):
+        return self.path
+
+
+class StreamingImageUploadHandler(FileUploadHandler):
+    """\
+    Upload handler that writes uploaded files straight to disk.
+
+    Each chunk received is written to a file in the upload directory and
+    added to the hash of the file. The format of the image is sniffed from
+    its first bytes and its dimensions are read from its header, so the
+    upload is read exactly once and never held in memory; only a bounded
+    header is buffered.
+
+    Install it in a view before the request data is accessed, e.g.:
+        request.upload_handlers = [StreamingImageUploadHandler(request)]
+
+    """
+
+    def new_file(self, *args, **kwargs):
+        super(StreamingImageUploadHandler, self).new_file(*args, **kwargs)
+        self.upload = StreamedImageUpload(self.file_name, self.content_type,
+                                          self.charset)
+        self.hash = sha1()
+        self.header = StringIO()
+        self.header_done = False
+
+    def receive_data_chunk(self, raw_data, start):
+        self.upload.file.write(raw_data)
+        self.hash.update(raw_data)
+        if not self.header_done:
+            self.read_header(raw_data)
+        return None
+
+    def read_header(self, raw_data):
+        """\
+        Buffers the start of the file until its format and dimensions are
+        known.
+
+        """
+        self.header.write(raw_data[:MAX_HEADER_SIZE - self.header.tell()])
+        header = self.header.getvalue()
+        if len(header) < SIGNATURE_LENGTH:
+            return
+        if self.upload.image_format is None:
+            self.upload.image_format = sniff_image_format(header)
+            if self.upload.image_format is None:
+                self.header_done = True
+                return
+
+        # PIL only reads the header when opening an image.
+        try:
+            self.upload.image_size = Image.open(StringIO(header)).size
+        except (IOError, IndexError, SyntaxError, ValueError):
+            if len(header) >= MAX_HEADER_SIZE:
+                self.header_done = True
+        else:
+            self.header_done = True
+
+        if self.header_done:
+            self.header.close()
+
+    def file_complete(self, file_size):
+        self.upload.file.flush()
+        self.upload.file.seek(0)
+        self.upload.size = file_size
+        self.upload.content_hash = self.hash.hexdigest()
+        if not self.header_done:
+            self.header.close()
+        return self.upload
+
+
+def get_image_format(uploaded_file):
+    """\
+    Returns the PIL name of the format of an uploaded image, or None.
+
+    The format sniffed while the file was streamed is used if available;
+    otherwise only the first bytes of the file are read.
+
+    Parameters:
+    uploaded_file -- UploadedFile of the image
+
+    """
+    if hasattr(uploaded_file, 'image_format'):
+        return uploaded_file.image_format
+    uploaded_file.open()
+    uploaded_file.seek(0)
+    header = uploaded_file.read(SIGNATURE_LENGTH)
+    uploaded_file.seek(0)
+    return sniff_image_format(header)
+
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+def parse_content_range(header):
+    """\
+    Parses the value of an HTTP Content-Range header of a request.
+
+    Returns a (start, end, total) tuple of the first and last byte sent and
+    the size of the whole file. Raises ValueError if the header is missing
+    or invalid.
+
+    Parameters:
+    header -- value of the Content-Range header
+
+    """
+    match = CONTENT_RANGE_RE.match(header.strip())
+    if match is None:
+        raise ValueError("Invalid Content-Range '%s'." % (header,))
+    start, end, total = [int(value) for value in match.groups()]
+    if start > end or end >= total:
+        raise ValueError("Invalid Content-Range '%s'." % (header,))
+    return (start, end, total)
+
+
+def write_chunk(stream, path, offset, length):
+    """\
+    Copies part of a request body into a file, in constant memory.
+
+    Returns the number of bytes written, which is less than length if the
+    stream ended early.
+
+    Parameters:
+    stream -- file-like object to read from
+    path -- path of the file to write to, which must exist
+    offset -- position in the file to write at
+    length -- number of bytes to copy
+
+    """
+    remaining = length
+    f = open(path, 'r+b')
+    try:
+        f.seek(offset)
+        while remaining > 0:
+            chunk = stream.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            f.write(chunk)
+            remaining -= len(chunk)
+    finally:
+        f.close()
+    return length - remaining
@@ -1,41 +1,46 @@
 from django.conf.urls.defaults import patterns, url
 
-from photasm.photos.models import Photo, Album
-
-photo_info = {
-    'queryset': Photo.objects.all(),
-}
-
-album_info = {
-    'queryset': Album.objects.all(),
-}
-
 urlpatterns = patterns(
     'photasm.photos.views',
 
     url(r'^$', 'home', name='home'),
 
+    url(r'^albums/(?P<object_id>\d+)/$', 'album_detail',
+        name='album_detail'),
+
+    url(r'^albums/(?P<object_id>\d+)/photos/$', 'album_photos',
+        name='album_photos'),
+
+    url(r'^photos/(?P<object_id>\d+)/$', 'photo_detail', name='photo_detail'),
+
     url(r'^photos/(?P<object_id>\d+)/edit/$', 'photo_edit'),
 
+    url(r'^photos/(?P<object_id>\d+)/similar/$', 'similar_photos',
+        name='similar_photos'),
+
     url(r'^albums/photos/(?P<object_id>\d+)/$',
         'photo_in_album', name='photo_in_album'),
 
     url(r'^albums/(?P<album_id>\d+)/photos/upload/$', 'photo_upload'),
 
+    url(r'^albums/(?P<album_id>\d+)/photos/batch/$', 'photo_batch_upload',
+        name='photo_batch_upload'),
+
+    url(r'^albums/(?P<album_id>\d+)/uploads/$', 'upload_initiate',
+        name='upload_initiate'),
+
+    url(r'^uploads/(?P<token>[0-9a-f]+)/$', 'upload_session',
+        name='upload_session'),
+
+    url(r'^uploads/(?P<token>[0-9a-f]+)/finalize/$', 'upload_finalize',
+        name='upload_finalize'),
+
     url(r'^(?P<in_album>albums)/photos/(?P<object_id>\d+)/edit/$',
         'photo_edit', name='photo_edit_in_album'),
 
     url(r'^albums/new/$', 'new_album', name='new_album'),
-)
-
-urlpatterns += patterns(
-    'django.views.generic',
-
-    url(r'^photos/(?P<object_id>\d+)/$', 'list_detail.object_detail',
-        dict(photo_info, template_name="photos/photo_detail.html"),
-        "photo_detail"),
 
-    url(r'^albums/(?P<object_id>\d+)/$', 'list_detail.object_detail',
-        dict(album_info, template_name="photos/album_detail.html"),
-        "album_detail"),
+    url(r'^media/photos/(?P<object_id>\d+)/(?P<field_name>\w+)/'
+        r'(?P<version>[0-9a-f]+)/(?P<filename>[^/]+)$', 'photo_media',
+        name='photo_media'),
 )
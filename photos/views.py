@@ -1,40 +1,325 @@
+from datetime import datetime
+
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect, Http404
+from django.db.models import Count, Max, Q
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed,
+    HttpResponseRedirect)
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
-from PIL import Image
+from django.utils import simplejson
+from django.views.decorators.http import condition
 
+from photasm.photos.batch import import_files
+from photasm.photos.cache import (
+    cache_view, conditional_view, get_cache_timeout, get_version)
+from photasm.photos.image_files import SIGNATURE_LENGTH, sniff_image_format
+from photasm.photos.jobs import enqueue_processing
+from photasm.photos.media import make_version, serve_file
 from photasm.photos.models import (
-    Album, Photo, PhotoEditForm, PhotoUploadForm, AlbumCreationForm)
+    Album, Photo, PhotoEditForm, PhotoUploadForm, AlbumCreationForm,
+    Rendition, UploadSession)
+from photasm.photos.pagination import InvalidCursor, KeysetPage, get_page_size
+from photasm.photos.perceptual import DEFAULT_MAX_DISTANCE, MAX_DISTANCE
+from photasm.photos.uploadhandler import (
+    StagedFile, StreamingImageUploadHandler, get_image_format,
+    parse_content_range, write_chunk)
+
+
+def _json_response(data, status=200):
+    response = HttpResponse(simplejson.dumps(data),
+                            mimetype='application/json')
+    response.status_code = status
+    return response
+
+
+def _check_album_access(request, album):
+    """\
+    Raises Http404 unless the user may view the Album.
+
+    Albums that are not public may only be viewed by their owner.
+
+    """
+    if not (album.is_public or request.user.id == album.owner_id):
+        raise Http404
+
+
+def _owner_versions(request, *args, **kwargs):
+    return [('owner', request.user.id)]
+
+
+def _album_versions(request, object_id):
+    return [('album', object_id)]
+
+
+def _photo_versions(request, object_id):
+    album_ids = Photo.objects.filter(pk=object_id)\
+                             .values_list('album', flat=True)
+    if not album_ids:
+        return None
+    return [('photo', object_id), ('album', album_ids[0])]
+
+
+def _owner_state(request, *args, **kwargs):
+    state = Album.objects.filter(owner__id=request.user.id)\
+                         .aggregate(Max('updated'), Count('id'))
+    return [state['updated__max'], state['id__count']]
+
+
+def _album_state(request, object_id):
+    return list(Album.objects.filter(pk=object_id)
+                .values_list('updated', flat=True)) or None
+
+
+def _photo_state(request, object_id):
+    state = Photo.objects.filter(pk=object_id)\
+                         .values_list('updated', 'album__updated')
+    if not state:
+        return None
+    return list(state[0])
 
 
 @login_required
+@conditional_view(_owner_state)
+@cache_view(_owner_versions)
 def home(request):
     album_list = Album.objects.filter(owner__id=request.user.id)
     return render_to_response('photos/home.html', {'album_list': album_list})
 
 
+def _get_album_page(request, album):
+    """\
+    Returns the KeysetPage of an Album requested by the query string.
+
+    The after and before parameters hold cursor tokens and per_page the
+    requested page size. Raises InvalidCursor if a cursor is invalid.
+
+    """
+    photos = Photo.objects.filter(album__id=album.id).only(
+        'id', 'image', 'thumbnail', 'thumbnail_hash', 'file_hash',
+        'file_size', 'file_mtime', 'updated', 'processing_status')
+    page = KeysetPage(photos, album.id,
+                      get_page_size(request.GET.get('per_page')),
+                      after=request.GET.get('after'),
+                      before=request.GET.get('before'))
+    Photo.objects.attach_rendition_urls(page.object_list, ['grid_2x'])
+    return page
+
+
+def _get_page_query(request, name, cursor):
+    """\
+    Returns the query string for the page at a cursor.
+
+    Parameters other than the cursors, such as per_page, are preserved.
+
+    """
+    query = request.GET.copy()
+    for key in ('after', 'before'):
+        if key in query:
+            del query[key]
+    query[name] = cursor
+    return query.urlencode()
+
+
+@conditional_view(_album_state)
+@cache_view(_album_versions)
+def album_detail(request, object_id):
+    """\
+    Displays an Album and one page of thumbnails of its photographs.
+
+    The album and its owner are fetched together, and only the columns
+    needed to display the thumbnails are fetched for one page of the
+    photographs, so the page takes a fixed number of queries and a bounded
+    time regardless of the size of the album.
+
+    """
+    album = get_object_or_404(Album.objects.select_related('owner'),
+                              pk=object_id)
+    _check_album_access(request, album)
+    try:
+        page = _get_album_page(request, album)
+    except InvalidCursor:
+        return HttpResponseBadRequest("Invalid page cursor.")
+
+    next_query = previous_query = None
+    if page.has_next:
+        next_query = _get_page_query(request, 'after', page.next_cursor())
+    if page.has_previous:
+        previous_query = _get_page_query(request, 'before',
+                                         page.previous_cursor())
+    return render_to_response('photos/album_detail.html', {
+        'object': album,
+        'photo_list': page.object_list,
+        'page': page,
+        'is_paged': 'after' in request.GET or 'before' in request.GET,
+        'next_query': next_query,
+        'previous_query': previous_query,
+    }, context_instance=RequestContext(request))
+
+
+@conditional_view(_album_state)
+@cache_view(_album_versions)
+def album_photos(request, object_id):
+    """\
+    Returns one page of the photographs of an Album as JSON.
+
+    This takes the same parameters as album_detail and is meant for
+    scrolling through an album without reloading the page. The response
+    holds the photographs and the cursors of the neighbouring pages, which
+    are null at either end of the album.
+
+    """
+    album = get_object_or_404(Album, pk=object_id)
+    _check_album_access(request, album)
+    try:
+        page = _get_album_page(request, album)
+    except InvalidCursor:
+        return HttpResponseBadRequest("Invalid page cursor.")
+
+    photos = []
+    for photo in page.object_list:
+        thumbnail_url = None
+        if photo.thumbnail:
+            thumbnail_url = photo.thumbnail_url
+        photos.append({
+            'id': photo.id,
+            'url': reverse('photo_in_album', kwargs={'object_id': photo.id}),
+            'thumbnail': thumbnail_url,
+            'grid_2x': photo.rendition_urls['grid_2x'],
+            'processing_status': photo.processing_status,
+        })
+    data = {
+        'photos': photos,
+        'next': page.next_cursor(),
+        'previous': page.previous_cursor(),
+    }
+    return _json_response(data)
+
+
+@conditional_view(_photo_state)
+@cache_view(_photo_versions)
+def photo_detail(request, object_id):
+    photo = get_object_or_404(Photo.objects.select_related('owner', 'album'),
+                              pk=object_id)
+    _check_album_access(request, photo.album)
+    return render_to_response('photos/photo_detail.html', {
+        'object': photo,
+        'photo_version': get_version('photo', photo.id),
+        'cache_timeout': get_cache_timeout(),
+    }, context_instance=RequestContext(request))
+
+
+@conditional_view(_photo_state)
+@cache_view(_photo_versions)
 def photo_in_album(request, object_id):
-    photo = get_object_or_404(Photo, pk=object_id)
-    photos_in_album = Photo.objects.filter(album__id=photo.album.id)\
-                           .order_by('id').values_list('id', flat=True)
-    photo_count = len(photos_in_album)
-    photo_index = list(photos_in_album).index(int(object_id)) + 1
+    photo = get_object_or_404(Photo.objects.select_related('album__owner'),
+                              pk=object_id)
+    _check_album_access(request, photo.album)
+    photo_index, photo_count = photo.get_album_position()
+    previous_id, next_id = photo.get_album_neighbors()
     return render_to_response('photos/photo_in_album.html', {
         'object': photo,
+        'photo_version': get_version('photo', photo.id),
+        'cache_timeout': get_cache_timeout(),
         'photo_index': photo_index,
         'photo_count': photo_count,
+        'previous_id': previous_id,
+        'next_id': next_id,
     }, context_instance=RequestContext(request))
 
 
+def similar_photos(request, object_id):
+    """\
+    Lists the photographs that look like a Photo.
+
+    The photos whose perceptual hash is within the Hamming distance given by
+    the distance GET parameter are listed, nearest first, among the photos
+    the user may view. The response is JSON for Ajax requests.
+
+    """
+    photo = get_object_or_404(Photo.objects.select_related('album'),
+                              pk=object_id)
+    _check_album_access(request, photo.album)
+    try:
+        distance = int(request.GET.get('distance', DEFAULT_MAX_DISTANCE))
+    except ValueError:
+        distance = DEFAULT_MAX_DISTANCE
+    distance = max(0, min(distance, MAX_DISTANCE))
+
+    similar = []
+    if photo.perceptual_hash:
+        visible = Photo.objects.filter(
+            Q(album__is_public=True) | Q(album__owner__id=request.user.id),
+        ).exclude(pk=photo.id)
+        similar = Photo.objects.find_similar(photo.perceptual_hash, distance,
+                                             visible)
+
+    if request.is_ajax():
+        return _json_response([{
+            'id': similar_photo.id,
+            'distance': photo_distance,
+            'url': reverse('photo_in_album', kwargs={
+                'object_id': similar_photo.id,
+            }),
+            'thumbnail_url': similar_photo.thumbnail_url,
+        } for photo_distance, similar_photo in similar])
+    return render_to_response('photos/similar_photos.html', {
+        'object': photo,
+        'similar': similar,
+        'distance': distance,
+        'max_distance': MAX_DISTANCE,
+    }, context_instance=RequestContext(request))
+
+
+def _media_etag(request, object_id, field_name, version, filename):
+    return version
+
+
+@condition(etag_func=_media_etag)
+def photo_media(request, object_id, field_name, version, filename):
+    """\
+    Serves the image, thumbnail or a rendition of a Photo.
+
+    Photos in albums that are not public are only served to their owner.
+    The URL includes a version of the file, so responses may be cached
+    indefinitely; requests for an outdated version are redirected to the
+    current one. See media.serve_file() for how the file is sent.
+
+    """
+    photo = get_object_or_404(Photo.objects.select_related('album'),
+                              pk=object_id)
+    _check_album_access(request, photo.album)
+
+    if field_name in ('image', 'thumbnail'):
+        field_file = getattr(photo, field_name)
+        if not field_file:
+            raise Http404
+        current_version = photo.get_media_version(field_name)
+        url = photo.get_media_url(field_name)
+    else:
+        rendition = get_object_or_404(Rendition, photo=photo, name=field_name)
+        field_file = rendition.image
+        current_version = make_version(field_file.name)
+        url = rendition.url
+
+    if version != current_version:
+        return HttpResponseRedirect(url)
+    return serve_file(request, field_file.path, field_file.name,
+                      public=photo.album.is_public)
+
+
 @login_required
 def photo_upload(request, album_id):
     """\
     Uploads a Photo.
 
-    This reads the image metadata from the file on the filesystem into the
-    corresponding properties in the Photo object.
+    The upload is streamed to disk by StreamingImageUploadHandler, which
+    also sniffs its format, so the file is read only once.
+
+    This queues the creation of the thumbnail and the reading of the image
+    metadata from the file on the filesystem into the corresponding
+    properties in the Photo object; both are done by a background worker.
 
     It is assumed that no Photo properties associated with the image metadata
     are submitted, as this would overwrite the metadata in the file without
@@ -42,6 +327,7 @@ def photo_upload(request, album_id):
 
     """
     if request.method == 'POST':
+        request.upload_handlers = [StreamingImageUploadHandler(request)]
         album = get_object_or_404(Album, pk=album_id)
         form = PhotoUploadForm(request.POST, request.FILES)
 
@@ -51,17 +337,11 @@ def photo_upload(request, album_id):
             new_photo = form.save(commit=False)
             new_photo.owner = request.user
             new_photo.album = album
-
-            photo.open()
-            image = Image.open(photo)
-            if image.format == 'JPEG':
-                new_photo.is_jpeg = True
-            photo.close()
+            new_photo.is_jpeg = get_image_format(photo) == 'JPEG'
 
             new_photo.save()
             form.save_m2m()
-            new_photo.create_thumbnail()
-            new_photo.sync_metadata_from_file()
+            enqueue_processing(new_photo)
 
             request.user.message_set.create(
                 message="Your photograph was added successfully.")
@@ -80,6 +360,161 @@ def photo_upload(request, album_id):
     })
 
 
+@login_required
+def photo_batch_upload(request, album_id):
+    """\
+    Uploads many photographs into an Album at once.
+
+    Any number of images, or zip archives of images, may be posted as the
+    images field. The files are streamed to disk, all of the Photos are
+    created in one transaction, and their thumbnails and metadata are
+    processed in parallel by the background workers.
+
+    The response lists the outcome for each file, as JSON for Ajax requests.
+
+    """
+    album = get_object_or_404(Album, pk=album_id, owner__id=request.user.id)
+    results = None
+    if request.method == 'POST':
+        request.upload_handlers = [StreamingImageUploadHandler(request)]
+        results = import_files(request.user, album,
+                               request.FILES.getlist('images'))
+        if request.is_ajax():
+            return _json_response([{
+                'name': result.name,
+                'id': result.photo and result.photo.id,
+                'error': result.error,
+            } for result in results])
+        added = len([result for result in results if result.photo])
+        if added:
+            request.user.message_set.create(
+                message="%d photograph%s added successfully." % (
+                    added, added != 1 and "s were" or " was"))
+
+    return render_to_response('photos/photo_batch_upload.html', {
+        'album': album,
+        'results': results,
+    }, context_instance=RequestContext(request))
+
+
+def _upload_state(session):
+    return {
+        'token': session.token,
+        'url': reverse('upload_session', args=[session.token]),
+        'offset': session.received,
+        'size': session.size,
+    }
+
+
+@login_required
+def upload_initiate(request, album_id):
+    """\
+    Starts a resumable upload of a photograph into an Album.
+
+    The POST parameters are the filename and the size of the file in bytes.
+    The response is the state of the upload as JSON, including the URL to
+    send the chunks to. See upload_session().
+
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    album = get_object_or_404(Album, pk=album_id, owner__id=request.user.id)
+    filename = request.POST.get('filename', '').strip()
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        size = 0
+    if not filename or not 0 < size < 2 ** 31:
+        return HttpResponseBadRequest("A filename and size are required.")
+
+    session = UploadSession.objects.create(owner=request.user, album=album,
+                                           filename=filename, size=size)
+    open(session.path, 'wb').close()
+    return _json_response(_upload_state(session), status=201)
+
+
+@login_required
+def upload_session(request, token):
+    """\
+    Receives a chunk of a resumable upload, or reports its state.
+
+    A PUT request sends the chunk as the request body, with a Content-Range
+    header giving its position, e.g. "bytes 0-1048575/104857600". Chunks
+    must be sent in order; a chunk that does not start where the previous
+    one ended is rejected with 409 Conflict. A GET request returns the
+    state of the upload, whose offset is where the next chunk must start,
+    so an interrupted upload can be resumed.
+
+    """
+    session = get_object_or_404(UploadSession, token=token,
+                                owner__id=request.user.id)
+    if request.method == 'GET':
+        return _json_response(_upload_state(session))
+    if request.method != 'PUT':
+        return HttpResponseNotAllowed(['GET', 'PUT'])
+
+    try:
+        start, end, total = parse_content_range(
+            request.META.get('HTTP_CONTENT_RANGE', ''))
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid Content-Range.")
+    if total != session.size or end - start + 1 != length:
+        return HttpResponseBadRequest("Invalid Content-Range.")
+    if start != session.received:
+        return _json_response(_upload_state(session), status=409)
+
+    written = write_chunk(request.environ['wsgi.input'], session.path,
+                          start, length)
+    # Only one of several requests sending the same chunk is counted.
+    claimed = UploadSession.objects.filter(pk=session.pk, received=start)\
+                                   .update(received=start + written,
+                                           updated=datetime.now())
+    session = UploadSession.objects.get(pk=session.pk)
+    if not claimed:
+        return _json_response(_upload_state(session), status=409)
+    return _json_response(_upload_state(session))
+
+
+@login_required
+def upload_finalize(request, token):
+    """\
+    Completes a resumable upload, creating a Photo from the file.
+
+    The file is moved into place and the thumbnail and metadata are
+    processed in the background, as for photo_upload(). The response gives
+    the ID and URL of the new Photo.
+
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    session = get_object_or_404(UploadSession, token=token,
+                                owner__id=request.user.id)
+    if not session.is_complete:
+        return _json_response(_upload_state(session), status=409)
+
+    f = open(session.path, 'rb')
+    image_format = sniff_image_format(f.read(SIGNATURE_LENGTH))
+    f.close()
+    if image_format is None:
+        session.delete()
+        return HttpResponseBadRequest("The file is not a recognized image.")
+
+    image_file = StagedFile(session.path, session.filename)
+    try:
+        photo = Photo.objects.create_from_file(request.user, session.album,
+                                               image_file, image_format)
+    finally:
+        image_file.close()
+    session.delete()
+    enqueue_processing(photo)
+
+    return _json_response({
+        'id': photo.id,
+        'url': reverse('photo_in_album', kwargs={'object_id': photo.id}),
+    }, status=201)
+
+
 @login_required
 def photo_edit(request, object_id, **kwargs):
     """\
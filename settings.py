@@ -1,5 +1,8 @@
 # Django settings for photasm project.
 
+import os
+import tempfile
+
 DEBUG = False
 TEMPLATE_DEBUG = DEBUG
 
@@ -61,6 +64,26 @@ TEMPLATE_LOADERS = (
 #     'django.template.loaders.eggs.load_template_source',
 )
 
+# Cache for rendered pages and template fragments. Photos are processed by
+# background workers in other processes, so the cache must be shared
+# between processes (a file or memcached backend, not locmem) for their
+# changes to invalidate cached pages.
+CACHE_BACKEND = 'file://%s' % os.path.join(tempfile.gettempdir(),
+                                           'photasm_cache')
+
+# How photo media is sent. None streams files from Django; 'x-sendfile'
+# (Apache mod_xsendfile, lighttpd) or 'x-accel-redirect' (nginx) hands the
+# transfer to the front-end server. For nginx, PHOTO_MEDIA_ACCEL_PREFIX is
+# an internal location aliased to MEDIA_ROOT. MEDIA_ROOT itself should not
+# be served directly, as that would bypass the album access checks.
+PHOTO_MEDIA_SENDFILE = None
+PHOTO_MEDIA_ACCEL_PREFIX = '/protected/'
+
+# Store each distinct image once, named by the hash of its contents, and
+# share it between the photos it is uploaded as. Photos get a copy of their
+# own before metadata is written to a shared image.
+PHOTO_CONTENT_ADDRESSED_STORAGE = False
+
 MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',